@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import math
+import time
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import generate_random_log
+from fanout import FanOut, OK
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+# Query classes over the generate_random_log.py data: 60% of the lines are INFO, a marker is
+# written on about one line in 10000, the regex mostly exercises the scan
+PATTERNS = {
+    'frequent': 'grep -n INFO',
+    'infrequent': 'grep -n NEEDLE',
+    'regex': 'grep -n -E "[a-z]{4}[0-9]{2} "',
+}
+MARKER = 'NEEDLE'
+
+# Where the generator's manifest has the exact number of matches of a query class per file
+GROUND_TRUTH = {
+    'frequent': ('levels', 'INFO'),
+    'infrequent': ('markers', MARKER),
+}
+
+
+def prepare_logs(data_dir, servers, size_mb, seed=42):
+    """
+    Generates one log file of size_mb per server, vm<i>/vm<i>.log under data_dir, unless the
+    manifest there shows the same files were already generated, so repeated runs search the
+    same data.
+
+    Returns:
+        tuple: (the log directory of every server, the generator's manifest).
+    """
+    config = {"shards": servers, "size_mb": size_mb, "name": 'vm{shard}/vm{shard}.log',
+              "markers": {MARKER: max(1, int(size_mb))}, "seed": seed}
+    try:
+        with open(os.path.join(data_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest["config"] != config or not all(os.path.exists(entry["file"]) for entry in manifest["files"]):
+            raise ValueError("Different logs")
+    except (OSError, ValueError, KeyError):
+        print(f"Generating {servers} log files of {size_mb}MB in {data_dir}")
+        manifest = generate_random_log.generate(data_dir, **config)
+    return [os.path.dirname(entry["file"]) for entry in manifest["files"]], manifest
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server on port {port} exited with status {process.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} did not start within {timeout}s")
+
+
+def start_servers(directories, base_port, server_args):
+    """
+    Starts one server.py per log directory on consecutive ports and waits until they listen.
+
+    Returns:
+        list: The server processes.
+    """
+    processes = []
+    try:
+        for i, directory in enumerate(directories):
+            command = [sys.executable, SERVER, '--log_directory', directory, '--port', str(base_port + i)] + server_args
+            # A session of its own, so stopping the server also stops the worker processes of its engine
+            processes.append(subprocess.Popen(command, stdout=subprocess.DEVNULL, start_new_session=True))
+        for i, process in enumerate(processes):
+            wait_for_port(base_port + i, process)
+    except Exception:
+        stop_servers(processes)
+        raise
+    return processes
+
+
+def stop_servers(processes):
+    for process in processes:
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+
+
+def percentile(values, p):
+    """
+    Returns the nearest-rank p-th percentile of values.
+    """
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+async def run_load(servers, query, mode, clients, queries, compression):
+    """
+    Runs queries fan-out queries from each of clients concurrent clients, every client with its
+    own connections, and measures every query from the first byte sent to the last trailer.
+
+    Returns:
+        dict: Latencies in seconds, wall time, bytes and matches of all queries and the errors.
+    """
+    fanouts = [FanOut(servers, compression=compression) for _ in range(clients)]
+    latencies = []
+    totals = {"wire_bytes": 0, "raw_bytes": 0, "matches": 0, "errors": 0}
+    loop = asyncio.get_running_loop()
+
+    async def client(fanout):
+        for _ in range(queries):
+            start = loop.time()
+            results = await fanout.query(query, mode)
+            latencies.append(loop.time() - start)
+            for result in results.values():
+                if result.status != OK:
+                    totals["errors"] += 1
+                    continue
+                totals["wire_bytes"] += result.trailer.get("wire_bytes", 0)
+                totals["raw_bytes"] += result.trailer.get("raw_bytes", 0)
+                totals["matches"] += result.total_matches
+
+    try:
+        start = loop.time()
+        await asyncio.gather(*(client(fanout) for fanout in fanouts))
+        wall = loop.time() - start
+    finally:
+        for fanout in fanouts:
+            fanout.close()
+    return {"latencies": latencies, "wall": wall, **totals}
+
+
+async def run_benchmark(servers, args, manifest):
+    results = []
+    for name in args.patterns:
+        query = PATTERNS[name]
+        expected = None
+        if name in GROUND_TRUTH:
+            kind, key = GROUND_TRUTH[name]
+            expected = sum(entry[kind][key] for entry in manifest["files"])
+        # Warm up the connections, the page cache and the server caches if any
+        await run_load(servers, query, args.mode, 1, args.warmup, args.compression)
+        for clients in args.clients:
+            load = await run_load(servers, query, args.mode, clients, args.queries, args.compression)
+            latencies = [latency * 1000 for latency in load["latencies"]]
+            row = {
+                "pattern": name, "query": query, "mode": args.mode, "clients": clients, "queries": len(latencies),
+                "p50_ms": round(percentile(latencies, 50), 3), "p95_ms": round(percentile(latencies, 95), 3),
+                "p99_ms": round(percentile(latencies, 99), 3), "mean_ms": round(sum(latencies) / len(latencies), 3),
+                "throughput_qps": round(len(latencies) / load["wall"], 3),
+                # Per query, summed over the servers
+                "wire_bytes": load["wire_bytes"] // len(latencies), "raw_bytes": load["raw_bytes"] // len(latencies),
+                "matches": load["matches"] // len(latencies), "expected": expected, "errors": load["errors"],
+            }
+            results.append(row)
+            print(f"{name:>10} clients={clients:<3} p50={row['p50_ms']:.1f}ms p95={row['p95_ms']:.1f}ms "
+                  f"p99={row['p99_ms']:.1f}ms {row['throughput_qps']:.1f} q/s {row['wire_bytes']} bytes/query "
+                  f"({row['raw_bytes']} uncompressed) {row['matches']} matches")
+            if expected is not None and load["matches"] != expected * len(latencies):
+                print(f"{name:>10} WRONG RESULTS: {expected} matches expected per query")
+    return results
+
+
+def compare(results, baseline_file):
+    """
+    Prints the change of every result against the same pattern and client count in a baseline file.
+    """
+    with open(baseline_file) as f:
+        baseline = {(row["pattern"], row["mode"], row["clients"]): row for row in json.load(f)["results"]}
+    print(f"\nChange against {baseline_file}:")
+    for row in results:
+        before = baseline.get((row["pattern"], row["mode"], row["clients"]))
+        if before is None:
+            continue
+        changes = ' '.join(f"{key}={(row[key] - before[key]) / before[key] * 100:+.1f}%"
+                           for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_qps", "wire_bytes") if before[key])
+        print(f"{row['pattern']:>10} clients={row['clients']:<3} {changes}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(SERVER), capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the grep servers on local generated logs.')
+    parser.add_argument('--servers', type=int, default=3, help='Number of local server instances')
+    parser.add_argument('--size_mb', type=int, default=10, help='Size of the generated log file of every server')
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='Where to keep the generated logs between runs (default: a temporary directory)')
+    parser.add_argument('--base_port', type=int, default=10000, help='Port of the first server, the others follow')
+    parser.add_argument('--engine', choices=['grep', 'python'], default='grep', help='Engine of the servers')
+    parser.add_argument('--server_args', type=str, default='',
+                        help="Further server.py options, e.g. '--cache_mb 0 --workers 2'")
+    parser.add_argument('--patterns', nargs='+', choices=list(PATTERNS), default=list(PATTERNS), help='Query classes to run')
+    parser.add_argument('--mode', choices=['all', 'count'], default='all', help='Query mode')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4], help='Concurrent client counts to measure')
+    parser.add_argument('--queries', type=int, default=20, help='Queries per client')
+    parser.add_argument('--warmup', type=int, default=2, help='Queries per pattern before measuring')
+    parser.add_argument('--compression', choices=['zlib', 'none'], default='zlib', help='Compression the clients ask for')
+    parser.add_argument('--output', type=str, default='bench_results.json', help='JSON file to write the results to')
+    parser.add_argument('--baseline', type=str, default=None, help='Earlier results file to compare against')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary:
+        directories, manifest = prepare_logs(args.data_dir or temporary, args.servers, args.size_mb)
+        server_args = ['--engine', args.engine] + args.server_args.split()
+        processes = start_servers(directories, args.base_port, server_args)
+        try:
+            servers = [('127.0.0.1', args.base_port + i) for i in range(args.servers)]
+            args.compression = None if args.compression == 'none' else args.compression
+            results = asyncio.run(run_benchmark(servers, args, manifest))
+        finally:
+            stop_servers(processes)
+
+    report = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "config": {"servers": args.servers, "size_mb": args.size_mb, "engine": args.engine, "server_args": args.server_args,
+                   "queries": args.queries, "compression": args.compression, "python": sys.version.split()[0]},
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    if args.baseline:
+        compare(results, args.baseline)
+
+if __name__ == '__main__':
+    main()
@@ -1,119 +1,321 @@
-import socket
-import threading
 import argparse
 import time
+import asyncio
+import datetime
 from dotenv import load_dotenv
-import os
+from protocol import ENCODINGS, DEFAULT_LEVEL, MAX_BATCH
+from fanout import FanOut, OK, load_servers
+from structured import FORMATS, METRICS, Aggregation, decode_groups, parse_filter
 
-# Lock to manage concurrent access to shared resources
-lock = threading.Lock()
-total_matches = 0
-server_matches = {}
+def send_query_to_server(server_ip, server_port, query, mode='all', limit=None, deadline=30):
+    """
+    Sends a query to a server, writes the streamed matches to <ip>.log as they arrive and returns the total.
+    mode is 'all', 'count' (no lines are transferred), 'first' (the first limit lines) or 'sample'
+    (limit lines drawn uniformly, with the exact total). The query runs on a fan-out to that one
+    server, see fanout.FanOut.query, and gives up after deadline seconds.
+    """
+    server = (server_ip, server_port)
+    # Receive the response frame by frame, memory stays bounded by the batch size
+    with open(f"{server_ip}.log", 'w') as log_file:
+        log_file.write(f"\nResults from {server_ip}:{server_port}:\n")
+        current_file = None
 
-def send_query_to_server(server_ip, server_port, query):
-    """Sends a query to a server and processes the response."""
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client.settimeout(5)
+        def write_matches(_, payload):
+            nonlocal current_file
+            if payload["file"] != current_file:
+                current_file = payload["file"]
+                log_file.write(f"File: {current_file}\n")
+            log_file.writelines(f"Line {line_number}: {line}\n" for line_number, line in payload["lines"])
+
+        async def run():
+            fanout = FanOut([server])
+            try:
+                return (await fanout.query(query, mode, limit, deadline, on_matches=write_matches))[server]
+            finally:
+                fanout.close()
+
+        result = asyncio.run(run())
+        for name, message in result.errors.items():
+            log_file.write(f"An error occurred while processing {name}: {message}\n")
+        if result.status != OK:
+            print(f"Error from {server_ip}:{server_port}: {result.message}")
+            log_file.write(f"ERROR: {result.message}\n")
+            return 0
+        log_file.write(f"TOTAL_MATCHES:{result.total_matches}\n")
+        return result.total_matches
+
+def parse_time(text):
+    """
+    Parses a Unix time or a local ISO date and time such as 2024-09-15 or 2024-09-15T12:00:00.
+    """
     try:
-        # Connect to the server
-        client.connect((server_ip, server_port))
-        client.send(query.encode('utf-8'))
-
-        # Receive and assemble the response
-        response = ""
-        while True:
-            chunk = client.recv(32768).decode('utf-8')
-            if "EOF" in chunk:
-                response += chunk.replace("EOF", "")
-                break
-            response += chunk
-
-        # print(f"\nResults from {server_ip}:{server_port}:\n{response}")
-
-        log_filename = f"{server_ip}.log"
-        with open(log_filename, 'w') as log_file:
-            log_file.write(f"\nResults from {server_ip}:{server_port}:\n{response}\n")
-        # Extract file name and total matches from the response
-        # file_name = [line for line in response.split('\n') if line.startswith('File:')]
-        # if file_name:
-        #     name = file_name[0].split(':')[1].strip()
-        
-        # with open(f"{name}_response.txt", "w") as logfile:
-        #     logfile.write(response)
-
-        matches_part = [line for line in response.split('\n') if line.startswith('TOTAL_MATCHES:')]
-        if matches_part:
-            total_matches = int(matches_part[0].split(':')[1].strip())
-            # server_matches[name] = total_matches
-            server_matches[server_ip] = total_matches
-            return total_matches
-
-        return 0
-    except Exception as e:
-        print(f"Error connecting to {server_ip}:{server_port}: {e}")
-        return 0
-    finally:
-        client.close()
-
-def query_server(ip, port, query):
-    """Wrapper function to handle querying a server and updating the global total_matches."""
-    global total_matches
-    matches = send_query_to_server(ip, port, query)
-    with lock:
-        total_matches += matches
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a Unix time or ISO date: {text}")
+
+def parse_log_time(text):
+    """
+    Parses a local ISO date and time into the "YYYY-MM-DD HH:MM:SS" timestamps of the log lines.
+    """
+    try:
+        return datetime.datetime.fromisoformat(text).strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not an ISO date: {text}")
+
+def time_range_of(args):
+    """
+    Returns the time_range of the lines to search, or None to search all of them.
+    """
+    if args.last_minutes:
+        start = datetime.datetime.now() - datetime.timedelta(minutes=args.last_minutes)
+        return [start.strftime('%Y-%m-%d %H:%M:%S'), None]
+    if args.time_from is None and args.time_to is None:
+        return None
+    return [args.time_from, args.time_to]
+
+def filter_arg(text):
+    try:
+        return parse_filter(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def metric_arg(text):
+    """
+    Parses a metric written as count, min:field or max:field.
+    """
+    metric = text.split(':')
+    if metric[0] not in METRICS or len(metric) != (1 if metric[0] == 'count' else 2):
+        raise argparse.ArgumentTypeError(f"metrics look like count, min:size or max:time: {text}")
+    return metric
+
+def aggregate_spec(args):
+    """
+    Returns the "aggregate" spec of the structured query options, or None if not in aggregate mode.
+    """
+    if args.mode != 'aggregate':
+        return None
+    return {"format": args.format, "filters": args.filter, "metrics": args.metric or [["count"]],
+            "group_by": [field for field in (args.group_by or '').split(',') if field]}
+
+def print_aggregate(spec, results):
+    """
+    Merges the partial aggregates of the servers and prints one row per group.
+    """
+    aggregation = Aggregation(spec)
+    for result in results.values():
+        if result.trailer and "groups" in result.trailer:
+            aggregation.merge((decode_groups(result.trailer["groups"]), result.trailer["total_matches"],
+                               result.trailer.get("unparsed", 0)))
+    names = aggregation.metric_names()
+    for key in sorted(aggregation.groups, key=lambda key: [(value is None, str(value)) for value in key]):
+        group = ' '.join(f"{field}={value}" for field, value in zip(aggregation.group_by, key))
+        values = ' '.join(f"{name}={value}" for name, value in zip(names, aggregation.groups[key]))
+        print(f"{group} {values}".strip())
+    print(f"Groups: {len(aggregation.groups)}, lines aggregated: {aggregation.matched}, lines not in the format: {aggregation.unparsed}")
+
+def print_stats(stats):
+    """
+    Prints where the query time of every server goes, see metrics.Metrics.snapshot.
+    """
+    for (ip, port), snapshot in stats.items():
+        if isinstance(snapshot, Exception):
+            print(f"{ip}:{port}: no stats: {snapshot}")
+            continue
+        histograms = snapshot["histograms"]
+        print(f"{ip}:{port}: {histograms['query_seconds']['count']} queries in {snapshot['uptime']:.0f}s, "
+              f"{snapshot['active_queries']} running, {snapshot['statuses']}")
+        for name in ("query_seconds", "queue_wait_seconds", "file_seconds", "serialize_seconds", "send_seconds"):
+            histogram = histograms[name]
+            print(f"    {name:<20} p50={histogram['p50'] * 1000:.1f}ms p95={histogram['p95'] * 1000:.1f}ms "
+                  f"p99={histogram['p99'] * 1000:.1f}ms max={histogram['max'] * 1000:.1f}ms")
+        slowest_files = sorted(snapshot["files"].items(), key=lambda item: item[1]["max_seconds"], reverse=True)[:3]
+        for log_file, file_stats in slowest_files:
+            print(f"    slowest file {log_file}: {file_stats['max_seconds']:.3f}s, {file_stats['searches']} searches")
+        for summary in snapshot["slowest"][:5]:
+            print(f"    slowest query {summary['seconds']:.3f}s ({summary['queue_wait']:.3f}s waiting) {summary['mode']} "
+                  f"{summary['query']}: {summary['files']} files, {summary['bytes_scanned']} bytes, {summary['matches']} matches")
+
+async def check_health_forever(fanout, interval):
+    while True:
+        await asyncio.sleep(interval)
+        for (ip, port), health in (await fanout.check_health(interval)).items():
+            if isinstance(health, Exception):
+                print(f"Health check of {ip}:{port} failed: {health}")
+
+async def run_queries(fanout, args):
+    """
+    Reads queries from the user and fans each of them out to all servers, writing every
+    server's matches to <ip>.log as they arrive.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        # Get query input from user without blocking the connections
+        query = await loop.run_in_executor(None, input, "Enter search pattern (or type 'exit' to disconnect): ")
+        if query.lower() == 'exit':
+            print("Disconnecting from all servers...")
+            break
+        if args.batch:
+            # The servers search for the whole batch in one pass over their logs
+            query = [query]
+            while len(query) < MAX_BATCH:
+                line = await loop.run_in_executor(None, input, "Next pattern of the batch (empty line to run it): ")
+                if not line:
+                    break
+                query.append(line)
+
+        log_files = {}
+
+        def log_file_of(server):
+            if server not in log_files:
+                log_file = open(f"{server[0]}.log", 'w')
+                log_file.write(f"\nResults from {server[0]}:{server[1]}:\n")
+                log_files[server] = [log_file, None]
+            return log_files[server]
+
+        def write_matches(server, payload):
+            entry = log_file_of(server)
+            if (payload["file"], payload.get("pattern")) != entry[1]:
+                entry[1] = (payload["file"], payload.get("pattern"))
+                pattern = f" (pattern {payload['pattern'] + 1}: {query[payload['pattern']]})" if "pattern" in payload else ""
+                entry[0].write(f"File: {payload['file']}{pattern}\n")
+            entry[0].writelines(f"Line {line_number}: {line}\n" if line_number is not None else f"{line}\n"
+                                for line_number, line in payload["lines"])
+
+        spec = aggregate_spec(args)
+        start_time = time.time()
+        if args.mode == 'subscribe':
+            def follow_matches(server, payload):
+                write_matches(server, payload)
+                log_file_of(server)[0].flush()
+                for line_number, line in payload["lines"]:
+                    # Lines of a file followed from its end are not numbered until they are counted
+                    location = f"{payload['file']}:{line_number}" if line_number is not None else payload['file']
+                    print(f"{server[0]} {location}: {line}")
+
+            # The servers push the new matches as their logs grow, until the user stops it
+            stopped = asyncio.Event()
+            subscription = asyncio.ensure_future(fanout.subscribe(query, stopped, follow_matches, files=args.files))
+            await loop.run_in_executor(None, input, "Following the logs, press Enter to stop\n")
+            stopped.set()
+            results = await subscription
+        else:
+            results = await fanout.query(query, args.mode, args.limit, args.deadline or None, args.server_timeout or None,
+                                         write_matches, files=args.files, since=args.since, until=args.until,
+                                         time_range=time_range_of(args), aggregate=spec)
+        end_time = time.time()
+        latency = (end_time - start_time) * 1000
+
+        # Display the results, servers that did not finish in time count with what they sent
+        total_matches = 0
+        answered = 0
+        for server, result in results.items():
+            log_file = log_file_of(server)[0]
+            for name, message in result.errors.items():
+                log_file.write(f"An error occurred while processing {name}: {message}\n")
+            if result.status == OK:
+                log_file.write(f"TOTAL_MATCHES:{result.total_matches}\n")
+                answered += 1
+                via = "" if result.answered_by == server else f" (answered by {result.answered_by[0]}:{result.answered_by[1]})"
+                print(f"\nFile: {server[0]}: {result.total_matches} matches{via}")
+            else:
+                log_file.write(f"ERROR: {result.message}\n")
+                print(f"\nFile: {server[0]}: {result.status}, {result.total_matches} matches received: {result.message}")
+            log_file.close()
+            total_matches += result.total_matches
+
+        if spec is not None:
+            print_aggregate(spec, results)
+        if args.batch:
+            for i, pattern in enumerate(query):
+                matches = sum(result.trailer["patterns"][i]["total_matches"] for result in results.values()
+                              if result.trailer and "patterns" in result.trailer)
+                print(f"Pattern {i + 1} ({pattern}): TOTAL_MATCHES:{matches}")
+        print(f"Servers answered: {answered}/{len(results)}")
+        print(f"Total matches across all servers: {total_matches}")
+        # Bytes of the complete results, as sent and as they would have been without compression
+        wire_bytes = sum(result.trailer.get("wire_bytes", 0) for result in results.values() if result.trailer)
+        raw_bytes = sum(result.trailer.get("raw_bytes", 0) for result in results.values() if result.trailer)
+        print(f"Total latency: {latency}ms")
+        print(f"Transferred: {wire_bytes} bytes ({raw_bytes} uncompressed)\n")
 
 def main():
     """Main function to handle user input, query servers, and display results."""
+    parser = argparse.ArgumentParser(description='Query the log grep servers.')
+    parser.add_argument('--mode', choices=['all', 'count', 'first', 'sample', 'aggregate', 'subscribe'], default='all',
+                        help='Return every match, only the counts, the first --limit matches, a sample of --limit matches, '
+                             'the --group_by groups of the matches, or follow the new matches as the logs grow')
+    parser.add_argument('--limit', type=int, default=None, help='Number of lines for the first and sample modes')
+    parser.add_argument('--files', type=str, default=None,
+                        help="Glob pattern of the log files to search, e.g. 'vm1.log*' for the rotated and compressed ones too")
+    parser.add_argument('--since', type=parse_time, default=None, help='Only search files written to at or after this time')
+    parser.add_argument('--until', type=parse_time, default=None, help='Only search files with lines from at or before this time')
+    parser.add_argument('--time_from', type=parse_log_time, default=None,
+                        help='Only search the lines with a timestamp at or after this time, e.g. "2024-09-15 12:00:00"')
+    parser.add_argument('--time_to', type=parse_log_time, default=None,
+                        help='Only search the lines with a timestamp at or before this time')
+    parser.add_argument('--last_minutes', type=float, default=None,
+                        help='Only search the lines of the last minutes before each query, instead of --time_from and --time_to')
+    parser.add_argument('--batch', action='store_true',
+                        help='Enter several patterns per query, each server finds the matches of all of them in one pass')
+    parser.add_argument('--format', choices=['auto'] + list(FORMATS), default='auto',
+                        help='Log format the aggregate mode parses the matching lines in')
+    parser.add_argument('--filter', type=filter_arg, action='append', default=[],
+                        help='Only aggregate the lines whose field matches, e.g. level=ERROR, status>=500 or path~^/wp- (repeatable)')
+    parser.add_argument('--group_by', type=str, default=None, help='Comma separated fields to group by, e.g. minute,level')
+    parser.add_argument('--metric', type=metric_arg, action='append', default=None,
+                        help='count, min:field or max:field per group (repeatable, count by default)')
+    parser.add_argument('--health_interval', type=float, default=10,
+                        help='Seconds between health checks of the server connections (0 to disable)')
+    parser.add_argument('--deadline', type=float, default=30,
+                        help='Seconds for a whole query, slower servers are reported with their partial results (0 for no deadline)')
+    parser.add_argument('--server_timeout', type=float, default=0, help='Seconds any single server may take (0 for no limit)')
+    parser.add_argument('--hedge_after', type=float, default=0,
+                        help='Also ask the SERVER_<n>_REPLICA of a server that has not answered after this many seconds (0 to disable)')
+    parser.add_argument('--connect_timeout', type=float, default=5, help='Seconds to wait for a connection to a server')
+    parser.add_argument('--compression', choices=list(ENCODINGS) + ['none'], default='zlib',
+                        help='Ask the servers to compress the matches they send')
+    parser.add_argument('--compress_level', type=int, choices=range(10), default=DEFAULT_LEVEL, metavar='0-9',
+                        help='Compression level, higher is smaller but slower for the servers')
+    parser.add_argument('--stats', action='store_true', help='Print the query metrics of every server and exit')
+    args = parser.parse_args()
+    if args.mode in ('first', 'sample') and not args.limit:
+        parser.error(f"--mode {args.mode} needs --limit")
+    if args.batch and args.mode not in ('all', 'count'):
+        parser.error("--batch works with --mode all or count")
+    if args.mode == 'aggregate':
+        try:
+            Aggregation(aggregate_spec(args))
+        except ValueError as e:
+            parser.error(str(e))
+
     # Load environment variables from .env file
     load_dotenv()
-    servers = []
-    index = 1
+    servers, replicas = load_servers()
 
-    # Retrieve server IPs and ports from environment variables
-    while True:
-        ip = os.getenv(f'SERVER_{index}_IP')
-        port = os.getenv(f'SERVER_{index}_PORT')
-        
-        if ip is None or port is None:
-            break
-        
-        servers.append((ip, int(port)))
-        index += 1
+    async def session():
+        # One persistent connection per server, reused by every query of the session
+        compression = None if args.compression == 'none' else args.compression
+        fanout = FanOut(servers, replicas, args.connect_timeout, args.hedge_after or None, compression, args.compress_level)
+        if args.stats:
+            try:
+                print_stats(await fanout.stats(args.connect_timeout))
+            finally:
+                fanout.close()
+            return
+        health = asyncio.ensure_future(check_health_forever(fanout, args.health_interval)) if args.health_interval else None
+        try:
+            await run_queries(fanout, args)
+        finally:
+            if health is not None:
+                health.cancel()
+            fanout.close()
 
     try:
-        while True:
-            # Get query input from user
-            query = input("Enter search pattern (or type 'exit' to disconnect): ")
-            if query.lower() == 'exit':
-                print("Disconnecting from all servers...")
-                break
-
-            global total_matches
-            total_matches = 0
-            server_matches.clear()
-
-            start_time = time.time()
-
-            # Create and start a thread for each server
-            threads = []
-            for server_ip, server_port in servers:
-                thread = threading.Thread(target=query_server, args=(server_ip, server_port, query))
-                threads.append(thread)
-                thread.start()
-
-            # Wait for all threads to complete
-            for thread in threads:
-                thread.join()
-
-            end_time = time.time()
-            latency = (end_time - start_time) * 1000
-
-            # Display the results
-            for name, matches in server_matches.items():
-                print(f"\nFile: {name}: {matches} matches")
-
-            print(f"Total matches across all servers: {total_matches}")
-            print(f"Total latency: {latency}ms\n")
+        asyncio.run(session())
     except Exception as e:
         print(f"An error occurred: {e}")
 
@@ -0,0 +1,467 @@
+import os
+import asyncio
+import itertools
+from protocol import (QUERY, MATCHES, TRAILER, ERROR, PING, PONG, HELLO, UNSUBSCRIBE, STATS, DEFAULT_LEVEL, ProtocolError,
+                      Decompressor, encode_frame, read_frame)
+
+# Status of a server in the result of a fan-out query
+OK = 'ok'                    # the server (or its replica) sent the complete result
+ERROR_STATUS = 'error'       # the server rejected the query, e.g. busy or invalid pattern
+TIMEOUT = 'timeout'          # the deadline passed, the counts only cover what arrived before
+UNREACHABLE = 'unreachable'  # neither the server nor any replica could be reached
+
+
+def load_servers(environ=os.environ):
+    """
+    Reads the servers from SERVER_<n>_IP and SERVER_<n>_PORT, and their replicas from the
+    optional SERVER_<n>_REPLICA, a comma separated list of ip:port holding the same logs.
+
+    Returns:
+        tuple: (servers, replicas) where servers is a list of (ip, port) and replicas maps
+        a server to the list of its replicas.
+    """
+    servers = []
+    replicas = {}
+    for index in itertools.count(1):
+        ip = environ.get(f'SERVER_{index}_IP')
+        port = environ.get(f'SERVER_{index}_PORT')
+        if ip is None or port is None:
+            break
+        server = (ip, int(port))
+        servers.append(server)
+        for replica in environ.get(f'SERVER_{index}_REPLICA', '').split(','):
+            if replica.strip():
+                replica_ip, replica_port = replica.strip().rsplit(':', 1)
+                replicas.setdefault(server, []).append((replica_ip, int(replica_port)))
+    return servers, replicas
+
+
+class ServerResult:
+    """
+    What one server contributed to a fan-out query.
+
+    Attributes:
+        server (tuple): (ip, port) of the server the query was addressed to.
+        status (str): OK, ERROR_STATUS, TIMEOUT or UNREACHABLE.
+        answered_by (tuple): (ip, port) that sent the result, the server or one of its replicas.
+        hedged (bool): Whether the query was also sent to a replica.
+        files (dict): Matches per file, from the trailer or counted so far.
+        errors (dict): Error message per file that could not be searched.
+        total_matches (int): Matches reported by the trailer, or received before the deadline.
+        message (str): Why the result is not OK.
+        latency (float): Seconds until the result was complete, or until it was given up.
+        trailer (dict): The full trailer payload if one arrived.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.status = TIMEOUT
+        self.answered_by = None
+        self.hedged = False
+        self.files = {}
+        self.errors = {}
+        self.total_matches = 0
+        self.message = None
+        self.latency = None
+        self.trailer = None
+
+
+class AsyncSession:
+    """
+    A persistent connection to one server on the event loop. Queries are multiplexed by id
+    and a lost connection is reopened by the next request. Matches are compressed if
+    compression is set and the server agrees.
+    """
+
+    def __init__(self, host, port, connect_timeout=5, compression='zlib', level=DEFAULT_LEVEL):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.compression = compression
+        self.level = level
+        self.encoding = None
+        self.writer = None
+        self.connecting = None
+        self.replies = {}
+        self.request_ids = itertools.count(1)
+
+    async def connect(self):
+        """
+        Returns the stream writer of the open connection, connecting first if there is none.
+        Concurrent requests wait for the same connection attempt.
+        """
+        if self.writer is not None:
+            return self.writer
+        if self.connecting is None:
+            self.connecting = asyncio.ensure_future(self.open_connection())
+        try:
+            return await asyncio.shield(self.connecting)
+        finally:
+            if self.connecting is not None and self.connecting.done():
+                self.connecting = None
+
+    async def open_connection(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.connect_timeout)
+        if self.compression is not None:
+            writer.write(encode_frame(HELLO, {"accept_encoding": [self.compression], "level": self.level}))
+        self.writer = writer
+        asyncio.ensure_future(self.read_frames(reader, writer))
+        return writer
+
+    async def read_frames(self, reader, writer):
+        decompressor = Decompressor()
+        try:
+            while True:
+                frame = await read_frame(reader, decompressor)
+                if frame is None:
+                    raise ProtocolError("Connection closed by the server")
+                if frame[0] == HELLO:
+                    self.encoding = frame[2].get("encoding")
+                    continue
+                replies = self.replies.get(frame[2].get("id"))
+                if replies is not None:
+                    replies.put_nowait(frame)
+        except (OSError, ProtocolError) as e:
+            self.disconnect(writer, e)
+
+    def disconnect(self, writer, error):
+        """
+        Closes the connection of writer and fails the requests that were waiting on it.
+        """
+        if self.writer is not writer:
+            return
+        self.writer = None
+        writer.close()
+        for replies in self.replies.values():
+            replies.put_nowait(error)
+
+    async def send(self, writer, data):
+        """
+        Writes data to the connection of writer and waits until it can take more.
+
+        Raises:
+            OSError: If the connection fails, which also fails the other requests on it.
+        """
+        try:
+            writer.write(data)
+            await writer.drain()
+        except OSError as e:
+            self.disconnect(writer, e)
+            raise
+
+    async def request(self, frame_type, payload):
+        """
+        Sends a frame and yields the frames of the response until a TRAILER, ERROR, PONG or STATS.
+        A request whose reused connection fails before any response arrived is retried once. A
+        query abandoned before its response ended, e.g. a hedge that lost or a query past its
+        deadline, is cancelled on the server.
+
+        Raises:
+            OSError, ProtocolError: If the connection fails.
+        """
+        for attempt in range(2):
+            request_id = next(self.request_ids)
+            replies = asyncio.Queue()
+            self.replies[request_id] = replies
+            reused = self.writer is not None
+            received = False
+            writer = None
+            ended = False
+            try:
+                writer = await self.connect()
+                await self.send(writer, encode_frame(frame_type, dict(payload, id=request_id)))
+                while True:
+                    frame = await replies.get()
+                    if isinstance(frame, Exception):
+                        ended = True
+                        raise frame
+                    received = True
+                    yield frame
+                    if frame[0] in (TRAILER, ERROR, PONG, STATS):
+                        ended = True
+                        return
+            except (OSError, ProtocolError):
+                if received or not reused or attempt == 1:
+                    raise
+            finally:
+                self.replies.pop(request_id, None)
+                if frame_type == QUERY and not ended and writer is not None and self.writer is writer:
+                    # Not awaited, the request may be cancelled itself. The server answers
+                    # with an error nobody reads.
+                    writer.write(encode_frame(UNSUBSCRIBE, {"id": request_id}))
+
+    async def subscribe(self, payload, stopped):
+        """
+        Sends a subscribe query and yields the frames of its response. Once stopped (an
+        asyncio.Event) is set, the subscription is ended and the frames are yielded up to its
+        TRAILER. A subscription is not retried, lines appended while it was down would be lost.
+
+        Raises:
+            OSError, ProtocolError: If the connection fails.
+        """
+        request_id = next(self.request_ids)
+        replies = asyncio.Queue()
+        self.replies[request_id] = replies
+        stop = asyncio.ensure_future(stopped.wait())
+        try:
+            writer = await self.connect()
+            await self.send(writer, encode_frame(QUERY, dict(payload, mode='subscribe', id=request_id)))
+            while True:
+                reply = asyncio.ensure_future(replies.get())
+                await asyncio.wait([reply, stop], return_when=asyncio.FIRST_COMPLETED)
+                if not reply.done():
+                    reply.cancel()
+                    await self.send(writer, encode_frame(UNSUBSCRIBE, {"id": request_id}))
+                    stop = asyncio.ensure_future(asyncio.Event().wait())
+                    continue
+                frame = reply.result()
+                if isinstance(frame, Exception):
+                    raise frame
+                yield frame
+                if frame[0] in (TRAILER, ERROR):
+                    return
+        finally:
+            stop.cancel()
+            self.replies.pop(request_id, None)
+
+    async def ping(self):
+        """
+        Returns the round trip time of a health check in seconds.
+        """
+        start = asyncio.get_running_loop().time()
+        async for _ in self.request(PING, {}):
+            pass
+        return asyncio.get_running_loop().time() - start
+
+    async def stats(self):
+        """
+        Returns the server's query metrics, see metrics.Metrics.snapshot.
+        """
+        async for frame_type, _, payload in self.request(STATS, {}):
+            if frame_type == STATS:
+                return payload["stats"]
+        raise ProtocolError("No stats in the response")
+
+    def close(self):
+        if self.writer is not None:
+            self.disconnect(self.writer, ProtocolError("Session closed"))
+
+
+class FanOut:
+    """
+    Sends each query to every server at once from a single event loop, over one persistent
+    session per server, and collects the results under a global deadline.
+
+    A server that has not started to answer after hedge_after seconds gets the same query
+    sent to its next replica; the first of them to answer is used and the other one ignored.
+    A server that cannot be reached fails over to its replicas right away. The matches are
+    sent compressed with compression at level, unless compression is None.
+    """
+
+    def __init__(self, servers, replicas=None, connect_timeout=5, hedge_after=None, compression='zlib', level=DEFAULT_LEVEL):
+        self.servers = list(servers)
+        self.replicas = replicas or {}
+        self.connect_timeout = connect_timeout
+        self.hedge_after = hedge_after
+        self.compression = compression
+        self.level = level
+        self.sessions = {}
+
+    def session(self, address):
+        if address not in self.sessions:
+            self.sessions[address] = AsyncSession(address[0], address[1], self.connect_timeout, self.compression, self.level)
+        return self.sessions[address]
+
+    async def query(self, query, mode='all', limit=None, deadline=None, server_timeout=None, on_matches=None, **options):
+        """
+        Runs a query on all servers.
+
+        Args:
+            query (str): The grep command or pattern, or a list of them to run as one batch.
+            mode (str): 'all', 'count', 'first' or 'sample', see protocol.QUERY_MODES.
+            limit (int): Number of lines for the first and sample modes.
+            deadline (float): Seconds for the whole query, after which the servers that have not
+                finished are given up with the partial counts received so far.
+            server_timeout (float): Seconds any single server may take.
+            on_matches (callable): Called with (server, payload) for every MATCHES frame, so
+                the lines can be written out as they arrive instead of being kept.
+            options: Further QUERY fields, e.g. the files glob and the since and until times.
+
+        Returns:
+            dict: ServerResult per server, in the order of the servers.
+        """
+        request = {"queries": query} if isinstance(query, list) else {"query": query}
+        request["mode"] = mode
+        if limit is not None:
+            request["limit"] = limit
+        request.update((name, value) for name, value in options.items() if value is not None)
+        results = {server: ServerResult(server) for server in self.servers}
+        tasks = [asyncio.ensure_future(self.query_server(server, request, results[server], server_timeout, on_matches))
+                 for server in self.servers]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=deadline)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        for result in results.values():
+            if result.status == TIMEOUT:
+                result.message = result.message or "Deadline passed before the server finished"
+        return results
+
+    async def query_server(self, server, request, result, timeout, on_matches):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            await asyncio.wait_for(self.hedged_query(server, request, result, on_matches), timeout)
+        except asyncio.TimeoutError:
+            result.status = TIMEOUT
+            result.message = f"No complete result within {timeout}s"
+        finally:
+            result.latency = loop.time() - start
+
+    async def hedged_query(self, server, request, result, on_matches):
+        """
+        Runs the query on server and, when it is slow or down, on its replicas. Only the frames
+        of the first address that answers are used.
+        """
+        backups = iter(self.replicas.get(server, []))
+        attempts = {}
+        error = None
+
+        async def attempt(address):
+            async for frame_type, _, payload in self.session(address).request(QUERY, request):
+                if result.answered_by is None:
+                    result.answered_by = address
+                    # The first answer wins, the other attempts stop reading
+                    for task, other in attempts.items():
+                        if other != address:
+                            task.cancel()
+                if frame_type == MATCHES:
+                    result.files[payload["file"]] = result.files.get(payload["file"], 0) + len(payload["lines"])
+                    result.total_matches += len(payload["lines"])
+                    if on_matches is not None:
+                        on_matches(server, payload)
+                elif frame_type == TRAILER:
+                    result.status = OK
+                    result.trailer = payload
+                    result.files = payload["files"]
+                    result.errors = payload["errors"]
+                    result.total_matches = payload["total_matches"]
+                elif frame_type == ERROR:
+                    result.status = ERROR_STATUS
+                    result.message = payload["message"]
+
+        def start(address):
+            attempts[asyncio.ensure_future(attempt(address))] = address
+
+        start(server)
+        try:
+            while attempts:
+                hedge = self.hedge_after if result.answered_by is None else None
+                done, _ = await asyncio.wait(attempts, timeout=hedge, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Slow to answer: ask a replica as well, unless there is none left
+                    backup = next(backups, None)
+                    if backup is not None:
+                        result.hedged = True
+                        start(backup)
+                    else:
+                        await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                for task in done:
+                    address = attempts.pop(task)
+                    if task.cancelled():
+                        continue
+                    if task.exception() is None or result.answered_by == address:
+                        if task.exception() is not None:
+                            result.status = ERROR_STATUS
+                            result.message = f"Connection to {address[0]}:{address[1]} lost: {task.exception()}"
+                        return
+                    error = task.exception()
+                    if result.answered_by is None and not attempts:
+                        # Down: fail over to the next replica right away
+                        backup = next(backups, None)
+                        if backup is not None:
+                            start(backup)
+            result.status = UNREACHABLE
+            result.message = f"Could not reach {server[0]}:{server[1]} or a replica: {error}"
+        finally:
+            for task in attempts:
+                task.cancel()
+
+    async def subscribe(self, query, stopped, on_matches=None, **options):
+        """
+        Subscribes to the new matches of query on every server until stopped (an asyncio.Event)
+        is set. Replicas are not subscribed to, they would send the same lines again.
+
+        Args:
+            on_matches (callable): Called with (server, payload) for every MATCHES frame.
+            options: Further QUERY fields, e.g. the files glob.
+
+        Returns:
+            dict: ServerResult per server, OK once the server confirmed the end of the subscription.
+        """
+        request = {"query": query}
+        request.update((name, value) for name, value in options.items() if value is not None)
+        results = {server: ServerResult(server) for server in self.servers}
+
+        async def subscribe(server):
+            result = results[server]
+            start = asyncio.get_running_loop().time()
+            try:
+                async for frame_type, _, payload in self.session(server).subscribe(request, stopped):
+                    result.answered_by = server
+                    if frame_type == MATCHES:
+                        result.files[payload["file"]] = result.files.get(payload["file"], 0) + len(payload["lines"])
+                        result.total_matches += len(payload["lines"])
+                        if on_matches is not None:
+                            on_matches(server, payload)
+                    elif frame_type == TRAILER:
+                        result.status = OK
+                        result.trailer = payload
+                    elif frame_type == ERROR:
+                        result.status = ERROR_STATUS
+                        result.message = payload["message"]
+            except (OSError, ProtocolError) as e:
+                result.status = UNREACHABLE if result.answered_by is None else ERROR_STATUS
+                result.message = f"Subscription to {server[0]}:{server[1]} lost: {e}"
+            finally:
+                result.latency = asyncio.get_running_loop().time() - start
+
+        await asyncio.gather(*(subscribe(server) for server in self.servers))
+        return results
+
+    async def check_health(self, timeout=None):
+        """
+        Pings every server and replica, reconnecting where needed.
+
+        Returns:
+            dict: Round trip time in seconds, or the error, per (ip, port).
+        """
+        addresses = list(self.servers) + [replica for server in self.servers for replica in self.replicas.get(server, [])]
+
+        async def check(address):
+            try:
+                return await asyncio.wait_for(self.session(address).ping(), timeout)
+            except Exception as e:
+                return e
+
+        return dict(zip(addresses, await asyncio.gather(*(check(address) for address in addresses))))
+
+    async def stats(self, timeout=None):
+        """
+        Returns the query metrics, or the error, of every server and replica per (ip, port).
+        """
+        addresses = list(self.servers) + [replica for server in self.servers for replica in self.replicas.get(server, [])]
+
+        async def fetch(address):
+            try:
+                return await asyncio.wait_for(self.session(address).stats(), timeout)
+            except Exception as e:
+                return e
+
+        return dict(zip(addresses, await asyncio.gather(*(fetch(address) for address in addresses))))
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
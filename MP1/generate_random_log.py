@@ -1,29 +1,296 @@
-import random
 import os
+import json
+import math
 import time
+import random
 import string
+import argparse
+import calendar
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+LEVELS = ('INFO', 'DEBUG', 'WARNING', 'ERROR')
+LEVEL_WEIGHTS = (60, 25, 10, 5)
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+DEFAULT_START = "2024-09-15 12:00:00"
+
+# Lines generated per task. A task's text is held in memory until it is written, so memory
+# stays around two tasks per worker whatever the size of the files.
+SEGMENT_LINES = 100000
+
+# Messages are slices of a pool of tokens drawn once from the Zipf distribution, so a line
+# costs two random numbers and a slice instead of one random draw per character
+POOL_TOKENS = 1 << 18
+
+# The vocabulary is lowercase letters and digits, so the levels and markers written in
+# capitals never appear in a message by chance and their counts are exact
+ALPHABET = string.ascii_lowercase
+
+
+def make_vocabulary(rng, size):
+    """
+    Returns size distinct words, a sixth of them ending in digits like ids do.
+    """
+    words = set()
+    vocabulary = []
+    while len(vocabulary) < size:
+        word = ''.join(rng.choices(ALPHABET, k=rng.randint(2, 10)))
+        if rng.random() < 1 / 6:
+            word += str(rng.randint(0, 9999))
+        if word not in words:
+            words.add(word)
+            vocabulary.append(word)
+    return vocabulary
+
+
+class Generator:
+    """
+    Generates log lines "YYYY-MM-DD HH:MM:SS - LEVEL - message". Built from the same options,
+    every process generates the same lines, so the output does not depend on the number of
+    workers.
+
+    Timestamps start at start and advance by one second every lines_per_second lines, the
+    levels follow level_weights and the words of the messages a Zipf distribution of exponent
+    zipf over the vocabulary, the first word being the most frequent.
+
+    Attributes:
+        mean_line (float): Expected length of a line in bytes, to turn a size into a line count.
+    """
+
+    def __init__(self, seed=42, start=DEFAULT_START, lines_per_second=100.0, level_weights=LEVEL_WEIGHTS,
+                 vocabulary=5000, zipf=1.1, min_tokens=3, max_tokens=15):
+        if lines_per_second <= 0 or not 1 <= min_tokens <= max_tokens or vocabulary < 1 or len(level_weights) != len(LEVELS):
+            raise ValueError("Invalid generator options")
+        self.seed = seed
+        self.start = calendar.timegm(time.strptime(start, TIME_FORMAT))
+        self.lines_per_second = lines_per_second
+        self.level_weights = list(level_weights)
+        self.token_counts = list(range(min_tokens, max_tokens + 1))
+        self.max_tokens = max_tokens
+
+        rng = random.Random(f"{seed}/vocabulary")
+        words = make_vocabulary(rng, vocabulary)
+        tokens = rng.choices(words, weights=[1 / rank ** zipf for rank in range(1, vocabulary + 1)], k=POOL_TOKENS)
+        self.pool = ' '.join(tokens) + ' '
+        # starts[i] is the offset of token i in the pool, a message of n tokens from i ends before starts[i + n] - 1
+        self.starts = [0] * (len(tokens) + 1)
+        for i, token in enumerate(tokens):
+            self.starts[i + 1] = self.starts[i] + len(token) + 1
+
+        mean_message = len(self.pool) / len(tokens) * sum(self.token_counts) / len(self.token_counts) - 1
+        mean_level = sum(len(level) * weight for level, weight in zip(LEVELS, self.level_weights)) / sum(self.level_weights)
+        self.mean_line = len("YYYY-MM-DD HH:MM:SS - ") + mean_level + len(" - ") + mean_message + 1
+
+    def timestamp(self, line):
+        return time.strftime(TIME_FORMAT, time.gmtime(self.start + int(line / self.lines_per_second)))
+
+    def segment(self, shard, index, first_line, count, markers):
+        """
+        Generates lines first_line to first_line + count of a shard.
+
+        Args:
+            shard (int): Number of the file, so every file gets different lines.
+            index (int): Number of the segment in the file, seeds its random numbers.
+            first_line (int): Line number of the first line in the file, sets its timestamp.
+            count (int): Number of lines.
+            markers (dict): Marker text per line (relative to first_line) that gets it
+                written at the start of its message.
+
+        Returns:
+            tuple: (text as bytes, count of every level).
+        """
+        rng = random.Random(f"{self.seed}/{shard}/{index}")
+        levels = rng.choices(LEVELS, weights=self.level_weights, k=count)
+        lengths = rng.choices(self.token_counts, k=count)
+        offsets = rng.choices(range(len(self.starts) - self.max_tokens), k=count)
+        pool, starts = self.pool, self.starts
+
+        lines = []
+        append = lines.append
+        i = 0
+        while i < count:
+            # The lines up to end share a timestamp, and so the start of the line per level
+            second = int((first_line + i) / self.lines_per_second)
+            end = min(count, math.ceil((second + 1) * self.lines_per_second) - first_line)
+            stamp = time.strftime(TIME_FORMAT, time.gmtime(self.start + second))
+            prefixes = {level: f"{stamp} - {level} - " for level in LEVELS}
+            for j in range(i, max(end, i + 1)):
+                offset = offsets[j]
+                append(prefixes[levels[j]] + pool[starts[offset]:starts[offset + lengths[j]] - 1])
+            i = max(end, i + 1)
+        for i, marker in markers.items():
+            prefix = len(lines[i]) - len(lines[i].split(' - ', 2)[2])
+            lines[i] = f"{lines[i][:prefix]}{marker} {lines[i][prefix:]}"
+        lines.append('')
+        return '\n'.join(lines).encode(), Counter(levels)
+
+
+def place_markers(seed, shard, total_lines, markers):
+    """
+    Picks the lines that get a marker, each line at most one.
+
+    Returns:
+        dict: Marker text per line number.
+
+    Raises:
+        ValueError: If there are more markers than lines.
+    """
+    wanted = sum(markers.values())
+    if wanted > total_lines:
+        raise ValueError(f"{wanted} markers do not fit in {total_lines} lines")
+    chosen = iter(random.Random(f"{seed}/{shard}/markers").sample(range(total_lines), wanted))
+    return {next(chosen): text for text, count in markers.items() for _ in range(count)}
+
+
+_generator = None
+
+
+def _init_worker(options):
+    global _generator
+    _generator = Generator(**options)
+
+
+def _segment(task):
+    return _generator.segment(*task)
+
+
+def generate_shard(generator, path, size_bytes, shard=1, markers=None, executor=None, workers=1,
+                   segment_lines=SEGMENT_LINES):
+    """
+    Writes about size_bytes of lines to path, in segments generated by the executor's workers
+    (or in this process without one) and written in order as they complete.
+
+    Returns:
+        dict: The manifest entry of the file: bytes, lines, first and last timestamp, and the
+        exact count of every level and marker, the ground truth for queries on the file.
+    """
+    markers = markers or {}
+    total_lines = max(1, round(size_bytes / generator.mean_line))
+    placed = place_markers(generator.seed, shard, total_lines, markers)
+    tasks = []
+    for index, first_line in enumerate(range(0, total_lines, segment_lines)):
+        count = min(segment_lines, total_lines - first_line)
+        segment_markers = {line - first_line: text for line, text in placed.items() if first_line <= line < first_line + count}
+        tasks.append((shard, index, first_line, count, segment_markers))
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    levels = Counter()
+    written = 0
+    with open(path, 'wb') as f:
+        if executor is None:
+            results = (generator.segment(*task) for task in tasks)
+        else:
+            results = _ordered_results(executor, tasks, 2 * workers)
+        for data, counts in results:
+            f.write(data)
+            written += len(data)
+            levels.update(counts)
+    return {
+        "file": path, "bytes": written, "lines": total_lines,
+        "first_time": generator.timestamp(0), "last_time": generator.timestamp(total_lines - 1),
+        "levels": {level: levels[level] for level in LEVELS}, "markers": dict(markers),
+    }
+
+
+def _ordered_results(executor, tasks, window):
+    """
+    Yields the results of the tasks in order, with at most window tasks submitted ahead.
+    """
+    pending = deque()
+    tasks = iter(tasks)
+    for task in tasks:
+        pending.append(executor.submit(_segment, task))
+        if len(pending) >= window:
+            break
+    while pending:
+        yield pending.popleft().result()
+        for task in tasks:
+            pending.append(executor.submit(_segment, task))
+            break
+
+
+def generate(output_dir, shards=1, size_mb=60, name='vm{shard}.log', markers=None, workers=None, **options):
+    """
+    Writes shards files of about size_mb each under output_dir, and manifest.json describing
+    them next to them.
+
+    Args:
+        output_dir (str): Directory of the files.
+        shards (int): Number of files, e.g. one per server.
+        size_mb (float): Size of every file.
+        name (str): File name relative to output_dir, {shard} is replaced by the shard number.
+        markers (dict): Lines per file to mark with each marker text.
+        workers (int): Processes generating lines, by default one per CPU.
+        **options: Options of Generator.
+
+    Returns:
+        dict: The manifest.
+    """
+    workers = workers or os.cpu_count() or 1
+    generator = Generator(**options)
+    start = time.monotonic()
+    files = []
+    executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(options,)) if workers > 1 else None
+    try:
+        for shard in range(1, shards + 1):
+            path = os.path.join(output_dir, name.format(shard=shard))
+            files.append(generate_shard(generator, path, size_mb * 1024 * 1024, shard, markers, executor, workers))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    elapsed = time.monotonic() - start
+    manifest = {
+        "config": {"shards": shards, "size_mb": size_mb, "name": name, "markers": markers or {}, **options},
+        "seconds": round(elapsed, 3),
+        "files": files,
+    }
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def generate_log_file(file_name="random.log", size_mb=2, seed=42, markers=None):
+    """
+    Writes one log file of about size_mb in this process.
+
+    Returns:
+        dict: The manifest entry of the file, see generate_shard.
+    """
+    return generate_shard(Generator(seed), file_name, size_mb * 1024 * 1024, markers=markers)
+
+
+def marker_arg(value):
+    text, _, count = value.rpartition('=')
+    if not text or not count.isdigit():
+        raise argparse.ArgumentTypeError(f"Markers look like TEXT=COUNT: {value}")
+    return text, int(count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic log files with known contents.')
+    parser.add_argument('--output_dir', type=str, default='.', help='Directory of the files and manifest.json')
+    parser.add_argument('--shards', type=int, default=1, help='Number of files, e.g. one per server')
+    parser.add_argument('--size_mb', type=float, default=60, help='Size of every file')
+    parser.add_argument('--name', type=str, default='vm{shard}.log', help='File name, {shard} is the file number')
+    parser.add_argument('--workers', type=int, default=None, help='Generating processes (default: one per CPU)')
+    parser.add_argument('--seed', type=int, default=42, help='The same seed and options give the same files')
+    parser.add_argument('--start', type=str, default=DEFAULT_START, help='Timestamp of the first line')
+    parser.add_argument('--lines_per_second', type=float, default=100.0, help='Lines with the same timestamp')
+    parser.add_argument('--level_weights', type=float, nargs=len(LEVELS), default=LEVEL_WEIGHTS,
+                        metavar=tuple(LEVELS), help='Relative frequency of every level')
+    parser.add_argument('--vocabulary', type=int, default=5000, help='Distinct words in the messages')
+    parser.add_argument('--zipf', type=float, default=1.1, help='Exponent of the Zipf distribution of the words')
+    parser.add_argument('--marker', type=marker_arg, action='append', default=[],
+                        help='TEXT=COUNT: mark exactly COUNT lines of every file with TEXT (use capitals, the words are lowercase)')
+    args = parser.parse_args()
 
-random.seed(42)
-
-def generate_random_message(length=50):
-    return ''.join(random.choices(string.ascii_letters + string.digits + string.punctuation + ' ', k=length))
-
-def generate_log_file(file_name="random.log", size_mb=2):
-    size_bytes = size_mb * 1024 * 1024
-    log_entries = []
-    log_size = 0
-    fixed_timestamp = "2024-09-15 12:00:00"
-    
-    while log_size < size_bytes:
-        level = random.choice(['INFO', 'DEBUG', 'WARNING', 'ERROR'])
-        message = generate_random_message(random.randint(10, 100))
-        entry = f"{fixed_timestamp} - {level} - {message}\n"
-        log_entries.append(entry)
-        log_size += len(entry)
-    
-    with open(file_name, 'w') as f:
-        f.writelines(log_entries)
-
-log_file_name = "random_log_60MB.log"
-generate_log_file(log_file_name, 60)
+    manifest = generate(args.output_dir, args.shards, args.size_mb, args.name, dict(args.marker), args.workers,
+                        seed=args.seed, start=args.start, lines_per_second=args.lines_per_second,
+                        level_weights=list(args.level_weights), vocabulary=args.vocabulary, zipf=args.zipf)
+    total = sum(entry["bytes"] for entry in manifest["files"])
+    print(f"Wrote {len(manifest['files'])} files, {total / 1024 / 1024:.1f}MB in {manifest['seconds']:.1f}s "
+          f"({total / 1024 / 1024 / max(manifest['seconds'], 1e-9):.1f}MB/s), see {os.path.join(args.output_dir, 'manifest.json')}")
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+import json
+import time
+import heapq
+import bisect
+import logging
+import threading
+from collections import Counter, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets: durations from 100us doubling up to about 100s,
+# sizes and counts in powers of 4 up to 4^20 (a TB)
+SECONDS_BUCKETS = tuple(0.0001 * 2 ** i for i in range(21))
+SIZE_BUCKETS = tuple(4 ** i for i in range(21))
+
+# The slowest queries since the start and the latest queries are kept to show which
+# patterns are slow, the other measurements are aggregated
+SLOWEST_QUERIES = 10
+RECENT_QUERIES = 50
+MAX_QUERY_TEXT = 200
+
+# Status of a finished query
+OK = 'ok'
+INVALID = 'invalid'
+BUSY = 'busy'
+TIMEOUT = 'timeout'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class Histogram:
+    """
+    Counts values in fixed buckets, so quantiles can be estimated and histograms of several
+    servers added up. Not thread-safe, Metrics updates its histograms under its lock.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket holding the q-quantile, at most the largest value.
+        """
+        if self.count == 0:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count, "sum": self.sum, "max": self.max,
+            "p50": self.quantile(0.5), "p95": self.quantile(0.95), "p99": self.quantile(0.99),
+            # Non-cumulative counts of the buckets that are not empty, the last bound is null for the overflow
+            "buckets": [[self.bounds[i] if i < len(self.bounds) else None, count] for i, count in enumerate(self.counts) if count],
+        }
+
+
+class QueryMetrics:
+    """
+    What one query spent its time on, filled in while it runs and recorded by Metrics.record.
+
+    Attributes:
+        queue_wait (float): Seconds waited for a query slot.
+        files (dict): Seconds until the results of every file were found, without the time
+            spent sending them.
+        bytes_scanned (int): Size of the files searched (an index or a time range may skip
+            parts of them).
+        serialize_seconds (float): Encoding and compressing the frames.
+        send_seconds (float): Writing the frames to the socket, including waiting for a slow client.
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.queue_wait = 0.0
+        self.files = {}
+        self.bytes_scanned = 0
+        self.serialize_seconds = 0.0
+        self.send_seconds = 0.0
+
+    def iter_timed(self, results):
+        """
+        Yields the (log_file, ...) results of a search, adding the time each took to arrive to
+        the time of its file.
+        """
+        last = time.monotonic()
+        for result in results:
+            now = time.monotonic()
+            self.files[result[0]] = self.files.get(result[0], 0.0) + now - last
+            yield result
+            last = time.monotonic()
+
+
+class Metrics:
+    """
+    Aggregates the measurements of every query of the server: histograms of where the time
+    goes, counters per mode and status, the time spent per file, and the slowest and latest
+    queries. snapshot() is what the STATS frame and the HTTP endpoint return.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.active = 0
+        self.histograms = {
+            "query_seconds": Histogram(SECONDS_BUCKETS),
+            "queue_wait_seconds": Histogram(SECONDS_BUCKETS),
+            "file_seconds": Histogram(SECONDS_BUCKETS),
+            "serialize_seconds": Histogram(SECONDS_BUCKETS),
+            "send_seconds": Histogram(SECONDS_BUCKETS),
+            "bytes_scanned": Histogram(SIZE_BUCKETS),
+            "matches": Histogram(SIZE_BUCKETS),
+        }
+        self.queries = Counter()
+        self.statuses = Counter()
+        self.files = {}
+        self.slowest = []
+        self.recent = deque(maxlen=RECENT_QUERIES)
+
+    def begin(self):
+        with self.lock:
+            self.active += 1
+
+    def record(self, request, query_metrics, status, matches=0):
+        """
+        Adds a finished query, see begin.
+
+        Args:
+            request (dict): The query frame payload.
+            query_metrics (QueryMetrics): Its measurements.
+            status (str): OK, INVALID, BUSY, TIMEOUT, CANCELLED or FAILED.
+            matches (int): Matching lines found.
+        """
+        seconds = time.monotonic() - query_metrics.start
+        text = request.get("query") if request.get("queries") is None else ' | '.join(map(str, request["queries"]))
+        summary = {
+            "query": str(text)[:MAX_QUERY_TEXT], "mode": request.get("mode", "all"), "status": status,
+            "seconds": round(seconds, 6), "queue_wait": round(query_metrics.queue_wait, 6),
+            "files": len(query_metrics.files), "bytes_scanned": query_metrics.bytes_scanned, "matches": matches,
+            "time": time.time(),
+        }
+        with self.lock:
+            self.active -= 1
+            self.queries[summary["mode"]] += 1
+            self.statuses[status] += 1
+            self.histograms["query_seconds"].observe(seconds)
+            self.histograms["queue_wait_seconds"].observe(query_metrics.queue_wait)
+            self.histograms["serialize_seconds"].observe(query_metrics.serialize_seconds)
+            self.histograms["send_seconds"].observe(query_metrics.send_seconds)
+            self.histograms["bytes_scanned"].observe(query_metrics.bytes_scanned)
+            self.histograms["matches"].observe(matches)
+            for log_file, file_seconds in query_metrics.files.items():
+                self.histograms["file_seconds"].observe(file_seconds)
+                searches, total, slowest = self.files.get(log_file, (0, 0.0, 0.0))
+                self.files[log_file] = (searches + 1, total + file_seconds, max(slowest, file_seconds))
+            self.recent.append(summary)
+            # A min-heap of the slowest, the id breaks ties without comparing the dicts
+            entry = (seconds, id(summary), summary)
+            if len(self.slowest) < SLOWEST_QUERIES:
+                heapq.heappush(self.slowest, entry)
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def snapshot(self):
+        """
+        Returns every measurement as a JSON object.
+        """
+        with self.lock:
+            return {
+                "uptime": round(time.time() - self.started, 3),
+                "active_queries": self.active,
+                "queries": dict(self.queries),
+                "statuses": dict(self.statuses),
+                "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+                "files": {log_file: {"searches": searches, "seconds": round(total, 6), "max_seconds": round(slowest, 6)}
+                          for log_file, (searches, total, slowest) in self.files.items()},
+                "slowest": [summary for _, _, summary in sorted(self.slowest, reverse=True)],
+                "recent": list(self.recent),
+            }
+
+    def exposition(self):
+        """
+        Returns the counters and histograms in the Prometheus text format.
+        """
+        with self.lock:
+            lines = [f"grep_active_queries {self.active}"]
+            lines += [f'grep_queries_total{{mode="{mode}"}} {count}' for mode, count in sorted(self.queries.items())]
+            lines += [f'grep_query_status_total{{status="{status}"}} {count}' for status, count in sorted(self.statuses.items())]
+            for name, histogram in self.histograms.items():
+                lines.append(f"# TYPE grep_{name} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    cumulative += count
+                    lines.append(f'grep_{name}_bucket{{le="{bound:g}"}} {cumulative}')
+                lines.append(f'grep_{name}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"grep_{name}_sum {histogram.sum:g}")
+                lines.append(f"grep_{name}_count {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves /stats as JSON and /metrics in the Prometheus text format.
+    """
+
+    def do_GET(self):
+        if self.path == '/stats':
+            body, content_type = json.dumps(self.server.metrics.snapshot()).encode('utf-8'), 'application/json'
+        elif self.path == '/metrics':
+            body, content_type = self.server.metrics.exposition().encode('utf-8'), 'text/plain; version=0.0.4'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("HTTP %s", format % args)
+
+
+def serve_metrics(metrics, port):
+    """
+    Serves the metrics over HTTP on port from a background thread.
+
+    Returns:
+        ThreadingHTTPServer: The server, shutdown() stops it.
+    """
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most rate records with the same message template through per interval seconds.
+    The first record let through afterwards tells how many were dropped meanwhile.
+    """
+
+    def __init__(self, rate=10, interval=1.0):
+        super().__init__()
+        self.rate = rate
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.windows = {}
+
+    def filter(self, record):
+        now = time.monotonic()
+        key = (record.name, record.levelno, record.msg)
+        with self.lock:
+            start, count, dropped = self.windows.get(key, (now, 0, 0))
+            if now - start >= self.interval:
+                start, count = now, 0
+            if count >= self.rate:
+                self.windows[key] = (start, count, dropped + 1)
+                return False
+            self.windows[key] = (start, count + 1, 0)
+        if dropped:
+            record.msg = f"{record.msg} ({dropped} similar messages dropped)"
+        return True
+
+
+def setup_logging(level='INFO', rate=10, interval=1.0):
+    """
+    Logs to stderr at level and above, at most rate messages of a kind per interval seconds.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    if rate > 0:
+        handler.addFilter(RateLimitFilter(rate, interval))
+    logging.basicConfig(level=level, handlers=[handler])
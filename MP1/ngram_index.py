@@ -0,0 +1,386 @@
+import os
+import re
+import mmap
+import bisect
+import struct
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from search_engine import CHUNK_SIZE, split_file
+
+try:
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+# Files are indexed in line-aligned blocks of about this size. A query only scans the
+# blocks whose trigram set contains every trigram the pattern requires.
+BLOCK_SIZE = 128 * 1024
+
+# Trigrams are taken from the lowercased [a-z0-9] runs of the text, so every trigram has
+# an exact id below 36 ** 3 and a block's trigram set is a fixed-size bitmap.
+ALPHABET = b'abcdefghijklmnopqrstuvwxyz0123456789'
+SYMBOL = {c: i for i, c in enumerate(ALPHABET)}
+TRIGRAMS = len(ALPHABET) ** 3
+BITMAP_SIZE = (TRIGRAMS + 7) // 8
+TOKEN = re.compile(rb'[a-z0-9]{3,}')
+
+# Bytes hashed at the start of a file to recognize it after a rotation reused its inode
+HEAD_SIZE = 1024
+
+# The index of a file is kept in two files that only grow. <name>.ngram holds HEADER, which
+# tells the indexed file and how much of it is indexed, followed by a BLOCK entry per block,
+# and <name>.ngram.bitmaps the blocks' bitmaps, which are read through mmap. An update
+# appends the new blocks to both and rewrites the header last, so whatever lies past the
+# header's block count, e.g. after an update was cut short, is ignored and overwritten.
+INDEX_MAGIC = b'NGRM'
+INDEX_VERSION = 2
+# magic, version, st_dev, st_ino, head length, head digest, size, lines, blocks
+HEADER = struct.Struct('!4sIQQH20sQQQ')
+# start, end, first_line
+BLOCK = struct.Struct('!QQQ')
+
+
+def trigram_id(trigram):
+    return (SYMBOL[trigram[0]] * len(ALPHABET) + SYMBOL[trigram[1]]) * len(ALPHABET) + SYMBOL[trigram[2]]
+
+
+def literal_trigrams(literal):
+    """
+    Returns the ids of the trigrams that any text containing literal must contain.
+    """
+    ids = set()
+    for token in TOKEN.findall(literal.lower()):
+        for i in range(len(token) - 2):
+            ids.add(trigram_id(token[i:i + 3]))
+    return ids
+
+
+def block_bitmap(block):
+    """
+    Builds the trigram bitmap of a block of text.
+    """
+    trigrams = set()
+    for token in set(TOKEN.findall(block.lower())):
+        trigrams.update(token[i:i + 3] for i in range(len(token) - 2))
+    bitmap = bytearray(BITMAP_SIZE)
+    for trigram in trigrams:
+        tid = trigram_id(trigram)
+        bitmap[tid >> 3] |= 1 << (tid & 7)
+    return bytes(bitmap)
+
+
+def index_range(path, start, end, block_size=BLOCK_SIZE):
+    """
+    Worker entry point: indexes the complete lines of path[start:end] in blocks.
+
+    Returns:
+        list: (start, end, newlines, bitmap) for every block. A line that is still being
+        written at the end of the range is left out and indexed by a later update.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    data = data[:data.rfind(b'\n') + 1]
+
+    blocks = []
+    pos = 0
+    while pos < len(data):
+        cut = data.find(b'\n', pos + block_size - 1)
+        cut = len(data) if cut < 0 else cut + 1
+        block = data[pos:cut]
+        blocks.append((start + pos, start + cut, block.count(b'\n'), block_bitmap(block)))
+        pos = cut
+    return blocks
+
+
+def query_plan(source, flags, invert=False):
+    """
+    Derives from a compiled pattern which trigrams a matching line must contain.
+
+    Returns:
+        tuple: A plan of nested ('and', [...]), ('or', [...]) and ('tri', id) nodes, or None
+        when the pattern requires no trigram (or the query is inverted) and nothing can be skipped.
+    """
+    if invert:
+        return None
+    try:
+        parsed = sre_parse.parse(source, flags & ~re.MULTILINE)
+    except Exception:
+        return None
+    return _plan(parsed)
+
+
+def _plan(parsed):
+    terms = []
+    run = bytearray()
+
+    def flush():
+        if run:
+            terms.extend(('tri', tid) for tid in sorted(literal_trigrams(bytes(run))))
+            run.clear()
+
+    for op, av in parsed:
+        if op is sre_constants.LITERAL and av < 256:
+            run.append(av)
+            continue
+        flush()
+        if op is sre_constants.SUBPATTERN:
+            sub = _plan(av[-1])
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            sub = _plan(av[2])
+        elif op is sre_constants.BRANCH:
+            alternatives = [_plan(alternative) for alternative in av[1]]
+            sub = ('or', alternatives) if all(alternatives) else None
+        else:
+            sub = None
+        if sub is not None:
+            terms.append(sub)
+    flush()
+
+    if not terms:
+        return None
+    return terms[0] if len(terms) == 1 else ('and', terms)
+
+
+def plan_matches(plan, bitmaps, offset):
+    """
+    Evaluates a plan against the bitmap stored at offset in bitmaps.
+    """
+    kind, value = plan
+    if kind == 'tri':
+        return bitmaps[offset + (value >> 3)] & (1 << (value & 7)) != 0
+    if kind == 'and':
+        return all(plan_matches(term, bitmaps, offset) for term in value)
+    return any(plan_matches(term, bitmaps, offset) for term in value)
+
+
+class FileIndex:
+    """
+    The trigram index of one log file.
+
+    Attributes:
+        identity (tuple): (st_dev, st_ino) of the indexed file.
+        head (tuple): Length and digest of the first (up to HEAD_SIZE) bytes when the index was started.
+        size (int): Bytes indexed so far, always at the end of a line.
+        lines (int): Lines indexed so far.
+        blocks (list): (start, end, first_line) of every block.
+        bitmaps (mmap.mmap): The blocks' trigram bitmaps, BITMAP_SIZE bytes each, mapped from
+            the bitmaps file. Empty bytes while there are no blocks.
+    """
+
+    def __init__(self, identity, head, size=0, lines=0, blocks=None, bitmaps=b''):
+        self.identity = identity
+        self.head = head
+        self.size = size
+        self.lines = lines
+        self.blocks = blocks if blocks is not None else []
+        self.bitmaps = bitmaps
+
+    def header(self):
+        return HEADER.pack(INDEX_MAGIC, INDEX_VERSION, *self.identity, *self.head, self.size, self.lines, len(self.blocks))
+
+
+def file_head(path, length=HEAD_SIZE):
+    with open(path, 'rb') as f:
+        head = f.read(length)
+    return len(head), hashlib.sha1(head).digest()
+
+
+def map_bitmaps(path, blocks):
+    """
+    Maps the bitmaps of the first blocks stored in path.
+
+    Raises:
+        ValueError: If the file holds fewer bitmaps.
+    """
+    if not blocks:
+        return b''
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), blocks * BITMAP_SIZE, access=mmap.ACCESS_READ)
+
+
+class NgramIndex:
+    """
+    Keeps a persistent trigram index for every searched log file in index_dir.
+
+    The index of a file is extended when the file grows and rebuilt when the file was
+    rotated (new inode, shrunk, or different first bytes). Updates run in the background,
+    with the indexing itself done in the engine's worker pool; until a file's index has
+    caught up, the part that is not indexed yet is simply scanned.
+    """
+
+    def __init__(self, index_dir, pool, block_size=BLOCK_SIZE, chunk_size=CHUNK_SIZE):
+        self.index_dir = index_dir
+        self.pool = pool
+        self.block_size = block_size
+        self.chunk_size = chunk_size
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.updating = set()
+        self.updater = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(index_dir, exist_ok=True)
+
+    def plan(self, source, flags, invert=False):
+        return query_plan(source, flags, invert)
+
+    def index_path(self, path):
+        name = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.index_dir, f"{os.path.basename(path)}.{name}.ngram")
+
+    def load(self, path):
+        with self.lock:
+            if path in self.indexes:
+                return self.indexes[path]
+        try:
+            index = self.read(path)
+        except (OSError, ValueError, struct.error):
+            index = None
+        with self.lock:
+            return self.indexes.setdefault(path, index)
+
+    def read(self, path):
+        """
+        Reads the stored index of path, without its bitmaps, which are mapped.
+
+        Returns:
+            FileIndex: The index, or None if it was stored by another version.
+        """
+        target = self.index_path(path)
+        with open(target, 'rb') as f:
+            magic, version, dev, ino, head_length, head_digest, size, lines, count = HEADER.unpack(f.read(HEADER.size))
+            if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                return None
+            table = f.read(count * BLOCK.size)
+        blocks = list(BLOCK.iter_unpack(table))
+        if len(blocks) != count:
+            return None
+        return FileIndex((dev, ino), (head_length, head_digest), size, lines, blocks, map_bitmaps(target + '.bitmaps', count))
+
+    def create(self, path, identity, head):
+        """
+        Starts an empty index of path. The files of the old one are replaced, not truncated,
+        so readers of its mapped bitmaps are not affected.
+        """
+        index = FileIndex(identity, head)
+        target = self.index_path(path)
+        for name, data in ((target + '.bitmaps', b''), (target, index.header())):
+            with open(name + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(name + '.tmp', name)
+        return index
+
+    def append(self, path, index, new_blocks):
+        """
+        Stores the blocks returned by index_range after those of index, writing only them and
+        the header.
+
+        Returns:
+            FileIndex: The extended index, a new one so readers never see a half-updated index.
+        """
+        target = self.index_path(path)
+        extended = FileIndex(index.identity, index.head, index.size, index.lines, list(index.blocks))
+        with open(target + '.bitmaps', 'r+b') as bitmaps, open(target, 'r+b') as table:
+            bitmaps.seek(len(index.blocks) * BITMAP_SIZE)
+            table.seek(HEADER.size + len(index.blocks) * BLOCK.size)
+            for start, end, newlines, bitmap in new_blocks:
+                extended.blocks.append((start, end, extended.lines))
+                bitmaps.write(bitmap)
+                table.write(BLOCK.pack(start, end, extended.lines))
+                extended.size = end
+                extended.lines += newlines
+            bitmaps.flush()
+            table.seek(0)
+            table.write(extended.header())
+        extended.bitmaps = map_bitmaps(target + '.bitmaps', len(extended.blocks))
+        return extended
+
+    def current_index(self, path, stat):
+        """
+        Returns the index of path if it still describes the same file, else None.
+        """
+        index = self.load(path)
+        if index is None or index.identity != (stat.st_dev, stat.st_ino) or stat.st_size < index.size:
+            return None
+        if file_head(path, index.head[0]) != index.head:
+            return None
+        return index
+
+    def refresh(self, path):
+        """
+        Brings the index of path up to date, rebuilding it if the file was rotated.
+        """
+        try:
+            stat = os.stat(path)
+            index = self.current_index(path, stat)
+            if index is None:
+                index = self.create(path, (stat.st_dev, stat.st_ino), file_head(path))
+            if stat.st_size > index.size:
+                futures = [self.pool.submit(index_range, path, start, end, self.block_size)
+                           for start, end in split_file(path, stat.st_size, self.chunk_size, index.size)]
+                index = self.append(path, index, (block for future in futures for block in future.result()))
+            with self.lock:
+                self.indexes[path] = index
+        finally:
+            with self.lock:
+                self.updating.discard(path)
+
+    def schedule_refresh(self, path):
+        with self.lock:
+            if path in self.updating:
+                return
+            self.updating.add(path)
+        self.updater.submit(self.refresh, path)
+
+    def candidate_ranges(self, path, size, plan):
+        """
+        Returns the byte ranges of path that can contain a match for plan.
+
+        Returns:
+            list: (start, end, first_line) ranges, adjacent candidate blocks merged, followed
+            by the part of the file that is not indexed yet; or None if the file has no usable
+            index and must be scanned completely. Stale indexes are refreshed in the background.
+        """
+        try:
+            stat = os.stat(path)
+            index = self.current_index(path, stat)
+        except OSError:
+            return None
+        if index is None or size > index.size:
+            self.schedule_refresh(path)
+        if index is None:
+            return None
+
+        ranges = []
+        for i, (start, end, first_line) in enumerate(index.blocks):
+            if plan is not None and not plan_matches(plan, index.bitmaps, i * BITMAP_SIZE):
+                continue
+            last = ranges[-1] if ranges else None
+            if last is not None and last[1] == start and end - last[0] <= self.chunk_size:
+                ranges[-1] = (last[0], end, last[2])
+            else:
+                ranges.append((start, end, first_line))
+        if size > index.size:
+            ranges.append((index.size, size, index.lines))
+        return ranges
+
+    def lines_at(self, path, offset):
+        """
+        Returns the number of lines before offset if offset is a block boundary of the
+        current index of path, else None.
+        """
+        index = self.load(path)
+        if index is None:
+            return None
+        if offset == index.size:
+            return index.lines
+        i = bisect.bisect_left(index.blocks, (offset,))
+        if i < len(index.blocks) and index.blocks[i][0] == offset:
+            return index.blocks[i][2]
+        return None
+
+    def close(self):
+        self.updater.shutdown(wait=False, cancel_futures=True)
+
@@ -0,0 +1,207 @@
+import json
+import zlib
+import struct
+import asyncio
+
+# Every frame starts with a fixed header: payload length, frame type and flags.
+# The payload is a UTF-8 JSON object, so clients never have to look for markers in the data.
+HEADER = struct.Struct('!IBB')
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Frame types
+QUERY = 1    # client -> server: {"query": str, "mode": str, "limit": int, "seed": int, "id": int,
+             #                   "files": glob, "since": unix_time, "until": unix_time,
+             #                   "time_range": [start, end], "aggregate": spec, "queries": [str, ...]}
+MATCHES = 2  # server -> client: {"file": str, "lines": [[line_number, line], ...], "pattern": int}
+             #   line_number is null for subscriptions until the lines before the match are counted
+TRAILER = 3  # server -> client: {"files": {file: matches}, "errors": {file: message}, "total_matches": int, ...}
+ERROR = 4    # server -> client: {"message": str}, ends the response like a trailer
+PING = 5     # client -> server: {"id": int}, health check
+PONG = 6     # server -> client: {"id": int, "active_queries": int}
+HELLO = 7    # client -> server: {"accept_encoding": [str], "level": int}, server -> client: {"encoding": str or null}
+UNSUBSCRIBE = 8  # client -> server: {"id": int}, ends the subscription with that id, which is answered with a trailer,
+                 # or cancels the running query with that id, which is answered with an error
+STATS = 9    # client -> server: {"id": int}, server -> client: {"id": int, "stats": {...}}, see metrics.Metrics.snapshot
+
+# Frame flags
+COMPRESSED = 0x01  # The payload is the next piece of the connection's compressed stream
+
+# A connection stays open for any number of queries. A query that carries an "id" runs
+# concurrently with the other queries of the connection, and every frame of its response
+# carries the same "id" so the client can tell the interleaved responses apart.
+
+# Query modes: every matching line, only the counts, the first `limit` lines (the scan stops
+# there), a uniform sample of `limit` lines with exact counts, or the structured aggregation
+# of the "aggregate" spec over them, whose groups come in the trailer instead of the lines.
+# A 'subscribe' query needs an id: it sends the lines appended to the logs that match, as
+# they are written, until the client sends UNSUBSCRIBE with that id.
+QUERY_MODES = ('all', 'count', 'first', 'sample', 'aggregate', 'subscribe')
+
+# Most queries in one batch, sent as "queries" instead of "query". Their matches are told
+# apart by the "pattern" index in the MATCHES frames, their counts by the trailer's "patterns".
+MAX_BATCH = 64
+
+# Matching lines are sent in batches of at most this many lines
+BATCH_LINES = 1000
+
+# Compression of MATCHES payloads, negotiated once per connection with HELLO. All compressed
+# frames of a connection form one zlib stream, flushed at every frame, so the repetitive
+# timestamps, levels and paths of one batch also shrink the next ones.
+ENCODINGS = ('zlib',)
+DEFAULT_LEVEL = 6
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the peer sends something that is not a valid frame.
+    """
+
+
+class Compressor:
+    """
+    Compresses the payloads of the frames a connection sends, in the order they are sent.
+    """
+
+    def __init__(self, level=DEFAULT_LEVEL):
+        self.compressor = zlib.compressobj(level)
+
+    def compress(self, body):
+        # A sync flush ends every frame on a byte boundary without resetting the stream
+        return self.compressor.compress(body) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class Decompressor:
+    """
+    Decompresses the compressed frames a connection receives, in the order they arrive.
+    """
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj()
+
+    def decompress(self, body):
+        try:
+            data = self.decompressor.decompress(body, MAX_FRAME_SIZE)
+        except zlib.error as e:
+            raise ProtocolError(f"Invalid compressed frame: {e}")
+        if self.decompressor.unconsumed_tail:
+            raise ProtocolError(f"Compressed frame exceeds the limit of {MAX_FRAME_SIZE} bytes")
+        return data
+
+
+def encode_payload(payload):
+    return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+
+def pack_frame(frame_type, body, flags=0, compressor=None):
+    """
+    Builds a frame from an encoded payload, compressing it if a compressor is given.
+    """
+    if compressor is not None:
+        body = compressor.compress(body)
+        flags |= COMPRESSED
+    return HEADER.pack(len(body), frame_type, flags) + body
+
+
+def encode_frame(frame_type, payload, flags=0, compressor=None):
+    """
+    Encodes a frame.
+
+    Args:
+        frame_type (int): One of the frame type constants.
+        payload (dict): The JSON payload.
+        flags (int): Frame flags, 0 unless stated otherwise.
+        compressor (Compressor): The connection's compressor if the payload is to be compressed.
+
+    Returns:
+        bytes: Header and payload, ready to be sent.
+    """
+    return pack_frame(frame_type, encode_payload(payload), flags, compressor)
+
+
+def send_frame(sock, frame_type, payload, flags=0):
+    """
+    Encodes a frame and sends all of it over the socket.
+    """
+    sock.sendall(encode_frame(frame_type, payload, flags))
+
+
+def recv_exact(sock, size):
+    """
+    Receives exactly size bytes.
+
+    Returns:
+        bytes: The data, or None if the connection was closed before any byte arrived.
+
+    Raises:
+        ProtocolError: If the connection was closed in the middle of the data.
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            if received == 0:
+                return None
+            raise ProtocolError("Connection closed in the middle of a frame")
+        received += n
+    return bytes(buf)
+
+
+def decode_payload(body, flags=0, decompressor=None):
+    if flags & COMPRESSED:
+        if decompressor is None:
+            raise ProtocolError("Compressed frame on a connection without compression")
+        body = decompressor.decompress(body)
+    try:
+        return json.loads(body.decode('utf-8'))
+    except ValueError as e:
+        raise ProtocolError(f"Invalid frame payload: {e}")
+
+
+def recv_frame(sock, decompressor=None):
+    """
+    Receives one frame, decompressing it with the connection's decompressor if needed.
+
+    Returns:
+        tuple: (frame_type, flags, payload), or None if the connection was closed between frames.
+
+    Raises:
+        ProtocolError: If the frame is truncated, too large or not valid JSON.
+    """
+    header = recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    length, frame_type, flags = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the limit of {MAX_FRAME_SIZE}")
+    body = recv_exact(sock, length) if length else b''
+    if body is None:
+        raise ProtocolError("Connection closed in the middle of a frame")
+    return frame_type, flags, decode_payload(body, flags, decompressor)
+
+
+async def read_frame(reader, decompressor=None):
+    """
+    Receives one frame from an asyncio stream, like recv_frame.
+
+    Returns:
+        tuple: (frame_type, flags, payload), or None if the connection was closed between frames.
+
+    Raises:
+        ProtocolError: If the frame is truncated, too large or not valid JSON.
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ProtocolError("Connection closed in the middle of a frame")
+    length, frame_type, flags = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the limit of {MAX_FRAME_SIZE}")
+    try:
+        body = await reader.readexactly(length) if length else b''
+    except asyncio.IncompleteReadError:
+        raise ProtocolError("Connection closed in the middle of a frame")
+    return frame_type, flags, decode_payload(body, flags, decompressor)
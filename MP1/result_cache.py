@@ -0,0 +1,178 @@
+import threading
+from collections import OrderedDict
+from ngram_index import file_head
+
+# Modes whose per-file results are complete and deterministic, and therefore cacheable
+CACHED_MODES = ('lines', 'count')
+
+# Rough per-entry and per-line overhead of a cached result, in bytes
+ENTRY_OVERHEAD = 200
+LINE_OVERHEAD = 100
+
+
+class CacheEntry:
+    """
+    The result of one query on one file, up to the end of the last complete line.
+
+    Attributes:
+        identity (tuple): (st_dev, st_ino) of the file.
+        head (tuple): Length and digest of the file's first bytes, see ngram_index.file_head.
+        file_size (int): Size of the file when the entry was made.
+        mtime_ns (int): Modification time of the file when the entry was made.
+        size (int): End of the covered part, always at the end of a line.
+        lines (int): Number of lines in the covered part.
+        result (object): The scan_buffer result for the covered part, relative to line 0.
+        nbytes (int): Estimated memory used by the entry.
+    """
+
+    def __init__(self, identity, head, file_size, mtime_ns, size, lines, result):
+        self.identity = identity
+        self.head = head
+        self.file_size = file_size
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.lines = lines
+        self.result = result
+        if isinstance(result, list):
+            self.nbytes = ENTRY_OVERHEAD + sum(len(line) + LINE_OVERHEAD for _, line in result)
+        else:
+            self.nbytes = ENTRY_OVERHEAD
+
+
+def last_line_end(path, size, window=64 * 1024):
+    """
+    Returns the offset just after the last newline in the first size bytes of path, or 0.
+    """
+    with open(path, 'rb') as f:
+        end = size
+        while end > 0:
+            start = max(0, end - window)
+            f.seek(start)
+            data = f.read(end - start)
+            nl = data.rfind(b'\n')
+            if nl >= 0:
+                return start + nl + 1
+            end = start
+    return 0
+
+
+class ResultCache:
+    """
+    An LRU cache of per-file query results with a memory budget.
+
+    Entries are keyed by the normalized query (compiled regex, flags, inversion and mode)
+    and the file path, and remember the file's identity, size and mtime. A file that only
+    grew since the entry was made keeps its entry: only the new tail is scanned and merged.
+    """
+
+    modes = CACHED_MODES
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+
+    def get(self, key, path, stat):
+        """
+        Returns the entry for key and path if it is still valid for the file described by stat.
+        A stale entry is dropped.
+        """
+        with self.lock:
+            entry = self.entries.get((key, path))
+            if entry is not None:
+                self.entries.move_to_end((key, path))
+        if entry is None:
+            self.misses += 1
+            return None
+
+        valid = (entry.identity == (stat.st_dev, stat.st_ino) and
+                 (stat.st_size > entry.file_size or
+                  (stat.st_size == entry.file_size and stat.st_mtime_ns == entry.mtime_ns)))
+        if valid and stat.st_size != entry.file_size:
+            # Appended or rotated in place? Only the first bytes tell
+            try:
+                valid = file_head(path, entry.head[0]) == entry.head
+            except OSError:
+                valid = False
+        if not valid:
+            self.misses += 1
+            self.discard(key, path)
+            return None
+        if stat.st_size == entry.file_size:
+            self.hits += 1
+        else:
+            self.partial_hits += 1
+        return entry
+
+    def put(self, key, path, entry):
+        if entry.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop((key, path), None)
+            if old is not None:
+                self.bytes -= old.nbytes
+            self.entries[(key, path)] = entry
+            self.bytes += entry.nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.nbytes
+
+    def discard(self, key, path):
+        with self.lock:
+            old = self.entries.pop((key, path), None)
+            if old is not None:
+                self.bytes -= old.nbytes
+
+    def start_fill(self, key, path, stat, entry):
+        """
+        Starts collecting the results of a query on path, continuing from entry if it is not None.
+        """
+        head = entry.head if entry is not None else file_head(path)
+        return CacheFill(self, key, path, stat, head, entry, last_line_end(path, stat.st_size))
+
+
+class CacheFill:
+    """
+    Collects the chunk results of one file during a query and stores them in the cache
+    once every chunk up to the last complete line has been scanned.
+
+    Attributes:
+        entry (CacheEntry): The valid entry the query started from, or None.
+        end (int): End of the last complete line when the query started.
+        end_lines (int): Number of lines before end, once known.
+    """
+
+    def __init__(self, cache, key, path, stat, head, entry, end, end_lines=None):
+        self.cache = cache
+        self.key = key
+        self.path = path
+        self.stat = stat
+        self.head = head
+        self.entry = entry
+        self.end = end
+        self.end_lines = end_lines
+        self.results = []
+
+    def add(self, base, result, newlines, range_end):
+        self.results.append((base, result))
+        if range_end == self.end:
+            self.end_lines = base + newlines
+
+    def commit(self, mode):
+        if self.end_lines is None:
+            return
+        if mode == 'count':
+            result = sum(result for _, result in self.results)
+            if self.entry is not None:
+                result += self.entry.result
+        else:
+            result = list(self.entry.result) if self.entry is not None else []
+            for base, chunk in self.results:
+                result.extend((base + index, line) for index, line in chunk)
+        self.cache.put(self.key, self.path, CacheEntry(
+            (self.stat.st_dev, self.stat.st_ino), self.head, self.stat.st_size, self.stat.st_mtime_ns,
+            self.end, self.end_lines, result))
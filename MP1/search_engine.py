@@ -0,0 +1,934 @@
+import os
+import re
+import bz2
+import gzip
+import lzma
+import time
+import shlex
+import heapq
+import random
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from structured import Aggregation
+
+# Files larger than this are split into line-aligned chunks so that a single
+# big log can be scanned by several workers at once.
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# Archived logs are decompressed while they are scanned, never to disk. A compressed file
+# cannot be split, so it is scanned by a single worker, one block of this size at a time.
+DECOMPRESSORS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+# Timestamp at the start of a line, as written by generate_random_log.py and MP2
+# ("2024-09-15 12:00:00 - LEVEL - message"), which time ranges are matched against
+TIMESTAMP = re.compile(rb'^(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})', re.MULTILINE)
+
+# Result of scan_buffer for a chunk that did not need to be scanned, per mode
+EMPTY_RESULTS = {'lines': [], 'count': 0, 'sample': (0, []), 'aggregate': ({}, 0, 0), 'patterns': [], 'pattern_counts': []}
+
+# A backreference's group number changes when patterns are combined into one alternation
+BACKREFERENCE = re.compile(rb'\\[1-9]|\(\?P=')
+
+# POSIX bracket classes that Python's re module does not understand
+POSIX_CLASSES = {
+    'alpha': 'a-zA-Z',
+    'digit': '0-9',
+    'alnum': 'a-zA-Z0-9',
+    'upper': 'A-Z',
+    'lower': 'a-z',
+    'space': ' \\t\\n\\r\\f\\v',
+    'blank': ' \\t',
+    'xdigit': '0-9A-Fa-f',
+    'punct': re.escape('!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~'),
+}
+
+
+class QueryTimeout(Exception):
+    """
+    Raised when a query runs past its deadline.
+    """
+
+
+class QueryCancelled(QueryTimeout):
+    """
+    Raised when a query is cancelled before its deadline, e.g. because the client gave up on it.
+    A QueryTimeout, so the scans stop the same way.
+    """
+
+
+class Deadline:
+    """
+    The time.monotonic() deadline of a query that can also be cancelled. time_left takes it
+    in place of a deadline.
+
+    Attributes:
+        at (float): The deadline, or None if there is none.
+        cancelled (bool): Whether the query was cancelled.
+    """
+
+    def __init__(self, at=None):
+        self.at = at
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def time_left(deadline):
+    """
+    Returns the seconds left until a time.monotonic() deadline or a Deadline, or None if
+    there is no deadline.
+
+    Raises:
+        QueryCancelled: If the Deadline was cancelled.
+        QueryTimeout: If the deadline has already passed.
+    """
+    if isinstance(deadline, Deadline):
+        if deadline.cancelled:
+            raise QueryCancelled("Query cancelled")
+        deadline = deadline.at
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise QueryTimeout("Query timed out")
+    return remaining
+
+
+class GrepQuery:
+    """
+    A grep command line reduced to what the search engine needs.
+
+    Attributes:
+        pattern (str): The pattern as written by the user.
+        syntax (str): 'basic', 'extended' or 'fixed', following grep -G/-E/-F, or 'python'
+            for a pattern that is already in Python syntax.
+        ignore_case (bool): grep -i.
+        invert (bool): grep -v.
+        word (bool): grep -w.
+        line (bool): grep -x.
+    """
+
+    def __init__(self, pattern, syntax='basic', ignore_case=False, invert=False, word=False, line=False):
+        self.pattern = pattern
+        self.syntax = syntax
+        self.ignore_case = ignore_case
+        self.invert = invert
+        self.word = word
+        self.line = line
+
+    def regex_source(self):
+        """
+        Translates the pattern into a Python regular expression (as bytes).
+        """
+        if self.syntax == 'fixed':
+            source = re.escape(self.pattern)
+        elif self.syntax == 'extended':
+            source = _translate(self.pattern, basic=False)
+        elif self.syntax == 'python':
+            source = self.pattern
+        else:
+            source = _translate(self.pattern, basic=True)
+
+        if self.word:
+            source = r'(?<!\w)(?:' + source + r')(?!\w)'
+        if self.line:
+            source = r'^(?:' + source + r')$'
+        return source.encode('utf-8')
+
+    def regex_flags(self):
+        flags = re.MULTILINE
+        if self.ignore_case:
+            flags |= re.IGNORECASE
+        return flags
+
+    def compile(self):
+        return re.compile(self.regex_source(), self.regex_flags())
+
+
+def parse_query(query):
+    """
+    Parses a query string into a GrepQuery.
+
+    The query can either be a full grep command (e.g. `grep -n -i "error"`), which is
+    what the grep path executes, or a bare pattern, which is searched as a basic regex.
+
+    Args:
+        query (str): The query received from the client.
+
+    Returns:
+        GrepQuery: The parsed query.
+
+    Raises:
+        ValueError: If the command uses options the engine does not support.
+    """
+    parts = shlex.split(query)
+    if not parts or parts[0] not in ('grep', 'egrep', 'fgrep'):
+        return GrepQuery(query)
+
+    syntax = {'grep': 'basic', 'egrep': 'extended', 'fgrep': 'fixed'}[parts[0]]
+    options = {'ignore_case': False, 'invert': False, 'word': False, 'line': False}
+    long_options = {
+        '--ignore-case': 'i', '--invert-match': 'v', '--word-regexp': 'w', '--line-regexp': 'x',
+        '--line-number': 'n', '--extended-regexp': 'E', '--fixed-strings': 'F', '--basic-regexp': 'G',
+    }
+    patterns = []
+    positional = []
+    args = iter(parts[1:])
+    for arg in args:
+        if arg == '--':
+            positional.extend(args)
+            break
+        if arg.startswith('--'):
+            if arg.startswith('--regexp='):
+                patterns.append(arg.split('=', 1)[1])
+                continue
+            if arg not in long_options:
+                raise ValueError(f"Unsupported grep option: {arg}")
+            letters = long_options[arg]
+        elif arg.startswith('-') and len(arg) > 1:
+            letters = arg[1:]
+        else:
+            positional.append(arg)
+            continue
+
+        for i, letter in enumerate(letters):
+            if letter == 'e':
+                rest = letters[i + 1:]
+                patterns.append(rest if rest else next(args, ''))
+                break
+            elif letter == 'i':
+                options['ignore_case'] = True
+            elif letter == 'v':
+                options['invert'] = True
+            elif letter == 'w':
+                options['word'] = True
+            elif letter == 'x':
+                options['line'] = True
+            elif letter == 'E':
+                syntax = 'extended'
+            elif letter == 'F':
+                syntax = 'fixed'
+            elif letter == 'G':
+                syntax = 'basic'
+            elif letter in 'nsH':
+                # Line numbers are always reported; -s and -H do not change the results
+                continue
+            else:
+                raise ValueError(f"Unsupported grep option: -{letter}")
+
+    if not patterns:
+        if not positional:
+            raise ValueError("No search pattern given")
+        patterns.append(positional.pop(0))
+    if positional:
+        raise ValueError("File arguments are not allowed, the server searches its log directory")
+
+    if len(patterns) > 1:
+        # grep -e A -e B matches lines matching any of the patterns
+        if syntax == 'fixed':
+            pattern = '|'.join(re.escape(p) for p in patterns)
+        else:
+            pattern = '|'.join('(?:' + _translate(p, basic=(syntax == 'basic')) + ')' for p in patterns)
+        return GrepQuery(pattern, 'python', **options)
+    return GrepQuery(patterns[0], syntax, **options)
+
+
+def combine_queries(queries):
+    """
+    Parses a batch of queries and combines them into a single query matching every line that
+    any of them may match. The combined query selects the chunks to read, e.g. through the
+    n-gram index, and every chunk is then searched for each of the patterns.
+
+    Returns:
+        tuple: (combined, patterns) where combined is a GrepQuery and patterns the list of
+        (source, flags, invert) of every query.
+
+    Raises:
+        ValueError: If a query uses options the engine does not support.
+    """
+    patterns = []
+    for query in queries:
+        grep = parse_query(query)
+        patterns.append((grep.regex_source(), grep.regex_flags(), grep.invert))
+    if any(invert or BACKREFERENCE.search(source) for source, _, invert in patterns):
+        # Not expressible as one alternation: every chunk has to be read
+        return GrepQuery('(?!)', 'python', invert=True), patterns
+    alternatives = [('(?i:' if flags & re.IGNORECASE else '(?:') + source.decode('utf-8') + ')'
+                    for source, flags, _ in patterns]
+    return GrepQuery('|'.join(alternatives), 'python'), patterns
+
+
+def _translate(pattern, basic):
+    """
+    Translates a POSIX basic or extended regex into Python syntax.
+
+    In basic regexes `( ) { } | + ?` are literals unless escaped, the opposite of Python.
+    Bracket expressions are copied with their POSIX classes expanded and backslashes escaped.
+    """
+    out = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '\\' and i + 1 < n:
+            nxt = pattern[i + 1]
+            if basic and nxt in '(){}|+?':
+                out.append(nxt)
+            else:
+                out.append(c + nxt)
+            i += 2
+        elif c == '[':
+            i = _translate_bracket(pattern, i, out)
+        elif basic and c in '(){}|+?':
+            out.append('\\' + c)
+            i += 1
+        else:
+            out.append(c)
+            i += 1
+    return ''.join(out)
+
+
+def _translate_bracket(pattern, i, out):
+    n = len(pattern)
+    j = i + 1
+    body = ['[']
+    if j < n and pattern[j] == '^':
+        body.append('^')
+        j += 1
+    if j < n and pattern[j] == ']':
+        body.append('\\]')
+        j += 1
+    while j < n and pattern[j] != ']':
+        if pattern.startswith('[:', j):
+            end = pattern.find(':]', j + 2)
+            name = pattern[j + 2:end] if end != -1 else None
+            if name in POSIX_CLASSES:
+                body.append(POSIX_CLASSES[name])
+                j = end + 2
+                continue
+        c = pattern[j]
+        body.append('\\' + c if c in '\\[' else c)
+        j += 1
+    if j >= n:
+        # Unterminated bracket, let re report the error on the original text
+        out.append(pattern[i:])
+        return n
+    body.append(']')
+    out.append(''.join(body))
+    return j + 1
+
+
+def split_file(path, size, chunk_size=CHUNK_SIZE, start=0):
+    """
+    Splits path[start:size] into (start, end) byte ranges that begin at line boundaries.
+    start must be at a line boundary.
+    """
+    if size - start <= chunk_size:
+        return [(start, size)]
+    bounds = [start]
+    with open(path, 'rb') as f:
+        for target in range(start + chunk_size, size, chunk_size):
+            if target <= bounds[-1]:
+                continue
+            f.seek(target - 1)
+            f.readline()
+            position = f.tell()
+            if position >= size:
+                break
+            bounds.append(position)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def iter_matching_lines(buf, start, end, regex, invert=False):
+    """
+    Finds the lines of buf[start:end] that match regex. start must be at a line boundary.
+
+    Yields:
+        tuple: (index, line_start, line_end) for every matching line, where index is the
+        number of the line relative to start (0 for the first line of the range).
+    """
+    if invert:
+        index = 0
+        pos = start
+        while pos < end:
+            line_end = buf.find(b'\n', pos, end)
+            if line_end < 0:
+                line_end = end
+            if regex.search(buf, pos, line_end) is None:
+                yield index, pos, line_end
+            index += 1
+            pos = line_end + 1
+        return
+
+    index = 0
+    counted = start
+    pos = start
+    while pos < end:
+        m = regex.search(buf, pos, end)
+        if m is None:
+            return
+        nl = buf.rfind(b'\n', pos, m.start())
+        line_start = pos if nl < 0 else nl + 1
+        line_end = buf.find(b'\n', m.start(), end)
+        if line_end < 0:
+            line_end = end
+        # A match may run over a newline (e.g. `\s`), grep only ever looks inside one line
+        if m.end() > line_end and regex.search(buf, line_start, line_end) is None:
+            pos = line_end + 1
+            continue
+        index += buf.count(b'\n', counted, line_start)
+        counted = line_start
+        yield index, line_start, line_end
+        pos = line_end + 1
+
+
+def scan_buffer(buf, start, end, regex, invert=False, mode='lines', limit=None, seed=None, spec=None):
+    """
+    Scans buf[start:end] and returns what the query mode needs from it.
+
+    Args:
+        mode (str): 'lines' for the matching lines (at most limit of them), 'count' for
+            their number only, 'sample' for a uniform sample of limit of them, 'aggregate'
+            for the structured.Aggregation of spec over them, or 'patterns' and 'pattern_counts'
+            for the lines and counts of every (source, flags, invert) pattern of spec, see
+            combine_queries.
+        seed: Seed for the sample keys.
+
+    Returns:
+        tuple: (result, newlines), newlines being the number of newlines in the range, so
+        that callers can turn relative line indexes into line numbers. result is a list of
+        (index, line) in 'lines' mode, an int in 'count' mode and, in 'sample' mode, a pair of
+        the match count and a list of (key, index, line) with the limit smallest random keys.
+        In 'aggregate' mode it is the partial result of Aggregation.result, in 'patterns' mode
+        a list of (index, line, hits) with the indexes of the patterns the line matches, and in
+        'pattern_counts' mode the list of the patterns' match counts.
+    """
+    newlines = buf.count(b'\n', start, end)
+    lines = iter_matching_lines(buf, start, end, regex, invert)
+    if mode == 'count':
+        return sum(1 for _ in lines), newlines
+    if mode == 'aggregate':
+        aggregation = Aggregation(spec)
+        for _, line_start, line_end in lines:
+            aggregation.add(buf[line_start:line_end])
+        return aggregation.result(), newlines
+    if mode in ('patterns', 'pattern_counts'):
+        # Each pattern runs its own search over the chunk, which was read only once. Python's re
+        # loses its literal prefix scan on an alternation, so that is faster than the combined regex.
+        counts = []
+        found = {}
+        for i, (source, flags, pattern_invert) in enumerate(spec):
+            count = 0
+            for index, line_start, line_end in iter_matching_lines(buf, start, end, re.compile(source, flags), pattern_invert):
+                count += 1
+                if mode == 'patterns':
+                    found.setdefault(line_start, (index, line_end, []))[2].append(i)
+            counts.append(count)
+        if mode == 'pattern_counts':
+            return counts, newlines
+        return [(index, buf[line_start:line_end], tuple(hits))
+                for line_start, (index, line_end, hits) in sorted(found.items())], newlines
+    if mode == 'sample':
+        # Bottom-k sampling: every match gets a random key and the smallest keys are kept,
+        # so samples of different chunks can be merged by keeping the smallest keys again.
+        rng = random.Random(seed)
+        count = 0
+        keyed = []
+        for index, line_start, line_end in lines:
+            count += 1
+            keyed.append((rng.random(), index, line_start, line_end))
+            if len(keyed) >= 2 * limit:
+                keyed = heapq.nsmallest(limit, keyed)
+        sample = [(key, index, buf[line_start:line_end])
+                  for key, index, line_start, line_end in heapq.nsmallest(limit, keyed)]
+        return (count, sample), newlines
+    return [(index, buf[line_start:line_end])
+            for index, line_start, line_end in itertools.islice(lines, limit)], newlines
+
+
+def scan_range(path, start, end, source, flags, invert, mode='lines', limit=None, seed=None, spec=None):
+    """
+    Worker entry point: reads one byte range of a file in a single read and scans it.
+    """
+    regex = re.compile(source, flags)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        buf = f.read(end - start)
+    return scan_buffer(buf, 0, len(buf), regex, invert, mode, limit, seed, spec)
+
+
+def is_compressed(path):
+    return os.path.splitext(path)[1] in DECOMPRESSORS
+
+
+def find_time(buf, timestamp, after=False, start=0, end=None):
+    """
+    Returns the offset of the first line of buf[start:end] with a timestamp at or after
+    timestamp (strictly after if after is set), or None. start must be at a line boundary.
+    Lines without a timestamp belong to the timestamped line before them and are skipped.
+    """
+    for m in TIMESTAMP.finditer(buf, start, len(buf) if end is None else end):
+        line_time = m.group(1) + b' ' + m.group(2)
+        if line_time > timestamp or (line_time == timestamp and not after):
+            return m.start()
+    return None
+
+
+def read_line_blocks(f, block_size=CHUNK_SIZE):
+    """
+    Reads an open binary file in blocks that end at a line boundary, except for the last
+    block if the file does not end with a newline.
+    """
+    carry = b''
+    while True:
+        data = f.read(block_size)
+        if not data:
+            if carry:
+                yield carry
+            return
+        buf = carry + data
+        cut = buf.rfind(b'\n') + 1
+        if cut:
+            yield buf[:cut]
+        carry = buf[cut:]
+
+
+def iter_blocks(path, time_range=None, block_size=CHUNK_SIZE):
+    """
+    Reads a plain or compressed log file from the start, block by block.
+
+    Args:
+        time_range (tuple): Optional (start, end) timestamps, either may be None. Only the lines
+            from the first one at or after start up to the last one at or before end are read,
+            the file is assumed to be in time order.
+
+    Yields:
+        tuple: (first_line, block) where block holds complete lines and first_line is the
+        number of lines of the file before it.
+    """
+    start_time, end_time = time_range or (None, None)
+    line = 0
+    with DECOMPRESSORS.get(os.path.splitext(path)[1], open)(path, 'rb') as f:
+        blocks = read_line_blocks(f, block_size)
+        if start_time is not None:
+            for block in blocks:
+                pos = find_time(block, start_time)
+                if pos is not None:
+                    line += block.count(b'\n', 0, pos)
+                    blocks = itertools.chain([block[pos:]], blocks)
+                    break
+                line += block.count(b'\n')
+        for block in blocks:
+            stop = None if end_time is None else find_time(block, end_time, after=True)
+            if stop is not None:
+                block = block[:stop]
+            if block:
+                yield line, block
+            if stop is not None:
+                return
+            line += block.count(b'\n')
+
+
+def scan_stream(path, source, flags, invert, mode='lines', limit=None, seed=None, block_size=CHUNK_SIZE,
+                time_range=None, spec=None):
+    """
+    Worker entry point: reads a whole file block by block with iter_blocks and scans it. Used for
+    compressed files, which cannot be split, and for time ranges on files without a time index.
+
+    Returns:
+        tuple: (result, newlines) for the whole file, like scan_buffer.
+    """
+    regex = re.compile(source, flags)
+    lines, count, sample, counts = [], 0, [], []
+    aggregation = Aggregation(spec) if mode == 'aggregate' else None
+    newlines = 0
+    for first_line, block in iter_blocks(path, time_range, block_size):
+        block_limit = limit - len(lines) if mode == 'lines' and limit is not None else limit
+        block_seed = None if seed is None else f"{seed}:{first_line}"
+        result, block_newlines = scan_buffer(block, 0, len(block), regex, invert, mode, block_limit, block_seed, spec)
+        if mode == 'count':
+            count += result
+        elif mode == 'aggregate':
+            aggregation.merge(result)
+        elif mode == 'pattern_counts':
+            counts = [a + b for a, b in zip(counts or [0] * len(result), result)]
+        elif mode == 'patterns':
+            lines.extend((first_line + index, line, hits) for index, line, hits in result)
+        elif mode == 'sample':
+            count += result[0]
+            sample.extend((key, first_line + index, line) for key, index, line in result[1])
+            sample = heapq.nsmallest(limit, sample)
+        else:
+            lines.extend((first_line + index, line) for index, line in result)
+        newlines = first_line + block_newlines
+        if mode == 'lines' and limit is not None and len(lines) >= limit:
+            break
+    if mode == 'count':
+        return count, newlines
+    if mode == 'sample':
+        return (count, sample), newlines
+    if mode == 'aggregate':
+        return aggregation.result(), newlines
+    if mode == 'pattern_counts':
+        return counts, newlines
+    return lines, newlines
+
+
+def sample_matches(batches, size, seed=None):
+    """
+    Draws a uniform sample of size matching lines from (log_file, matches, error) batches,
+    in one pass and without keeping more than the sample in memory.
+
+    Returns:
+        tuple: The sample as a list of (log_file, line_number, line) in file order, the number
+        of matches per file and the error message per file.
+    """
+    rng = random.Random(seed)
+    order = {}
+    counts = {}
+    errors = {}
+    heap = []
+    for log_file, matches, error in batches:
+        order.setdefault(log_file, len(order))
+        counts[log_file] = counts.get(log_file, 0) + len(matches)
+        if error is not None:
+            errors[log_file] = str(error)
+        for line_number, line in matches:
+            # Keep the size smallest random keys, the heap holds their negations
+            item = (-rng.random(), order[log_file], line_number, line)
+            if len(heap) < size:
+                heapq.heappush(heap, item)
+            elif item[0] > heap[0][0]:
+                heapq.heapreplace(heap, item)
+    names = {index: log_file for log_file, index in order.items()}
+    sample = sorted((index, line_number, line) for _, index, line_number, line in heap)
+    return [(names[index], line_number, line) for index, line_number, line in sample], counts, errors
+
+
+class SearchEngine:
+    """
+    Searches log files in-process with a pool of worker processes.
+
+    The query is parsed and compiled once, every file is split into line-aligned
+    chunks of at most chunk_size bytes, and the chunks are read whole and scanned
+    in parallel, so no grep process is started and no grep output is parsed back.
+    """
+
+    def __init__(self, workers=None, chunk_size=CHUNK_SIZE):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        # Chunks in flight per query; results are consumed in order, so this bounds the
+        # memory held by finished chunks that wait for an earlier, slower one.
+        self.max_pending = self.workers * 2
+        # Workers are spawned rather than forked: a fork from a connection thread would
+        # inherit the client sockets and keep them open after the server closes them.
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        # Optional ngram_index.NgramIndex used to skip the parts of files that cannot match
+        self.index = None
+        # Optional result_cache.ResultCache with earlier per-file results
+        self.cache = None
+        # Optional time_index.TimeIndex that finds where a time range lies in a file
+        self.time_index = None
+
+    def _chunks(self, log_files, plan=None, cache_key=None, time_range=None):
+        """
+        Plans the chunks of every file, using the result cache, the index and the time index
+        when they are set.
+
+        Yields:
+            tuple: (log_file, byte_range, error, cached, fill) where byte_range is (start, end,
+            first_line or None), with end None for a file that is read whole by scan_stream,
+            cached is a (result, newlines) pair that needs no scan, and fill is the CacheFill
+            collecting the file's results for the cache.
+        """
+        for log_file in log_files:
+            if is_compressed(log_file) or (time_range is not None and self.time_index is None):
+                # Read whole by one worker, the indexes and the cache only know plain files
+                yield log_file, (0, None, 0), None, None, None
+                continue
+            try:
+                stat = os.stat(log_file)
+                size = stat.st_size
+                entry = None
+                if cache_key is not None:
+                    entry = self.cache.get(cache_key, log_file, stat)
+                start, first_line = (entry.size, entry.lines) if entry is not None else (0, 0)
+                if time_range is not None:
+                    # Only the lines of the time range are scanned, wherever they are in the file
+                    start, size, first_line = self.time_index.window(log_file, stat, time_range)
+
+                ranges = None
+                if self.index is not None:
+                    ranges = self.index.candidate_ranges(log_file, stat.st_size, plan)
+                if ranges is None:
+                    ranges = [(s, e, first_line if s == start else None)
+                              for s, e in split_file(log_file, size, self.chunk_size, start)]
+                else:
+                    ranges = [(max(s, start), min(e, size), fl if s >= start else first_line)
+                              for s, e, fl in ranges if e > start and s < size]
+
+                fill = None
+                if cache_key is not None:
+                    fill = self.cache.start_fill(cache_key, log_file, stat, entry)
+                    end = fill.end
+                    if end == start:
+                        fill.end_lines = first_line
+                    elif self.index is not None:
+                        fill.end_lines = self.index.lines_at(log_file, end)
+                    # Cut at the last complete line, the partial line after it is never cached
+                    cut = []
+                    for s, e, fl in ranges:
+                        if s < end < e:
+                            cut.extend([(s, end, fl), (end, e, None)])
+                        else:
+                            cut.append((s, e, fl))
+                    ranges = cut
+            except OSError as e:
+                yield log_file, None, e, None, None
+                continue
+
+            if entry is not None:
+                yield log_file, (0, entry.size, 0), None, (entry.result, entry.lines), fill
+            elif not ranges:
+                # The index rules the whole file out, it is still reported with no matches
+                yield log_file, None, None, None, fill
+            for byte_range in ranges:
+                yield log_file, byte_range, None, None, fill
+
+    def _iter_chunks(self, query, log_files, deadline, mode='lines', limit=None, seed=None, time_range=None, spec=None):
+        """
+        Scans the files chunk by chunk in the worker pool and yields the chunk results in order.
+
+        In 'lines' mode with a limit, chunks are only submitted while fewer than limit lines
+        have been found, and each chunk stops after the number still missing.
+
+        Yields:
+            tuple: (log_file, base, result, error) where base is the number of lines of the
+            file before the chunk and result is the chunk result of scan_buffer, or None if
+            the chunk failed. A file is skipped after its first error.
+
+        Raises:
+            QueryTimeout: If the deadline passes. Chunks that have not started are cancelled,
+            so a slow query gives the pool back to other queries within one chunk per worker.
+        """
+        grep = query if isinstance(query, GrepQuery) else parse_query(query)
+        source, flags = grep.regex_source(), grep.regex_flags()
+        re.compile(source, flags)  # Report bad patterns before anything is submitted
+
+        plan = self.index.plan(source, flags, grep.invert) if self.index is not None else None
+        cache_key = None
+        if self.cache is not None and mode in self.cache.modes and limit is None and time_range is None:
+            cache_key = (source, flags, grep.invert, mode)
+        chunks = self._chunks(log_files, plan, cache_key, time_range)
+        pending = deque()
+        found = 0
+
+        def submit_more():
+            while len(pending) < self.max_pending:
+                if limit is not None and mode == 'lines' and found >= limit:
+                    return
+                chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                log_file, byte_range, error, cached, fill = chunk
+                future = None
+                if byte_range is not None and cached is None:
+                    chunk_limit = limit - found if mode == 'lines' and limit is not None else limit
+                    chunk_seed = None if seed is None else f"{seed}:{log_file}:{byte_range[0]}"
+                    if byte_range[1] is None:
+                        future = self.pool.submit(scan_stream, log_file, source, flags, grep.invert, mode,
+                                                  chunk_limit, chunk_seed, self.chunk_size, time_range, spec)
+                    else:
+                        future = self.pool.submit(scan_range, log_file, byte_range[0], byte_range[1], source, flags,
+                                                  grep.invert, mode, chunk_limit, chunk_seed, spec)
+                pending.append((log_file, byte_range, error, cached, fill, future))
+
+        current_file, base, failed, current_fill = None, 0, False, None
+        try:
+            submit_more()
+            while pending:
+                log_file, byte_range, error, cached, fill, future = pending.popleft()
+                if log_file != current_file:
+                    if current_fill is not None and not failed:
+                        current_fill.commit(mode)
+                    current_file, base, failed, current_fill = log_file, 0, False, fill
+                result = EMPTY_RESULTS[mode] if error is None else None
+                chunk_base = base
+                if byte_range is not None and byte_range[2] is not None:
+                    # Ranges picked by the index know their first line, the others follow the previous chunk
+                    chunk_base = byte_range[2]
+                if cached is not None:
+                    result, newlines = cached
+                    base = chunk_base + newlines
+                elif future is not None:
+                    try:
+                        result, newlines = future.result(timeout=time_left(deadline))
+                        base = chunk_base + newlines
+                        if mode == 'lines':
+                            found += len(result)
+                        if fill is not None and byte_range[1] <= fill.end:
+                            fill.add(chunk_base, result, newlines, byte_range[1])
+                    except FutureTimeoutError:
+                        raise QueryTimeout("Query timed out")
+                    except QueryTimeout:
+                        raise
+                    except Exception as e:
+                        error = e
+                submit_more()
+                if failed:
+                    continue
+                failed = error is not None
+                yield log_file, chunk_base, (None if failed else result), error
+            if current_fill is not None and not failed:
+                current_fill.commit(mode)
+        finally:
+            # Also reached when the consumer stops early or the deadline passes
+            for *_, future in pending:
+                if future is not None:
+                    future.cancel()
+
+    def iter_search(self, query, log_files, deadline=None, limit=None, time_range=None):
+        """
+        Searches the given files and yields the results chunk by chunk, in file order.
+
+        Args:
+            query (str): A grep command or a bare pattern, see parse_query.
+            log_files (list): Paths of the files to search.
+            deadline (float): Optional time.monotonic() deadline for the whole query.
+            limit (int): Stop after this many matching lines.
+            time_range (tuple): Optional (start, end) timestamps as bytes, either may be None.
+                Only the lines in this range are searched, see iter_blocks.
+
+        Yields:
+            tuple: (log_file, matches, error). Every file is yielded at least once, large files
+            once per chunk. matches is a list of (line_number, line) and error is None unless
+            the file could not be searched.
+
+        Raises:
+            QueryTimeout: If the deadline passes.
+        """
+        remaining = limit
+        for log_file, base, result, error in self._iter_chunks(query, log_files, deadline, 'lines', limit,
+                                                                time_range=time_range):
+            matches = [(base + index + 1, line.decode('utf-8', errors='replace'))
+                       for index, line in (result or [])[:remaining]]
+            yield log_file, matches, error
+            if remaining is not None:
+                remaining -= len(matches)
+                if remaining <= 0:
+                    return
+
+    def iter_counts(self, query, log_files, deadline=None, time_range=None):
+        """
+        Counts the matching lines without transferring them out of the workers.
+
+        Yields:
+            tuple: (log_file, count, error), like iter_search but with the number of matches.
+        """
+        for log_file, _, result, error in self._iter_chunks(query, log_files, deadline, 'count', time_range=time_range):
+            yield log_file, result or 0, error
+
+    def sample(self, query, log_files, size, deadline=None, seed=None, time_range=None):
+        """
+        Draws a uniform sample of size matching lines. Every file is scanned completely,
+        but each worker only returns its own sample of at most size lines.
+
+        Returns:
+            tuple: The sample as a list of (log_file, line_number, line) in file order, the
+            number of matches per file and the error message per file.
+        """
+        order = {}
+        counts = {}
+        errors = {}
+        keyed = []
+        for log_file, base, result, error in self._iter_chunks(query, log_files, deadline, 'sample', size, seed,
+                                                                time_range):
+            order.setdefault(log_file, len(order))
+            counts.setdefault(log_file, 0)
+            if error is not None:
+                errors[log_file] = str(error)
+                continue
+            count, chunk_sample = result
+            counts[log_file] += count
+            keyed.extend((key, order[log_file], base + index + 1, line) for key, index, line in chunk_sample)
+            keyed = heapq.nsmallest(size, keyed)
+        names = {index: log_file for log_file, index in order.items()}
+        sample = sorted((index, line_number, line) for _, index, line_number, line in keyed)
+        return ([(names[index], line_number, line.decode('utf-8', errors='replace'))
+                 for index, line_number, line in sample], counts, errors)
+
+    def aggregate(self, query, log_files, spec, deadline=None, time_range=None):
+        """
+        Computes a structured aggregation over the lines matching query, each worker
+        aggregating its own chunks so only the partial aggregates leave the pool.
+
+        Args:
+            spec (dict): The aggregation to compute, see structured.Aggregation.
+
+        Returns:
+            tuple: The merged Aggregation, the number of aggregated lines per file and the
+            error message per file.
+        """
+        aggregation = Aggregation(spec)  # Report a bad spec before anything is submitted
+        counts = {}
+        errors = {}
+        for log_file, _, result, error in self._iter_chunks(query, log_files, deadline, 'aggregate',
+                                                             time_range=time_range, spec=spec):
+            counts.setdefault(log_file, 0)
+            if error is not None:
+                errors[log_file] = str(error)
+                continue
+            counts[log_file] += result[1]
+            aggregation.merge(result)
+        return aggregation, counts, errors
+
+    def iter_search_patterns(self, queries, log_files, deadline=None, time_range=None):
+        """
+        Searches the given files for a batch of queries in a single pass: every chunk is read
+        once and searched for each query in the worker that read it.
+
+        Yields:
+            tuple: (log_file, matches, error) like iter_search, with matches a list of
+            (line_number, line, hits) where hits are the indexes of the queries the line matches.
+        """
+        combined, patterns = combine_queries(queries)
+        for log_file, base, result, error in self._iter_chunks(combined, log_files, deadline, 'patterns',
+                                                                time_range=time_range, spec=patterns):
+            yield log_file, [(base + index + 1, line.decode('utf-8', errors='replace'), hits)
+                             for index, line, hits in (result or [])], error
+
+    def iter_pattern_counts(self, queries, log_files, deadline=None, time_range=None):
+        """
+        Counts the matching lines of every query of a batch in a single pass.
+
+        Yields:
+            tuple: (log_file, counts, error) with the list of the queries' counts.
+        """
+        combined, patterns = combine_queries(queries)
+        for log_file, _, result, error in self._iter_chunks(combined, log_files, deadline, 'pattern_counts',
+                                                             time_range=time_range, spec=patterns):
+            yield log_file, result or [0] * len(patterns), error
+
+    def search(self, query, log_files, deadline=None):
+        """
+        Searches the given files and collects the results.
+
+        Returns:
+            list: One (log_file, matches, error) tuple per file, in order, see iter_search.
+        """
+        results = []
+        for log_file, matches, error in self.iter_search(query, log_files, deadline):
+            if results and results[-1][0] == log_file:
+                results[-1][1].extend(matches)
+                if error is not None:
+                    results[-1] = (log_file, results[-1][1], error)
+            else:
+                results.append((log_file, list(matches), error))
+        return results
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
@@ -1,87 +1,793 @@
 import socket
 import subprocess
+import threading
+import time
 import re
 import os
 import argparse
 import shlex 
+import itertools
+import fnmatch
+import logging
+from search_engine import SearchEngine, QueryTimeout, QueryCancelled, Deadline, time_left, sample_matches, iter_blocks, is_compressed, parse_query
+from ngram_index import NgramIndex
+from result_cache import ResultCache
+from time_index import TimeIndex, parse_time_range
+from structured import Aggregation
+from tail import LogTailer, Subscription
+from metrics import Metrics, QueryMetrics, serve_metrics, setup_logging, OK, INVALID, BUSY, TIMEOUT, CANCELLED, FAILED
+from protocol import (QUERY, MATCHES, TRAILER, ERROR, PING, PONG, HELLO, UNSUBSCRIBE, STATS, HEADER, BATCH_LINES, QUERY_MODES, MAX_BATCH, DEFAULT_LEVEL,
+                      ProtocolError, Compressor, encode_payload, pack_frame, recv_frame)
 
 # python MP1/server.py /path/to/log/directory
 
-def execute_grep_on_logs(query, log_directory):
+# Log files, rotated ones (vm1.log.1) and compressed archives of both (vm1.log.2.gz)
+LOG_FILE = re.compile(r'\.log(\.\d+)?(\.gz|\.bz2|\.xz)?$')
+
+# grep variants that decompress the file themselves
+COMPRESSED_GREPS = {'.gz': 'zgrep', '.bz2': 'bzgrep', '.xz': 'xzgrep'}
+
+log = logging.getLogger(__name__)
+
+def list_log_files(log_directory, pattern=None, since=None, until=None):
     """
-    Executes a grep search on all .log files in the current directory and returns the results.
+    Returns the paths of the log files in the specified directory.
     
     Args:
-        query (str): The search pattern to use with grep.
+        pattern (str): Glob pattern for the file names, which selects among all log files,
+            rotated and compressed ones included. Only the .log files by default.
+        since (float): Keep only the files that were written to at or after this Unix time.
+        until (float): Keep only the files that can hold lines written at or before this
+            Unix time, i.e. the rotated file before them was last written before it.
+    """
+    names = [f for f in os.listdir(log_directory)
+             if (f.endswith('.log') if pattern is None else LOG_FILE.search(f) and fnmatch.fnmatch(f, pattern))]
+    log_files = [os.path.join(log_directory, f) for f in names]
+    if since is None and until is None:
+        return log_files
+
+    # The files of one rotation chain (vm1.log, vm1.log.1, vm1.log.2.gz, ...) follow each
+    # other in time, each one starts about when the one before it was last written
+    mtimes = {}
+    for log_file in log_files:
+        try:
+            mtimes[log_file] = os.stat(log_file).st_mtime
+        except OSError:
+            pass  # Rotated or removed since it was listed
+    log_files = [log_file for log_file in log_files if log_file in mtimes]
+    chains = {}
+    for log_file in log_files:
+        chains.setdefault(LOG_FILE.sub('', log_file), []).append(log_file)
+    starts = {}
+    for chain in chains.values():
+        chain.sort(key=mtimes.get)
+        for previous, log_file in zip([None] + chain, chain):
+            starts[log_file] = mtimes[previous] if previous is not None else None
+    return [log_file for log_file in log_files
+            if (since is None or mtimes[log_file] >= since) and
+               (until is None or starts[log_file] is None or starts[log_file] <= until)]
+
+def file_size(log_file):
+    try:
+        return os.path.getsize(log_file)
+    except OSError:
+        return 0  # Removed meanwhile, the search reports it
+
+def grep_command(command_parts, log_file):
+    """
+    Returns the grep command for log_file, with the matching zgrep, bzgrep or xzgrep for archives.
+    """
+    tool = COMPRESSED_GREPS.get(os.path.splitext(log_file)[1])
+    if tool is None or os.path.basename(command_parts[0]) not in ('grep', 'egrep', 'fgrep'):
+        return command_parts
+    syntax = {'egrep': ['-E'], 'fgrep': ['-F']}.get(os.path.basename(command_parts[0]), [])
+    return [tool] + syntax + command_parts[1:]
+
+class GrepProcess:
+    """
+    Runs one grep command and kills it if the query deadline passes while its output is read.
+    
+    Attributes:
+        stdout (file): grep's output as text lines.
+        first_line (int): Number of lines of the file before the input, when grep reads
+            input_blocks instead of a file. grep numbers the lines from there.
+    """
+
+    def __init__(self, command, deadline=None, input_blocks=None):
+        timeout = time_left(deadline)
+        log.debug("Executing command: %s", ' '.join(command))
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE if input_blocks is not None else None,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                        universal_newlines=True, errors='replace')
+        self.stdout = self.process.stdout
+        self.first_line = 0
+        self.input_error = None
+        self.feeder = None
+        if input_blocks is not None:
+            self.feeder = threading.Thread(target=self.feed, args=(input_blocks,), daemon=True)
+            self.feeder.start()
+        self.timed_out = threading.Event()
+        self.timer = threading.Timer(timeout, self.kill) if timeout is not None else None
+        if self.timer is not None:
+            self.timer.start()
+
+    def feed(self, input_blocks):
+        """
+        Writes (first_line, block) pairs to grep's input, see TimeIndex.iter_window.
+        """
+        try:
+            for i, (first_line, block) in enumerate(input_blocks):
+                if i == 0:
+                    # Set before grep can see, and number, a single line
+                    self.first_line = first_line
+                self.process.stdin.buffer.write(block)
+        except (BrokenPipeError, ValueError):
+            pass  # grep stopped reading: -m reached, or killed
+        except Exception as e:
+            self.input_error = e
+        finally:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+
+    def kill(self):
+        self.timed_out.set()
+        self.process.kill()
+
+    def finish(self):
+        """
+        Waits for grep to exit.
         
-    Returns:
-        tuple: A string containing the results and an integer representing the total number of matches.
+        Returns:
+            Exception: The error grep reported for the file, or None.
+        
+        Raises:
+            QueryTimeout: If grep was killed because the deadline passed.
+        """
+        stderr = self.process.stderr.read()
+        self.process.wait()
+        self.close()
+        if self.timed_out.is_set():
+            raise QueryTimeout("Query timed out")
+        if self.input_error is not None:
+            return self.input_error
+        # grep exits with 1 when nothing matched and with 2 on errors
+        if self.process.returncode > 1:
+            log.warning("Command failed with error: %s", stderr.strip())
+            return RuntimeError(stderr.strip() or f"grep exited with status {self.process.returncode}")
+        return None
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        if self.feeder is not None:
+            self.feeder.join()
+        self.process.stdout.close()
+        self.process.stderr.close()
+
+def grep_input(command_parts, options, log_file, time_range=None, time_index=None):
     """
-    # Get a list of all .log files in the specified directory
-    log_files = [os.path.join(log_directory, f) for f in os.listdir(log_directory) if f.endswith('.log')]
-    result = ""
-    total_matches = 0
+    Returns the grep command for log_file, with the extra options, and the blocks to feed it:
+    the lines of time_range if one is given, found with time_index if there is one. Otherwise
+    the blocks are None and grep reads the file itself.
+    """
+    if time_range is None:
+        return grep_command(command_parts, log_file) + options + [log_file], None
+    if time_index is not None:
+        return command_parts + options, time_index.iter_window(log_file, time_range)
+    return command_parts + options, iter_blocks(log_file, time_range)
 
+def iter_grep_on_logs(query, log_directory, deadline=None, limit=None, log_files=None, time_range=None, time_index=None,
+                      line_numbers=False):
+    """
+    Runs the grep command on every .log file in the directory and yields its output in batches,
+    as soon as grep produces it.
+    
+    Args:
+        query (str): The grep command, the file name is appended to it.
+        deadline (float): Optional time.monotonic() deadline, QueryTimeout is raised once it passes.
+        limit (int): Stop after this many matching lines, grep is told to stop with -m.
+        log_files (list): The files to search instead of the .log files of the directory.
+        time_range (tuple): Only search the lines between these (start, end) timestamps, which
+            are fed to grep, found with time_index if one is given.
+        line_numbers (bool): Add -n, so the lines come out whole whether the query asked for it or not.
+        
+    Yields:
+        tuple: (log_file, matches, error) where matches is a list of (line_number, line). Every file
+        is yielded at least once, error is None unless grep failed on the file.
+    """
     # Split the query into command and arguments
     command_parts = shlex.split(query)
+    remaining = limit
 
-    for log_file in log_files:
-        command = command_parts + [log_file]
-        
-        print(command)
-        print(f"Executing command: {' '.join(command)}")
-        
+    for log_file in log_files if log_files is not None else list_log_files(log_directory):
+        options = (['-n'] if line_numbers else []) + (['-m', str(remaining)] if remaining is not None else [])
         try:
-            grep_result = subprocess.check_output(command, stderr=subprocess.STDOUT, universal_newlines=True)
-            matches = grep_result.strip().split('\n')
-
-            # Check if any matches wer  e found
-            if matches:
-                result += f"File: {log_file}\n"
-                for match in matches:
-                    # Format each match and append to the result
-                    result += f"Line {match.split(':')[0]}: {match.split(':', 1)[1]}\n"
-                total_matches += len(matches)
-            else:
-                result += f"File: {log_file}\nNo matches found\n"
-        except subprocess.CalledProcessError:
-            result += f"File: {log_file}\nNo matches found\n"
-        except Exception as e:
-            print(f"Command failed with error: {e}")
-            result += f"An error occurred while processing {log_file}: {str(e)}\n"
+            command, input_blocks = grep_input(command_parts, options, log_file, time_range, time_index)
+            grep = GrepProcess(command, deadline, input_blocks)
+        except OSError as e:
+            yield log_file, [], e
+            continue
+
+        yielded = False
+        file_matches = 0
+        try:
+            batch = []
+            for output_line in grep.stdout:
+                line_number, _, line = output_line.rstrip('\n').partition(':')
+                batch.append((int(line_number) + grep.first_line if line_number.isdigit() else line_number, line))
+                file_matches += 1
+                if len(batch) >= BATCH_LINES:
+                    yield log_file, batch, None
+                    yielded = True
+                    batch = []
+            error = grep.finish()
+        finally:
+            grep.close()
+
+        if batch or error is not None or not yielded:
+            yield log_file, batch, error
+        if remaining is not None:
+            remaining -= file_matches
+            if remaining <= 0:
+                return
+
+def iter_grep_counts(query, log_directory, deadline=None, log_files=None, time_range=None, time_index=None):
+    """
+    Runs the grep command with -c on every .log file, or on log_files, so only the counts leave grep.
+    Only the lines of time_range are counted if one is given, see iter_grep_on_logs.
+    
+    Yields:
+        tuple: (log_file, count, error) for every file.
+    """
+    command_parts = shlex.split(query)
+
+    for log_file in log_files if log_files is not None else list_log_files(log_directory):
+        try:
+            command, input_blocks = grep_input(command_parts, ['-c'], log_file, time_range, time_index)
+            grep = GrepProcess(command, deadline, input_blocks)
+        except OSError as e:
+            yield log_file, 0, e
+            continue
+        try:
+            output = grep.stdout.read().strip()
+            error = grep.finish()
+        finally:
+            grep.close()
+        yield log_file, int(output) if output.isdigit() else 0, error
+
+def format_results(batches):
+    """
+    Formats (log_file, matches, error) batches as the text the client writes to its log.
+    
+    Returns:
+        tuple: A string containing the results and an integer representing the total number of matches.
+    """
+    result = []
+    total_matches = 0
+    current_file = None
+    file_matches = 0
+    file_failed = False
+
+    def finish_file():
+        if current_file is not None and file_matches == 0 and not file_failed:
+            result.append(f"File: {current_file}\nNo matches found\n")
+
+    for log_file, matches, error in batches:
+        if log_file != current_file:
+            finish_file()
+            current_file, file_matches, file_failed = log_file, 0, False
+        if matches:
+            if file_matches == 0:
+                result.append(f"File: {log_file}\n")
+            result.extend(f"Line {line_number}: {line}\n" for line_number, line in matches)
+            file_matches += len(matches)
+            total_matches += len(matches)
+        if error is not None:
+            result.append(f"An error occurred while processing {log_file}: {str(error)}\n")
+            file_failed = True
+    finish_file()
+
+    return "".join(result), total_matches
 
-    return result, total_matches
+def execute_grep_on_logs(query, log_directory, deadline=None):
+    """
+    Executes a grep search on all .log files in the current directory and returns the results.
+    
+    Args:
+        query (str): The search pattern to use with grep.
+        deadline (float): Optional time.monotonic() deadline, QueryTimeout is raised once it passes.
+        
+    Returns:
+        tuple: A string containing the results and an integer representing the total number of matches.
+    """
+    return format_results(iter_grep_on_logs(query, log_directory, deadline))
 
-def handle_client(client_socket, log_directory):
+def execute_search_on_logs(query, log_directory, engine, deadline=None):
     """
-    Handles communication with a connected client. Receives queries, executes the search,
-    and sends back the results.
+    Searches all .log files with the in-process search engine instead of grep subprocesses.
+    The results have the same format as execute_grep_on_logs.
     
     Args:
-        client_socket (socket.socket): The socket object for the client connection.
+        query (str): A grep command or a bare pattern.
+        engine (SearchEngine): The engine holding the worker pool.
+        deadline (float): Optional time.monotonic() deadline, QueryTimeout is raised once it passes.
+        
+    Returns:
+        tuple: A string containing the results and an integer representing the total number of matches.
     """
     try:
+        return format_results(engine.iter_search(query, list_log_files(log_directory), deadline))
+    except QueryTimeout:
+        raise
+    except Exception as e:
+        log.error("Search failed with error: %s", e)
+        return f"An error occurred while processing the query: {str(e)}\n", 0
+
+class Reply:
+    """
+    Sends the frames of one query's response. A connection can run several queries at
+    once, so every frame is tagged with the query's id and sent whole under the
+    connection's send lock. MATCHES frames are compressed if the connection negotiated it.
+
+    Attributes:
+        raw_bytes (int): Bytes the frames sent so far would have taken uncompressed.
+        wire_bytes (int): Bytes actually sent so far.
+        metrics (QueryMetrics): Measurements of the query, with the time spent encoding and
+            sending its frames.
+        deadline (Deadline): The query's deadline, cancelled when the client gives up on it.
+    """
+
+    def __init__(self, client_socket, send_lock, request_id=None, compressor=None):
+        self.client_socket = client_socket
+        self.send_lock = send_lock
+        self.request_id = request_id
+        self.compressor = compressor
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.metrics = QueryMetrics()
+        self.deadline = Deadline()
+
+    def send(self, frame_type, payload):
+        """
+        Sends one frame of the response.
+
+        Raises:
+            QueryCancelled: If a MATCHES frame is sent after the query was cancelled.
+            OSError: If the client is gone.
+        """
+        if frame_type == MATCHES and self.deadline.cancelled:
+            raise QueryCancelled("Query cancelled")
+        if self.request_id is not None:
+            payload["id"] = self.request_id
+        start = time.monotonic()
+        body = encode_payload(payload)
+        compressor = self.compressor if frame_type == MATCHES else None
+        with self.send_lock:
+            # Compressed frames must be sent in the order they went through the compressor
+            data = pack_frame(frame_type, body, compressor=compressor)
+            encoded = time.monotonic()
+            self.client_socket.sendall(data)
+        self.metrics.serialize_seconds += encoded - start
+        self.metrics.send_seconds += time.monotonic() - encoded
+        self.raw_bytes += HEADER.size + len(body)
+        self.wire_bytes += len(data)
+
+class GrepServer:
+    """
+    A log grep server that handles every client connection in its own thread and
+    runs at most max_concurrency queries at a time.
+
+    Queries that cannot get a slot within query_timeout, or that run past it, are
+    answered with an error instead of holding up the other clients. Every query is
+    measured into metrics, see the STATS frame.
+    """
+
+    def __init__(self, log_directory, engine=None, max_concurrency=8, query_timeout=30, compression=True):
+        self.log_directory = log_directory
+        self.engine = engine
+        self.query_timeout = query_timeout
+        self.compression = compression
+        self.query_slots = threading.BoundedSemaphore(max_concurrency)
+        # Shared with the engine, so both paths find time ranges the same way
+        self.time_index = TimeIndex()
+        if engine is not None:
+            engine.time_index = self.time_index
+        self.tailer = LogTailer(lines_at=self.lines_at)
+        self.metrics = Metrics()
+
+    def lines_at(self, path, identity, offset):
+        """
+        Returns the number of lines before offset in the file identity at path if the n-gram
+        or the time index knows it, else None.
+        """
+        index = self.engine.index if self.engine is not None else None
+        if index is not None:
+            stored = index.load(path)
+            if stored is not None and stored.identity == identity:
+                lines = index.lines_at(path, offset)
+                if lines is not None:
+                    return lines
+        try:
+            return self.time_index.lines_at(path, identity, offset)
+        except OSError:
+            return None
+
+    def select_log_files(self, request):
+        """
+        Returns the log files a query asks for with its optional "files" glob pattern and
+        "since" and "until" Unix times.
+        
+        Raises:
+            ValueError: If the selection is not valid.
+        """
+        pattern, since, until = request.get("files"), request.get("since"), request.get("until")
+        if pattern is not None and (not isinstance(pattern, str) or os.sep in pattern):
+            raise ValueError(f"files must be a file name pattern: {pattern}")
+        for value in (since, until):
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                raise ValueError(f"since and until must be Unix times: {value}")
+        return list_log_files(self.log_directory, pattern, since, until)
+
+    def iter_results(self, query, log_files, deadline, limit=None, time_range=None):
+        if self.engine is not None:
+            return self.engine.iter_search(query, log_files, deadline, limit, time_range)
+        return iter_grep_on_logs(query, self.log_directory, deadline, limit, log_files, time_range, self.time_index)
+
+    def iter_counts(self, query, log_files, deadline, time_range=None):
+        if self.engine is not None:
+            return self.engine.iter_counts(query, log_files, deadline, time_range)
+        return iter_grep_counts(query, self.log_directory, deadline, log_files, time_range, self.time_index)
+
+    def send_matches(self, reply, query, log_files, deadline, limit=None, time_range=None):
+        """
+        Streams the matching lines, at most limit of them, and returns the trailer.
+        """
+        files = {}
+        errors = {}
+        total_matches = 0
+        for log_file, matches, error in reply.metrics.iter_timed(self.iter_results(query, log_files, deadline, limit, time_range)):
+            files.setdefault(log_file, 0)
+            for i in range(0, len(matches), BATCH_LINES):
+                reply.send(MATCHES, {"file": log_file, "lines": matches[i:i + BATCH_LINES]})
+            files[log_file] += len(matches)
+            total_matches += len(matches)
+            if error is not None:
+                errors[log_file] = str(error)
+        trailer = {"files": files, "errors": errors, "total_matches": total_matches}
+        if limit is not None:
+            # The scan stopped early, the counts only cover the lines that were sent
+            trailer["limit_reached"] = total_matches >= limit
+        return trailer
+
+    def send_counts(self, reply, query, log_files, deadline, time_range=None):
+        """
+        Counts the matching lines without sending any of them and returns the trailer.
+        """
+        files = {}
+        errors = {}
+        for log_file, count, error in reply.metrics.iter_timed(self.iter_counts(query, log_files, deadline, time_range)):
+            files[log_file] = files.get(log_file, 0) + count
+            if error is not None:
+                errors[log_file] = str(error)
+        return {"files": files, "errors": errors, "total_matches": sum(files.values())}
+
+    def send_sample(self, reply, query, log_files, deadline, size, seed=None, time_range=None):
+        """
+        Sends a uniform sample of size matching lines and returns the trailer with the full counts.
+        """
+        if self.engine is not None:
+            sample, files, errors = self.engine.sample(query, log_files, size, deadline, seed, time_range)
+        else:
+            results = reply.metrics.iter_timed(self.iter_results(query, log_files, deadline, time_range=time_range))
+            sample, files, errors = sample_matches(results, size, seed)
+        for log_file, lines in itertools.groupby(sample, key=lambda match: match[0]):
+            lines = [(line_number, line) for _, line_number, line in lines]
+            for i in range(0, len(lines), BATCH_LINES):
+                reply.send(MATCHES, {"file": log_file, "lines": lines[i:i + BATCH_LINES]})
+        return {"files": files, "errors": errors, "total_matches": sum(files.values()), "sampled": len(sample)}
+
+    def send_aggregate(self, reply, query, log_files, deadline, spec, time_range=None):
+        """
+        Aggregates the matching lines on the server and returns the trailer with the groups,
+        no lines are sent.
+        """
+        if self.engine is not None:
+            aggregation, files, errors = self.engine.aggregate(query, log_files, spec, deadline, time_range)
+        else:
+            aggregation, files, errors = Aggregation(spec), {}, {}
+            results = iter_grep_on_logs(query, self.log_directory, deadline, None, log_files, time_range, self.time_index,
+                                        line_numbers=True)
+            for log_file, matches, error in reply.metrics.iter_timed(results):
+                matched = aggregation.matched
+                try:
+                    for _, line in matches:
+                        aggregation.add(line.encode('utf-8'))
+                except ValueError as e:
+                    error = e
+                files[log_file] = files.get(log_file, 0) + aggregation.matched - matched
+                if error is not None:
+                    errors[log_file] = str(error)
+        return {"files": files, "errors": errors, "total_matches": sum(files.values()), "groups": aggregation.encode(),
+                "unparsed": aggregation.unparsed}
+
+    def send_patterns(self, reply, queries, log_files, deadline, count_only=False, time_range=None):
+        """
+        Runs a batch of queries and returns the trailer with the counts of every query under
+        "patterns". The matches are sent with the index of their query under "pattern".
+
+        The engine finds the matches of the whole batch in one pass over the files, the grep
+        path runs one grep per query.
+        """
+        files = {}
+        errors = {}
+        patterns = [{"files": {}, "total_matches": 0} for _ in queries]
+
+        def add(log_file, i, count, error):
+            files[log_file] = files.get(log_file, 0) + count
+            patterns[i]["files"][log_file] = patterns[i]["files"].get(log_file, 0) + count
+            patterns[i]["total_matches"] += count
+            if error is not None:
+                errors[log_file] = str(error)
+
+        if self.engine is not None and count_only:
+            for log_file, counts, error in reply.metrics.iter_timed(self.engine.iter_pattern_counts(queries, log_files, deadline, time_range)):
+                for i, count in enumerate(counts):
+                    add(log_file, i, count, error)
+        elif self.engine is not None:
+            for log_file, matches, error in reply.metrics.iter_timed(self.engine.iter_search_patterns(queries, log_files, deadline, time_range)):
+                for i in range(len(queries)):
+                    lines = [(line_number, line) for line_number, line, hits in matches if i in hits]
+                    for start in range(0, len(lines), BATCH_LINES):
+                        reply.send(MATCHES, {"file": log_file, "pattern": i, "lines": lines[start:start + BATCH_LINES]})
+                    add(log_file, i, len(lines), error)
+        else:
+            for i, query in enumerate(queries):
+                if count_only:
+                    for log_file, count, error in reply.metrics.iter_timed(self.iter_counts(query, log_files, deadline, time_range)):
+                        add(log_file, i, count, error)
+                    continue
+                for log_file, matches, error in reply.metrics.iter_timed(self.iter_results(query, log_files, deadline, None, time_range)):
+                    for start in range(0, len(matches), BATCH_LINES):
+                        reply.send(MATCHES, {"file": log_file, "pattern": i, "lines": matches[start:start + BATCH_LINES]})
+                    add(log_file, i, len(matches), error)
+        return {"files": files, "errors": errors, "total_matches": sum(files.values()), "patterns": patterns}
+
+    def subscribe(self, reply, request):
+        """
+        Starts sending the new matches of a subscribe query as the log files grow. Subscriptions
+        match the appended lines in-process, with either engine, and do not take a query slot.
+
+        Returns:
+            Subscription: The subscription, or None if the query was rejected.
+        """
+        if not isinstance(request.get("id"), int) or not isinstance(request.get("query"), str):
+            reply.send(ERROR, {"message": "A subscription needs a single query and an id to unsubscribe with"})
+            return None
+        try:
+            grep = parse_query(request["query"])
+            regex = grep.compile()
+            self.select_log_files(request)
+        except (ValueError, re.error) as e:
+            reply.send(ERROR, {"message": f"Invalid query: {e}"})
+            return None
+
+        def select():
+            # Compressed files are archives, they do not grow
+            return [log_file for log_file in list_log_files(self.log_directory, request.get("files")) if not is_compressed(log_file)]
+
+        def send(log_file, matches):
+            for i in range(0, len(matches), BATCH_LINES):
+                reply.send(MATCHES, {"file": log_file, "lines": matches[i:i + BATCH_LINES]})
+
+        subscription = Subscription(select, regex, grep.invert, send)
+        try:
+            self.tailer.subscribe(subscription)
+        except OSError as e:
+            reply.send(ERROR, {"message": f"Could not list the log files: {e}"})
+            return None
+        return subscription
+
+    def unsubscribe(self, reply, subscription):
+        """
+        Ends a subscription and sends its trailer with the matches sent per file.
+        """
+        self.tailer.unsubscribe(subscription)
+        errors = {"*": str(subscription.error)} if subscription.error is not None else {}
+        reply.send(TRAILER, {"files": subscription.files, "errors": errors, "total_matches": sum(subscription.files.values())})
+
+    def run_query(self, reply, request):
+        """
+        Answers a query, see execute_query, and records its measurements in metrics.
+        """
+        self.metrics.begin()
+        status, matches = FAILED, 0
+        try:
+            status, matches = self.execute_query(reply, request)
+        finally:
+            self.metrics.record(request, reply.metrics, status, matches)
+            log.info("Query %s: %s in %.3fs, %d matches", request.get("query", request.get("queries")), status,
+                     time.monotonic() - reply.metrics.start, matches)
+
+    def execute_query(self, reply, request):
+        """
+        Waits for a free query slot, executes the query within query_timeout and streams
+        the matches to the client as they are found, followed by a trailer with the counts.
+        
+        Args:
+            reply (Reply): Sends the response frames to the client.
+            request (dict): The query frame payload: the query, or a batch of them under "queries"
+                (with the 'all' or 'count' mode only), and optionally a mode
+                ('all', 'count', 'first' or 'sample') with the limit for the last two, and
+                the file selection, see select_log_files, the "time_range" of the lines
+                to search, see time_index.parse_time_range, and the "aggregate" spec of the
+                aggregate mode, see structured.Aggregation.
+
+        Returns:
+            tuple: (status, matches), the status being one of the metrics statuses.
+        """
+        query = request.get("query")
+        queries = request.get("queries")
+        mode = request.get("mode", "all")
+        limit = request.get("limit")
+        if mode not in QUERY_MODES:
+            reply.send(ERROR, {"message": f"Unknown query mode: {mode}"})
+            return INVALID, 0
+        if queries is not None and (mode not in ('all', 'count') or not queries or len(queries) > MAX_BATCH or
+                                    not all(isinstance(batch_query, str) for batch_query in queries)):
+            reply.send(ERROR, {"message": f"A batch of queries needs the all or count mode and 1 to {MAX_BATCH} queries"})
+            return INVALID, 0
+        if mode in ('first', 'sample') and (isinstance(limit, bool) or not isinstance(limit, int) or limit <= 0):
+            reply.send(ERROR, {"message": f"Mode {mode} needs a positive limit"})
+            return INVALID, 0
+
+        deadline = reply.deadline
+        deadline.at = time.monotonic() + self.query_timeout if self.query_timeout else None
+        if not self.query_slots.acquire(timeout=self.query_timeout or -1):
+            reply.send(ERROR, {"message": f"Server busy, query waited more than {self.query_timeout}s for a free slot"})
+            return BUSY, 0
+        reply.metrics.queue_wait = time.monotonic() - reply.metrics.start
+        try:
+            try:
+                log_files = self.select_log_files(request)
+                reply.metrics.bytes_scanned = sum(file_size(log_file) for log_file in log_files)
+                time_range = parse_time_range(request.get("time_range"))
+                if queries is not None:
+                    trailer = self.send_patterns(reply, queries, log_files, deadline, mode == 'count', time_range)
+                elif mode == 'count':
+                    trailer = self.send_counts(reply, query, log_files, deadline, time_range)
+                elif mode == 'sample':
+                    trailer = self.send_sample(reply, query, log_files, deadline, limit, request.get("seed"), time_range)
+                elif mode == 'aggregate':
+                    trailer = self.send_aggregate(reply, query, log_files, deadline, request.get("aggregate", {}), time_range)
+                else:
+                    trailer = self.send_matches(reply, query, log_files, deadline, limit if mode == 'first' else None, time_range)
+            except QueryCancelled:
+                reply.send(ERROR, {"message": "Query cancelled"})
+                return CANCELLED, 0
+            except QueryTimeout:
+                reply.send(ERROR, {"message": f"Query timed out after {self.query_timeout}s"})
+                return TIMEOUT, 0
+            except (ValueError, re.error) as e:
+                reply.send(ERROR, {"message": f"Invalid query: {e}"})
+                return INVALID, 0
+            # Transfer size of the matches, the trailer itself is not counted
+            trailer["raw_bytes"] = reply.raw_bytes
+            trailer["wire_bytes"] = reply.wire_bytes
+            reply.send(TRAILER, trailer)
+            return OK, trailer["total_matches"]
+        finally:
+            self.query_slots.release()
+
+    def run_query_in_thread(self, reply, request):
+        try:
+            self.run_query(reply, request)
+        except OSError as e:
+            log.warning("Connection error while answering query %s: %s", reply.request_id, e)
+
+    def handle_client(self, client_socket):
+        """
+        Handles communication with a connected client. The connection stays open for any
+        number of queries. Queries with an id run concurrently and their responses are
+        interleaved frame by frame, queries without one are answered in order. UNSUBSCRIBE
+        with the id of a running query cancels it, it stops at its next check of its deadline.
+        
+        Args:
+            client_socket (socket.socket): The socket object for the client connection.
+        """
+        send_lock = threading.Lock()
+        compressor = None
+        queries = []
+        subscriptions = {}
+        try:
+            while True:
+                # Receive the next query or health check from the client
+                frame = recv_frame(client_socket)
+                if frame is None:
+                    log.debug("Client disconnected.")
+                    break
+                frame_type, _, payload = frame
+                if not isinstance(payload, dict):
+                    Reply(client_socket, send_lock).send(ERROR, {"message": "Expected a JSON object as the payload"})
+                    break
+                queries = [(thread, reply) for thread, reply in queries if thread.is_alive()]
+                if frame_type == PING:
+                    Reply(client_socket, send_lock, payload.get("id")).send(PONG, {"active_queries": len(queries)})
+                    continue
+                if frame_type == STATS:
+                    Reply(client_socket, send_lock, payload.get("id")).send(STATS, {"stats": self.metrics.snapshot()})
+                    continue
+                if frame_type == HELLO:
+                    # Compress the results of this connection if the client can decompress them
+                    level = payload.get("level", DEFAULT_LEVEL)
+                    if compressor is None and self.compression and "zlib" in payload.get("accept_encoding", []):
+                        compressor = Compressor(min(max(level, 0), 9) if isinstance(level, int) else DEFAULT_LEVEL)
+                    Reply(client_socket, send_lock).send(HELLO, {"encoding": "zlib" if compressor is not None else None})
+                    continue
+                if frame_type == UNSUBSCRIBE:
+                    if payload.get("id") in subscriptions:
+                        self.unsubscribe(*subscriptions.pop(payload["id"]))
+                    for _, reply in queries:
+                        if reply.request_id == payload.get("id"):
+                            reply.deadline.cancel()
+                    continue
+                if frame_type != QUERY or not (isinstance(payload.get("query"), str) or isinstance(payload.get("queries"), list)):
+                    Reply(client_socket, send_lock).send(ERROR, {"message": "Expected a query frame"})
+                    break
+                log.debug("Received query: %s", payload.get('query', payload.get('queries')))
+                
+                # Execute the search on the log files and send the results back to the client
+                reply = Reply(client_socket, send_lock, payload.get("id"), compressor)
+                if payload.get("mode") == 'subscribe':
+                    if reply.request_id in subscriptions:
+                        self.unsubscribe(*subscriptions.pop(reply.request_id))
+                    subscription = self.subscribe(reply, payload)
+                    if subscription is not None:
+                        subscriptions[reply.request_id] = (reply, subscription)
+                elif reply.request_id is None:
+                    self.run_query(reply, payload)
+                else:
+                    thread = threading.Thread(target=self.run_query_in_thread, args=(reply, payload), daemon=True)
+                    thread.start()
+                    queries.append((thread, reply))
+        except (OSError, ProtocolError) as e:
+            log.warning("Connection error: %s", e)
+        finally:
+            for _, subscription in subscriptions.values():
+                self.tailer.unsubscribe(subscription)
+            # Nobody reads the running queries any more, the socket is only closed once they
+            # are done with it
+            for _, reply in queries:
+                reply.deadline.cancel()
+            for thread, _ in queries:
+                thread.join()
+            # Close the connection with the client
+            client_socket.close()
+            log.debug("Connection closed with the client.")
+
+    def serve_forever(self, port=9999, backlog=64):
+        """
+        Listens for client connections and starts a thread for each of them.
+        """
+        # Create a socket object
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Bind the socket to the specified IP and port
+        server.bind(('0.0.0.0', port))
+        # Listen for incoming connections
+        server.listen(backlog)
+        log.info("Server listening on port %d", port)
+
         while True:
-            # Receive the query from the client
-            query = client_socket.recv(1024).decode('utf-8')
-            if not query or query.lower() == 'exit':
-                print("Client requested disconnection or sent empty query.")
-                break
-            
-            print(f"Received query: {query}")
-            
-            # Execute the search on the log files
-            result, total_matches = execute_grep_on_logs(query, log_directory)
-
-            # Send the results back to the client
-            client_socket.send(result.encode('utf-8'))
-            client_socket.send(b"EOF")  # End of file indicator
-            client_socket.send(f"TOTAL_MATCHES:{total_matches}".encode('utf-8'))
-            break
-    finally:
-        # Close the connection with the client
-        client_socket.close()
-        print("Connection closed with the client.")
+            # Accept a new client connection
+            client_socket, addr = server.accept()
+            log.debug("Accepted connection from %s", addr)
+            # Handle the client connection in its own thread so queries run concurrently
+            threading.Thread(target=self.handle_client, args=(client_socket,), daemon=True).start()
 
 def main():
     """
@@ -89,23 +795,42 @@ def main():
     """
     parser = argparse.ArgumentParser(description='Start a log grep server.')
     parser.add_argument('--log_directory', type=str, default='MP2', help='Directory containing .log files')
+    parser.add_argument('--port', type=int, default=9999, help='Port to listen on')
+    parser.add_argument('--engine', choices=['grep', 'python'], default='grep',
+                        help='Run a grep process per file, or search in-process with a worker pool')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes for the python engine (default: all cores)')
+    parser.add_argument('--index_dir', type=str, default=None,
+                        help='Keep a trigram index of the logs in this directory and skip blocks that cannot match (python engine only)')
+    parser.add_argument('--cache_mb', type=int, default=256,
+                        help='Memory for cached per-file query results, repeated queries only scan appended data (python engine only, 0 to disable)')
+    parser.add_argument('--max_concurrency', type=int, default=8, help='Maximum number of queries executed at the same time')
+    parser.add_argument('--backlog', type=int, default=64, help='Backlog of pending connections for listen()')
+    parser.add_argument('--compression', choices=['zlib', 'none'], default='zlib',
+                        help='Compress the matches sent to clients that ask for it')
+    parser.add_argument('--query_timeout', type=float, default=30, help='Seconds a query may wait and run before it is aborted (0 to disable)')
+    parser.add_argument('--metrics_port', type=int, default=None,
+                        help='Also serve the query metrics over HTTP on this port, as JSON at /stats and for Prometheus at /metrics')
+    parser.add_argument('--log_level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO',
+                        help='DEBUG also logs every connection and every grep command')
+    parser.add_argument('--log_rate', type=int, default=10,
+                        help='Most messages of the same kind logged per second, the others are counted (0 for no limit)')
     args = parser.parse_args()
-    log_directory = args.log_directory
-
-    # Create a socket object
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # Bind the socket to the specified IP and port
-    server.bind(('0.0.0.0', 9999))
-    # Listen for incoming connections
-    server.listen(5)
-    print("Server listening on port 9999")
-    
-    while True:
-        # Accept a new client connection
-        client_socket, addr = server.accept()
-        print(f"Accepted connection from {addr}")
-        # Handle the client connection in a separate function
-        handle_client(client_socket, log_directory)
+    setup_logging(args.log_level, args.log_rate)
+    engine = SearchEngine(args.workers) if args.engine == 'python' else None
+    if args.index_dir:
+        if engine is None:
+            parser.error("--index_dir needs --engine python")
+        engine.index = NgramIndex(args.index_dir, engine.pool, chunk_size=engine.chunk_size)
+        # Start indexing right away instead of at the first query
+        for log_file in list_log_files(args.log_directory):
+            engine.index.schedule_refresh(log_file)
+    if engine is not None and args.cache_mb > 0:
+        engine.cache = ResultCache(args.cache_mb * 1024 * 1024)
+
+    server = GrepServer(args.log_directory, engine, args.max_concurrency, args.query_timeout, args.compression != 'none')
+    if args.metrics_port:
+        serve_metrics(server.metrics, args.metrics_port)
+    server.serve_forever(args.port, args.backlog)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,212 @@
+import re
+
+# The log formats structured queries understand: the lines of generate_random_log.py and MP2,
+# and the Apache access log lines of test.py. 'auto' tries them in this order on every line.
+FORMATS = {
+    'app': re.compile(rb'^(?P<date>\d{4}-\d{2}-\d{2})[ T](?P<clock>\d{2}:\d{2}:\d{2}) - (?P<level>[A-Z]+) - (?P<message>.*)$'),
+    'access': re.compile(rb'^(?P<host>\S+) \S+ (?P<user>\S+) \[(?P<day>\d{2})/(?P<month>[A-Z][a-z]{2})/(?P<year>\d{4}):'
+                         rb'(?P<clock>\d{2}:\d{2}:\d{2}) [-+]\d{4}\] "(?P<method>[A-Z]+) (?P<path>\S+) (?P<protocol>[^"]*)" '
+                         rb'(?P<status>\d{3}) (?P<size>\d+|-)(?: "(?P<referer>[^"]*)" "(?P<agent>[^"]*)")?'),
+}
+
+# time is "YYYY-MM-DD HH:MM:SS" in both formats, minute and hour are its prefixes for grouping
+FIELDS = {
+    'app': ('time', 'minute', 'hour', 'level', 'message'),
+    'access': ('time', 'minute', 'hour', 'host', 'user', 'method', 'path', 'protocol', 'status', 'size', 'referer', 'agent'),
+}
+NUMERIC_FIELDS = ('status', 'size')
+OPERATORS = ('!=', '<=', '>=', '=', '<', '>', '~')
+METRICS = ('count', 'min', 'max')
+
+# A query grouping by a field like message could otherwise keep the whole log in memory
+MAX_GROUPS = 100000
+
+MONTHS = {name: f"{i:02d}" for i, name in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1)}
+FILTER = re.compile(r'^\s*(\w+)\s*(' + '|'.join(re.escape(op) for op in OPERATORS) + r')\s*(.*?)\s*$')
+
+
+def parse_line(line, log_format='auto'):
+    """
+    Splits a log line into its fields.
+
+    Returns:
+        dict: The fields of the line as str, or int for NUMERIC_FIELDS, or None if the line
+        is not in log_format. A missing optional field (e.g. the size "-") is None.
+    """
+    for name in (FORMATS if log_format == 'auto' else (log_format,)):
+        m = FORMATS[name].match(line)
+        if m is None:
+            continue
+        fields = {key: value.decode('utf-8', errors='replace') for key, value in m.groupdict().items() if value is not None}
+        if name == 'access':
+            fields['time'] = f"{fields.pop('year')}-{MONTHS.get(fields.pop('month'), '00')}-{fields.pop('day')} {fields.pop('clock')}"
+            for key in NUMERIC_FIELDS:
+                fields[key] = int(fields[key]) if fields[key].isdigit() else None
+        else:
+            fields['time'] = f"{fields.pop('date')} {fields.pop('clock')}"
+        fields['minute'] = fields['time'][:16]
+        fields['hour'] = fields['time'][:13]
+        return fields
+    return None
+
+
+def parse_filter(text):
+    """
+    Parses a filter written as "field op value", e.g. "status>=500" or "path~^/wp-".
+
+    Returns:
+        list: [field, op, value] as sent in the "aggregate" spec of a query.
+    """
+    m = FILTER.match(text)
+    if m is None:
+        raise ValueError(f"Filters look like field=value, with one of {' '.join(OPERATORS)}: {text}")
+    return [m.group(1), m.group(2), m.group(3)]
+
+
+def combine(op, a, b):
+    """
+    Combines two values of a metric, either of which may be None.
+    """
+    if op == 'count':
+        return a + b
+    if a is None or b is None:
+        return b if a is None else a
+    return min(a, b) if op == 'min' else max(a, b)
+
+
+class Aggregation:
+    """
+    Computes the "aggregate" spec of a query over log lines in a single pass: the lines are
+    parsed into fields, filtered, grouped by the group_by fields and the metrics kept per group.
+
+    The spec is a dict of:
+        format (str): 'auto', 'app' or 'access', see FORMATS.
+        filters (list): [field, op, value] triples that all have to hold, op being one of
+            OPERATORS, with '~' for a regex search. NUMERIC_FIELDS are compared as numbers.
+        group_by (list): Fields to group the lines by, e.g. ["minute", "level"].
+        metrics (list): ["count"], ["min", field] or ["max", field] per value to compute,
+            by default just the count.
+
+    Partial aggregations of chunks, files or servers merge into one with merge.
+
+    Attributes:
+        groups (dict): The metric values per tuple of group_by values.
+        matched (int): Lines that passed the filters.
+        unparsed (int): Lines that were not in the format.
+
+    Raises:
+        ValueError: If the spec is not valid.
+    """
+
+    def __init__(self, spec):
+        if not isinstance(spec, dict):
+            raise ValueError(f"aggregate must be an object: {spec}")
+        self.format = spec.get("format", "auto")
+        if self.format != 'auto' and self.format not in FORMATS:
+            raise ValueError(f"Unknown log format: {self.format}")
+        fields = set(FIELDS[self.format]) if self.format != 'auto' else {field for names in FIELDS.values() for field in names}
+
+        def check_field(field):
+            if field not in fields:
+                raise ValueError(f"Unknown field {field}, the fields are {', '.join(sorted(fields))}")
+            return field
+
+        self.filters = []
+        for entry in spec.get("filters", []):
+            if not isinstance(entry, list) or len(entry) != 3 or entry[1] not in OPERATORS or not isinstance(entry[2], (str, int)):
+                raise ValueError(f"Filters must be [field, op, value] with op one of {' '.join(OPERATORS)}: {entry}")
+            field, op, value = check_field(entry[0]), entry[1], entry[2]
+            if op == '~':
+                try:
+                    value = re.compile(str(value))
+                except re.error as e:
+                    raise ValueError(f"Not a valid regex for {field}: {value} ({e})")
+            elif field in NUMERIC_FIELDS:
+                try:
+                    value = int(value)
+                except ValueError:
+                    raise ValueError(f"{field} is compared as a number: {value}")
+            else:
+                value = str(value)
+            self.filters.append((field, op, value))
+        self.group_by = [check_field(field) for field in spec.get("group_by", [])]
+        self.metrics = []
+        for metric in spec.get("metrics", [["count"]]):
+            if not isinstance(metric, list) or not metric or metric[0] not in METRICS or len(metric) != (1 if metric[0] == 'count' else 2):
+                raise ValueError(f"Metrics must be [\"count\"], [\"min\", field] or [\"max\", field]: {metric}")
+            self.metrics.append((metric[0], check_field(metric[1]) if len(metric) == 2 else None))
+        self.spec = spec
+        self.groups = {}
+        self.matched = 0
+        self.unparsed = 0
+
+    def accepts(self, fields):
+        for field, op, value in self.filters:
+            actual = fields.get(field)
+            if actual is None:
+                return False
+            if op == '~':
+                if value.search(str(actual)) is None:
+                    return False
+            elif not ((op == '=' and actual == value) or (op == '!=' and actual != value) or
+                      (op == '<' and actual < value) or (op == '<=' and actual <= value) or
+                      (op == '>' and actual > value) or (op == '>=' and actual >= value)):
+                return False
+        return True
+
+    def add(self, line):
+        """
+        Adds one log line, given as bytes without its newline.
+        """
+        fields = parse_line(line, self.format)
+        if fields is None:
+            self.unparsed += 1
+            return
+        if not self.accepts(fields):
+            return
+        self.matched += 1
+        key = tuple(fields.get(field) for field in self.group_by)
+        values = self.groups.get(key)
+        if values is None:
+            if len(self.groups) >= MAX_GROUPS:
+                raise ValueError(f"More than {MAX_GROUPS} groups, group by fewer or coarser fields")
+            values = self.groups[key] = [0 if op == 'count' else None for op, _ in self.metrics]
+        for i, (op, field) in enumerate(self.metrics):
+            values[i] = combine(op, values[i], 1 if op == 'count' else fields.get(field))
+
+    def result(self):
+        """
+        Returns the partial result to merge elsewhere: (groups, matched, unparsed).
+        """
+        return self.groups, self.matched, self.unparsed
+
+    def merge(self, result):
+        """
+        Merges a partial result of the same spec, see result.
+        """
+        groups, matched, unparsed = result
+        for key, values in groups.items():
+            own = self.groups.get(key)
+            if own is None:
+                self.groups[key] = list(values)
+            else:
+                self.groups[key] = [combine(op, a, b) for (op, _), a, b in zip(self.metrics, own, values)]
+        self.matched += matched
+        self.unparsed += unparsed
+
+    def encode(self):
+        """
+        Returns the groups as a JSON list of [key, values] pairs, see decode_groups.
+        """
+        return [[list(key), values] for key, values in self.groups.items()]
+
+    def metric_names(self):
+        return [op if field is None else f"{op}({field})" for op, field in self.metrics]
+
+
+def decode_groups(groups):
+    """
+    Turns the groups of a trailer back into the dict of Aggregation.groups.
+    """
+    return {tuple(key): values for key, values in groups}
@@ -0,0 +1,278 @@
+import os
+import queue
+import logging
+import threading
+from search_engine import CHUNK_SIZE, read_line_blocks, scan_buffer
+from ngram_index import HEAD_SIZE
+
+log = logging.getLogger(__name__)
+
+# Seconds between two looks at the followed files. A look costs one stat per file, and only
+# the bytes appended since the previous look are read.
+POLL_INTERVAL = 1.0
+
+# Batches of matches a subscription may have waiting to be sent. A client that falls further
+# behind gets its subscription ended instead of holding up the tailer.
+OUTBOX_SIZE = 64
+
+
+class Subscription:
+    """
+    A query whose new matches are pushed to a client while the log files grow. The matches
+    are queued by the tailer and sent from the subscription's own thread, so a slow client
+    only holds up its own matches.
+
+    Attributes:
+        select (callable): Returns the paths of the files to follow, called at every poll so
+            files created later, e.g. by a rotation, are followed too.
+        regex (re.Pattern): The compiled query.
+        invert (bool): Whether the query is inverted (grep -v).
+        on_matches (callable): Called with (log_file, matches), matches being a list of
+            (line_number, line). line_number is None while the lines before the match are
+            not counted, see LogTailer.
+        files (dict): Matches sent per file.
+        error (Exception): What ended the subscription early, e.g. the client went away.
+        outbox (queue.Queue): (log_file, matches) waiting to be sent, None once it is ended.
+        sender (threading.Thread): Sends what is in the outbox.
+    """
+
+    def __init__(self, select, regex, invert, on_matches):
+        self.select = select
+        self.regex = regex
+        self.invert = invert
+        self.on_matches = on_matches
+        self.files = {}
+        self.error = None
+        self.outbox = queue.Queue(OUTBOX_SIZE)
+        self.sender = threading.Thread(target=self.send_all, daemon=True)
+
+    def send_all(self):
+        while True:
+            item = self.outbox.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue  # Ended, what is left is dropped
+            log_file, matches = item
+            try:
+                self.on_matches(log_file, matches)
+            except Exception as e:
+                self.error = e
+                continue
+            self.files[log_file] = self.files.get(log_file, 0) + len(matches)
+
+
+class FollowedFile:
+    """
+    A log file followed by the tailer. Files are followed by inode through an open file, so a
+    file renamed or deleted by a rotation is still read up to its last line.
+
+    Attributes:
+        path (str): The latest name of the file.
+        f (file): The open file.
+        identity (tuple): (st_dev, st_ino) of the file.
+        offset (int): Bytes read so far, always at the end of a line.
+        lines (int): Lines before offset, None if they are not counted.
+        head (bytes): The first (up to HEAD_SIZE) bytes read, to notice a file rewritten in place.
+        subscriptions (set): The subscriptions that follow the file.
+    """
+
+    def __init__(self, path, f, identity, offset=0, lines=0):
+        self.path = path
+        self.f = f
+        self.identity = identity
+        self.offset = offset
+        self.lines = lines
+        self.head = b''
+        self.subscriptions = set()
+
+
+class LogTailer:
+    """
+    Follows the log files of every subscription with one thread, polling their sizes.
+
+    The bytes appended to a file are read once per poll and matched for every subscription
+    that follows it, so the work is proportional to the new bytes, whatever the size of the
+    files and the number of subscriptions. A file that is truncated or rewritten in place
+    (its first bytes changed) is read again from its start. When a rotation renames a file,
+    the renamed file is read to its end and the new file at the old name from its start.
+
+    Subscriptions start at the end of the files without reading them, so the matches in a
+    file followed from its end only have line numbers if lines_at, called with (path,
+    identity, offset), knows the number of lines before the offset, e.g. from an index.
+    """
+
+    def __init__(self, interval=POLL_INTERVAL, block_size=CHUNK_SIZE, lines_at=None):
+        self.interval = interval
+        self.block_size = block_size
+        self.lines_at = lines_at
+        self.files = {}
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def subscribe(self, subscription):
+        """
+        Starts following the files of subscription from their current last line.
+
+        Raises:
+            OSError: If the files cannot be listed.
+        """
+        with self.lock:
+            for path in subscription.select():
+                try:
+                    followed = self.follow(path, at_end=True)
+                except OSError:
+                    continue  # Removed meanwhile
+                followed.subscriptions.add(subscription)
+            self.subscriptions.add(subscription)
+            subscription.sender.start()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def unsubscribe(self, subscription):
+        """
+        Stops following the files of subscription, and returns once the matches already
+        found are sent.
+        """
+        with self.lock:
+            self.subscriptions.discard(subscription)
+            for followed in self.files.values():
+                followed.subscriptions.discard(subscription)
+        subscription.outbox.put(None)
+        subscription.sender.join()
+
+    def follow(self, path, at_end=False):
+        """
+        Returns the FollowedFile of path, opening it at its start, or at the end of its last
+        complete line if at_end is set, if it is not followed yet.
+        """
+        stat = os.stat(path)
+        followed = self.files.get((stat.st_dev, stat.st_ino))
+        if followed is not None:
+            followed.path = path
+            return followed
+        f = open(path, 'rb')
+        followed = FollowedFile(path, f, (stat.st_dev, stat.st_ino))
+        if at_end:
+            followed.offset = last_line_end(f, os.fstat(f.fileno()).st_size, self.block_size)
+            followed.lines = self.count_lines(followed)
+            followed.head = os.pread(f.fileno(), min(followed.offset, HEAD_SIZE), 0)
+        self.files[followed.identity] = followed
+        return followed
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                log.error("Error while following the log files: %s", e)
+
+    def poll(self):
+        """
+        Reads what was appended to the followed files since the last poll and sends the new
+        matches. Files no subscription selects any more are read to their end and closed.
+        """
+        with self.lock:
+            selected = {}
+            for subscription in list(self.subscriptions):
+                if subscription.error is not None:
+                    # Its client went away
+                    self.end(subscription, subscription.error)
+                    continue
+                try:
+                    paths = subscription.select()
+                except OSError as e:
+                    self.end(subscription, e)
+                    continue
+                for path in paths:
+                    try:
+                        followed = self.follow(path)
+                    except OSError:
+                        continue
+                    selected.setdefault(followed.identity, set()).add(subscription)
+
+            for identity, followed in list(self.files.items()):
+                if identity in selected:
+                    # A subscription only gets the lines of the files it selects
+                    followed.subscriptions = selected[identity]
+                self.read_new_lines(followed)
+                if identity not in selected:
+                    followed.f.close()
+                    del self.files[identity]
+
+    def read_new_lines(self, followed):
+        try:
+            size = os.fstat(followed.f.fileno()).st_size
+            if size == followed.offset:
+                return
+            if size < followed.offset or os.pread(followed.f.fileno(), len(followed.head), 0) != followed.head:
+                # Truncated or rewritten in place (copytruncate), everything in it is new
+                followed.offset, followed.lines, followed.head = 0, 0, b''
+            if followed.lines is None:
+                followed.lines = self.count_lines(followed)
+            followed.f.seek(followed.offset)
+            for block in read_line_blocks(followed.f, self.block_size):
+                if not block.endswith(b'\n'):
+                    break  # A line that is still being written
+                for subscription in list(followed.subscriptions):
+                    self.send_matches(subscription, followed, block)
+                followed.offset += len(block)
+                if followed.lines is not None:
+                    followed.lines += block.count(b'\n')
+            if len(followed.head) < HEAD_SIZE:
+                followed.head = os.pread(followed.f.fileno(), min(followed.offset, HEAD_SIZE), 0)
+        except OSError as e:
+            log.warning("Could not read %s: %s", followed.path, e)
+
+    def send_matches(self, subscription, followed, block):
+        result, _ = scan_buffer(block, 0, len(block), subscription.regex, subscription.invert)
+        if not result:
+            return
+        lines = followed.lines
+        matches = [(lines + index + 1 if lines is not None else None, line.decode('utf-8', errors='replace'))
+                   for index, line in result]
+        try:
+            subscription.outbox.put_nowait((followed.path, matches))
+        except queue.Full:
+            self.end(subscription, OverflowError(f"More than {OUTBOX_SIZE} batches of matches were waiting to be sent"))
+
+    def count_lines(self, followed):
+        if self.lines_at is None:
+            return None
+        return self.lines_at(followed.path, followed.identity, followed.offset)
+
+    def end(self, subscription, error):
+        if subscription.error is None:
+            subscription.error = error
+        self.subscriptions.discard(subscription)
+        for followed in self.files.values():
+            followed.subscriptions.discard(subscription)
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            self.unsubscribe(subscription)
+        with self.lock:
+            for followed in self.files.values():
+                followed.f.close()
+            self.files.clear()
+
+
+def last_line_end(f, size, block_size=CHUNK_SIZE):
+    """
+    Returns the offset just after the last newline of f before size, 0 if there is none,
+    reading backwards from size one block at a time.
+    """
+    end = size
+    while end > 0:
+        start = max(end - block_size, 0)
+        i = os.pread(f.fileno(), end - start, start).rfind(b'\n')
+        if i >= 0:
+            return start + i + 1
+        end = start
+    return 0
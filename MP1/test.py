@@ -1,5 +1,25 @@
+import os
+import time
+import logging
+import gzip
+import socket
+import asyncio
+import tempfile
+import threading
 import unittest
 from client import send_query_to_server
+from server import GrepServer, execute_grep_on_logs, execute_search_on_logs, iter_grep_on_logs, format_results, list_log_files
+from search_engine import SearchEngine, parse_query, time_left
+from result_cache import ResultCache
+from ngram_index import NgramIndex
+from time_index import TimeIndex, parse_time_range
+from structured import Aggregation
+from tail import LogTailer, Subscription
+from fanout import FanOut, OK, TIMEOUT as DEADLINE_PASSED, UNREACHABLE
+from generate_random_log import generate
+from metrics import Histogram, RateLimitFilter, SECONDS_BUCKETS
+from metrics import BUSY, TIMEOUT, CANCELLED
+from protocol import QUERY, MATCHES, TRAILER, ERROR, PING, COMPRESSED, Compressor, Decompressor, encode_frame, recv_frame, send_frame
 
 class TestQueryResponses(unittest.TestCase):
     """
@@ -39,5 +59,596 @@ class TestQueryResponses(unittest.TestCase):
         expected_match = 32093
         self.assertEqual(total_match, expected_match)
 
+class TestSearchEngine(unittest.TestCase):
+    """
+    Checks that the in-process search engine agrees with the grep path on local files.
+    """
+
+    def setUp(self):
+        self.log_directory = tempfile.mkdtemp()
+        with open(os.path.join(self.log_directory, 'vm1.log'), 'w') as f:
+            for i in range(5000):
+                level = ['INFO', 'DEBUG', 'WARNING', 'ERROR'][i % 4]
+                f.write(f"2024-09-15 12:00:00 - {level} - request {i} from 10.0.{i % 7}.{i % 13}\n")
+        with open(os.path.join(self.log_directory, 'vm2.log'), 'w') as f:
+            f.write("ERROR without newline at the end")
+        # Small chunks so that vm1.log is split across several workers
+        self.engine = SearchEngine(workers=2, chunk_size=4096)
+
+    def tearDown(self):
+        self.engine.close()
+        for name in os.listdir(self.log_directory):
+            os.remove(os.path.join(self.log_directory, name))
+        os.rmdir(self.log_directory)
+
+    def test_same_matches_as_grep(self):
+        """
+        Tests that both paths return the same matching lines and TOTAL_MATCHES.
+        """
+        queries = ['grep -n ERROR', 'grep -n -i "error - request 1"', 'grep -n -E "10\\.0\\.[0-3]\\.1[0-2]$"',
+                   'grep -n -v INFO', 'grep -n -F "request 4999"', 'grep -n "request \\(12\\)\\{1,2\\}"']
+        for query in queries:
+            grep_result, grep_matches = execute_grep_on_logs(query, self.log_directory)
+            engine_result, engine_matches = execute_search_on_logs(query, self.log_directory, self.engine)
+            self.assertEqual(engine_matches, grep_matches, query)
+            self.assertEqual(sorted(engine_result.split('File: ')), sorted(grep_result.split('File: ')), query)
+
+    def test_cached_results_after_append(self):
+        """
+        Tests that a cached query still agrees with grep after the logs were appended to.
+        """
+        self.engine.cache = ResultCache()
+        query = 'grep -n ERROR'
+        execute_search_on_logs(query, self.log_directory, self.engine)
+        with open(os.path.join(self.log_directory, 'vm1.log'), 'a') as f:
+            f.write("2024-09-15 12:00:01 - ERROR - appended\n")
+        with open(os.path.join(self.log_directory, 'vm2.log'), 'a') as f:
+            f.write(" and ERROR appended\n")
+        grep_result, grep_matches = execute_grep_on_logs(query, self.log_directory)
+        engine_result, engine_matches = execute_search_on_logs(query, self.log_directory, self.engine)
+        self.assertEqual(engine_matches, grep_matches)
+        self.assertEqual(sorted(engine_result.split('File: ')), sorted(grep_result.split('File: ')))
+        self.assertEqual(self.engine.cache.partial_hits, 2)
+
+    def test_ngram_index(self):
+        """
+        Tests that the trigram index skips blocks without losing a match, while the log grows,
+        is rotated and is rewritten in place, and that it is stored and read back.
+        """
+        log_file = os.path.join(self.log_directory, 'vm1.log')
+        index_dir = os.path.join(self.log_directory, 'index')
+        index = NgramIndex(index_dir, self.engine.pool, block_size=4096, chunk_size=self.engine.chunk_size)
+        queries = ['grep -n ERROR', 'grep -n -E "request (12|4999) from"', 'grep -n -i "error - request 1"',
+                   'grep -n -v INFO', 'grep -n -F "from 10.0.3.5"', 'grep -n "appended\\|rewritten"', 'grep -n "no such line"']
+
+        def assert_same_matches():
+            for query in queries:
+                self.engine.index = None
+                expected = format_results(self.engine.iter_search(query, [log_file]))
+                self.engine.index = index
+                self.assertEqual(format_results(self.engine.iter_search(query, [log_file])), expected, query)
+
+        try:
+            index.refresh(log_file)
+            stored = index.load(log_file)
+            self.assertGreater(len(stored.blocks), 10)
+            self.assertEqual(index.candidate_ranges(log_file, os.path.getsize(log_file), index.plan('no such line', 0)), [])
+            assert_same_matches()
+
+            # Appended to: searched past the index until it is extended
+            with open(log_file, 'a') as f:
+                f.write("2024-09-15 12:00:01 - ERROR - appended\n2024-09-15 12:00:01 - INFO - still being wr")
+            assert_same_matches()
+            index.refresh(log_file)
+            appended = index.load(log_file)
+            self.assertEqual((appended.identity, appended.lines), (stored.identity, 5001))
+            self.assertEqual(appended.blocks[:len(stored.blocks)], stored.blocks)
+            assert_same_matches()
+
+            # Read back from its files
+            loaded = NgramIndex(index_dir, self.engine.pool, block_size=4096).load(log_file)
+            self.assertEqual((loaded.size, loaded.lines, loaded.blocks), (appended.size, appended.lines, appended.blocks))
+            self.assertEqual(loaded.bitmaps[:], appended.bitmaps[:])
+
+            # Rotated: a new file under the same name
+            os.rename(log_file, log_file + '.1')
+            with open(log_file, 'w') as f:
+                for i in range(3000):
+                    f.write(f"2024-09-15 13:00:00 - {['INFO', 'ERROR'][i % 2]} - request {i} appended\n")
+            index.refresh(log_file)
+            self.assertEqual(index.load(log_file).lines, 3000)
+            assert_same_matches()
+
+            # Rewritten in place, same inode and a larger size
+            with open(log_file, 'w') as f:
+                for i in range(4000):
+                    f.write(f"2024-09-15 14:00:00 - {['WARNING', 'ERROR'][i % 2]} - request {i} rewritten from 10.0.3.5\n")
+            assert_same_matches()
+            index.refresh(log_file)
+            self.assertEqual(index.load(log_file).lines, 4000)
+            assert_same_matches()
+        finally:
+            self.engine.index = None
+            index.close()
+            for name in os.listdir(index_dir):
+                os.remove(os.path.join(index_dir, name))
+            os.rmdir(index_dir)
+
+    def test_compressed_archives(self):
+        """
+        Tests that zgrep and the engine agree on a gzip archive selected with a glob pattern.
+        """
+        with open(os.path.join(self.log_directory, 'vm1.log'), 'rb') as f, \
+                gzip.open(os.path.join(self.log_directory, 'vm1.log.1.gz'), 'wb') as archive:
+            archive.write(f.read())
+        log_files = list_log_files(self.log_directory, 'vm1.log*')
+        self.assertEqual(len(log_files), 2)
+        for query in ['grep -n ERROR', 'grep -n -v INFO']:
+            grep_result = format_results(iter_grep_on_logs(query, self.log_directory, log_files=log_files))
+            engine_result = format_results(self.engine.iter_search(query, log_files))
+            self.assertEqual(engine_result, grep_result, query)
+
+    def test_time_range(self):
+        """
+        Tests that grep and the engine search the same lines of a time range, found with the time index.
+        """
+        log_file = os.path.join(self.log_directory, 'vm3.log')
+        with open(log_file, 'w') as f:
+            for i in range(5000):
+                f.write(f"2024-09-15 {12 + i // 3600}:{i // 60 % 60:02d}:{i % 60:02d} - {['INFO', 'ERROR'][i % 2]} - request {i}\n")
+        time_index = TimeIndex(interval=1024)
+        self.engine.time_index = time_index
+        for time_range in [('2024-09-15 12:10:00', '2024-09-15 12:20:30'), ('2024-09-15 13:20:00', None), (None, '2024-09-15 11:00:00')]:
+            time_range = parse_time_range(list(time_range))
+            grep_result = format_results(iter_grep_on_logs('grep -n ERROR', self.log_directory, log_files=[log_file],
+                                                           time_range=time_range, time_index=time_index))
+            engine_result = format_results(self.engine.iter_search('grep -n ERROR', [log_file], time_range=time_range))
+            self.assertEqual(engine_result, grep_result, time_range)
+        self.assertEqual(grep_result[1], 0)
+        self.assertEqual(engine_result[1], 0)
+
+    def test_aggregate(self):
+        """
+        Tests that the engine's per-chunk aggregates merge into the aggregate of the lines grep finds.
+        """
+        spec = {"group_by": ["level"], "filters": [["message", "~", "from 10\\.0\\.[12]\\."]],
+                "metrics": [["count"], ["max", "message"]]}
+        log_files = list_log_files(self.log_directory)
+        expected = Aggregation(spec)
+        for _, matches, _ in iter_grep_on_logs('grep -v DEBUG', self.log_directory, log_files=log_files, line_numbers=True):
+            for _, line in matches:
+                expected.add(line.encode('utf-8'))
+        aggregation, files, errors = self.engine.aggregate('grep -v DEBUG', log_files, spec)
+        self.assertEqual(aggregation.groups, expected.groups)
+        self.assertEqual(sorted(aggregation.groups), [('ERROR',), ('INFO',), ('WARNING',)])
+        self.assertEqual((sum(files.values()), aggregation.unparsed), (expected.matched, 1))
+        with self.assertRaises(ValueError):
+            Aggregation({"filters": [["message", "~", "["]]})
+
+    def test_pattern_batch(self):
+        """
+        Tests that a batch of queries searched in one pass finds what grep finds for each of them.
+        """
+        queries = ['grep -n ERROR', 'grep -n -i "request 12"', 'grep -n -v "10\\.0\\.1\\."', 'grep -n "\\(4\\)\\1"']
+        log_files = list_log_files(self.log_directory)
+        found = [{} for _ in queries]
+        for log_file, matches, error in self.engine.iter_search_patterns(queries, log_files):
+            self.assertIsNone(error)
+            for line_number, line, hits in matches:
+                for i in hits:
+                    found[i].setdefault(log_file, []).append((line_number, line))
+        for i, query in enumerate(queries):
+            expected = {log_file: matches for log_file, matches, _ in self.engine.search(query, log_files) if matches}
+            self.assertEqual(found[i], expected, query)
+            grep_result, grep_matches = execute_grep_on_logs(query, self.log_directory)
+            self.assertEqual(sum(len(matches) for matches in found[i].values()), grep_matches, query)
+
+    def test_follow_appended_lines(self):
+        """
+        Tests that a subscription gets only the lines appended after it started, across a rotation,
+        numbered from the time index, and without line numbers until a rotation if no index counts them.
+        """
+        log_file = os.path.join(self.log_directory, 'vm1.log')
+        time_index = TimeIndex()
+        time_index.update(log_file, os.stat(log_file))
+        received, unnumbered = [], []
+        tailer = LogTailer(lines_at=time_index.lines_at)
+        uncounted = LogTailer()
+        uncounted.subscribe(Subscription(lambda: [log_file], parse_query('grep ERROR').compile(), False,
+                                         lambda path, matches: unnumbered.extend(match[0] for match in matches)))
+        tailer.subscribe(Subscription(lambda: list_log_files(self.log_directory), parse_query('grep ERROR').compile(), False,
+                                      lambda path, matches: received.extend((os.path.basename(path), *match) for match in matches)))
+        try:
+            with open(log_file, 'a') as f:
+                f.write("2024-09-15 12:00:01 - ERROR - appended\n2024-09-15 12:00:01 - ERROR - still being wr")
+            tailer.poll()
+            uncounted.poll()
+            os.rename(log_file, log_file + '.1')
+            with open(log_file + '.1', 'a') as f:
+                f.write("itten\n")
+            with open(log_file, 'w') as f:
+                f.write("2024-09-15 12:00:02 - ERROR - after the rotation\n")
+            tailer.poll()
+            uncounted.poll()
+        finally:
+            tailer.close()
+            uncounted.close()
+        self.assertEqual(received, [('vm1.log', 5001, "2024-09-15 12:00:01 - ERROR - appended"),
+                                    ('vm1.log', 5002, "2024-09-15 12:00:01 - ERROR - still being written"),
+                                    ('vm1.log', 1, "2024-09-15 12:00:02 - ERROR - after the rotation")])
+        self.assertEqual(unnumbered, [None, None, 1])
+
+    def test_generated_logs(self):
+        """
+        Tests that the generator writes the same files with any number of workers, with ordered
+        timestamps and the level and marker counts of its manifest.
+        """
+        manifest = generate(self.log_directory, shards=2, size_mb=0.5, markers={'NEEDLE': 7}, workers=1, seed=1)
+        with open(os.path.join(self.log_directory, 'vm2.log'), 'rb') as f:
+            data = f.read()
+        generate(self.log_directory, shards=2, size_mb=0.5, markers={'NEEDLE': 7}, workers=2, seed=1)
+        with open(os.path.join(self.log_directory, 'vm2.log'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+        timestamps = [line[:19] for line in data.splitlines()]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertEqual(len(timestamps), manifest["files"][1]["lines"])
+        _, matches = execute_grep_on_logs('grep -n NEEDLE', self.log_directory)
+        self.assertEqual(matches, 14)
+        _, matches = execute_grep_on_logs('grep -n " - ERROR - "', self.log_directory)
+        self.assertEqual(matches, sum(entry["levels"]["ERROR"] for entry in manifest["files"]))
+
+class TestProtocol(unittest.TestCase):
+    """
+    Checks that frames are decoded correctly however the bytes are split on the wire.
+    """
+
+    def test_frames_split_across_sends(self):
+        """
+        Tests frames sent one byte at a time, with a multibyte character and an EOF inside a line.
+        """
+        lines = [[1, "EOF reached in r\u00e9sum\u00e9 upload"], [7, "TOTAL_MATCHES:3"]]
+        data = (encode_frame(MATCHES, {"file": "vm1.log", "lines": lines}) +
+                encode_frame(TRAILER, {"files": {"vm1.log": 2}, "errors": {}, "total_matches": 2}))
+        sender, receiver = socket.socketpair()
+
+        def send_slowly():
+            for i in range(len(data)):
+                sender.send(data[i:i + 1])
+            sender.close()
+
+        thread = threading.Thread(target=send_slowly)
+        thread.start()
+        try:
+            self.assertEqual(recv_frame(receiver), (MATCHES, 0, {"file": "vm1.log", "lines": lines}))
+            self.assertEqual(recv_frame(receiver)[2]["total_matches"], 2)
+            self.assertIsNone(recv_frame(receiver))
+        finally:
+            thread.join()
+            receiver.close()
+
+    def test_compressed_frames(self):
+        """
+        Tests that compressed frames share one stream and come out as they went in, between plain frames.
+        """
+        batches = [[[i * 10 + j, f"2024-09-15 12:00:00 - ERROR - request {i} {j}"] for j in range(10)] for i in range(3)]
+        compressor = Compressor()
+        data = b''.join(encode_frame(MATCHES, {"file": "vm1.log", "lines": lines}, compressor=compressor) for lines in batches)
+        data += encode_frame(TRAILER, {"total_matches": 30})
+        sender, receiver = socket.socketpair()
+        try:
+            sender.sendall(data)
+            sender.close()
+            decompressor = Decompressor()
+            for lines in batches:
+                self.assertEqual(recv_frame(receiver, decompressor), (MATCHES, COMPRESSED, {"file": "vm1.log", "lines": lines}))
+            self.assertEqual(recv_frame(receiver, decompressor), (TRAILER, 0, {"total_matches": 30}))
+        finally:
+            receiver.close()
+
+class SlowServer(GrepServer):
+    """
+    A grep server that waits delay seconds before each file it searches, like one on an
+    overloaded VM. The wait ends early with QueryTimeout once the query's deadline passes, or
+    QueryCancelled once it is cancelled.
+    """
+
+    def __init__(self, log_directory, delay, **options):
+        super().__init__(log_directory, **options)
+        self.delay = delay
+
+    def iter_results(self, query, log_files, deadline, limit=None, time_range=None):
+        for result in super().iter_results(query, log_files, deadline, limit, time_range):
+            end = time.monotonic() + self.delay
+            while time.monotonic() < end:
+                time_left(deadline)
+                time.sleep(0.01)
+            yield result
+
+def connect(server):
+    """
+    Returns a socket connected to server, which handles it in a thread of its own.
+    """
+    client_socket, server_socket = socket.socketpair()
+    threading.Thread(target=server.handle_client, args=(server_socket,), daemon=True).start()
+    return client_socket
+
+def ask(client_socket, request):
+    """
+    Sends a query and returns the frames of the response up to its TRAILER or ERROR.
+    """
+    send_frame(client_socket, QUERY, request)
+    frames = []
+    while not frames or frames[-1][0] not in (TRAILER, ERROR):
+        frames.append(recv_frame(client_socket))
+    return [(frame_type, payload) for frame_type, _, payload in frames]
+
+def serve(server):
+    """
+    Accepts connections for server on a free local port, each handled in a thread of its own.
+
+    Returns:
+        socket.socket: The listening socket, shut it down to stop accepting.
+    """
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def accept():
+        while True:
+            try:
+                client_socket, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=server.handle_client, args=(client_socket,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener
+
+class TestGrepServer(unittest.TestCase):
+    """
+    Checks the answers of in-process grep servers, with both engines, over a socket pair.
+    """
+
+    def setUp(self):
+        self.log_directory = tempfile.mkdtemp()
+        for name in ('vm1.log', 'vm2.log'):
+            with open(os.path.join(self.log_directory, name), 'w') as f:
+                for i in range(2000):
+                    level = ['INFO', 'DEBUG', 'WARNING', 'ERROR'][i % 4]
+                    f.write(f"2024-09-15 12:00:00 - {level} - request {i} from {name}\n")
+        self.engine = SearchEngine(workers=2, chunk_size=4096)
+        self.sockets = []
+
+    def tearDown(self):
+        for client_socket in self.sockets:
+            client_socket.close()
+        self.engine.close()
+        for name in os.listdir(self.log_directory):
+            os.remove(os.path.join(self.log_directory, name))
+        os.rmdir(self.log_directory)
+
+    def connect(self, server):
+        client_socket = connect(server)
+        self.sockets.append(client_socket)
+        return client_socket
+
+    def test_busy_without_a_free_slot(self):
+        """
+        Tests that a query that cannot get a slot within query_timeout is answered as busy, and
+        that the next one runs once the slot is free again.
+        """
+        server = GrepServer(self.log_directory, max_concurrency=1, query_timeout=0.2)
+        client_socket = self.connect(server)
+        server.query_slots.acquire()
+        start = time.monotonic()
+        frames = ask(client_socket, {"query": "grep ERROR"})
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(frames[-1][0], ERROR)
+        self.assertIn("busy", frames[-1][1]["message"])
+        server.query_slots.release()
+        self.assertEqual(ask(client_socket, {"query": "grep ERROR"})[-1][1]["total_matches"], 1000)
+        self.assertEqual(server.metrics.snapshot()["statuses"][BUSY], 1)
+
+    def test_payload_not_an_object(self):
+        """
+        Tests that a frame whose payload is JSON but not an object is answered with an error
+        that ends the connection.
+        """
+        client_socket = self.connect(GrepServer(self.log_directory))
+        frames = ask(client_socket, [1])
+        self.assertEqual(frames, [(ERROR, {"message": "Expected a JSON object as the payload"})])
+        self.assertIsNone(recv_frame(client_socket))
+
+    def test_query_timeout(self):
+        """
+        Tests that a query running past query_timeout is answered with an error and gives its
+        slot back, so the next query gets to run (and time out) instead of being busy.
+        """
+        server = SlowServer(self.log_directory, 1, max_concurrency=1, query_timeout=0.3)
+        client_socket = self.connect(server)
+        for _ in range(2):
+            start = time.monotonic()
+            frames = ask(client_socket, {"query": "grep ERROR"})
+            self.assertLess(time.monotonic() - start, 1)
+            self.assertEqual(frames, [(ERROR, {"message": "Query timed out after 0.3s"})])
+        # Queries without an id are recorded before the next frame is read
+        send_frame(client_socket, PING, {})
+        recv_frame(client_socket)
+        self.assertEqual(server.metrics.snapshot()["statuses"][TIMEOUT], 2)
+
+    def test_query_modes(self):
+        """
+        Tests the count, first and sample modes against the lines grep finds, with both engines.
+        """
+        expected = {}
+        for log_file, matches, _ in iter_grep_on_logs('grep -n ERROR', self.log_directory):
+            expected[log_file] = [tuple(match) for match in matches]
+        all_matches = {(name, *match) for name, matches in expected.items() for match in matches}
+        for engine in (None, self.engine):
+            client_socket = self.connect(GrepServer(self.log_directory, engine))
+
+            frames = ask(client_socket, {"query": "grep -n ERROR", "mode": "count"})
+            self.assertEqual([frame_type for frame_type, _ in frames], [TRAILER])
+            self.assertEqual(frames[0][1]["total_matches"], len(all_matches))
+
+            frames = ask(client_socket, {"query": "grep -n ERROR", "mode": "first", "limit": 10})
+            lines = [(payload["file"], *line) for frame_type, payload in frames if frame_type == MATCHES
+                     for line in payload["lines"]]
+            self.assertEqual(len(lines), 10)
+            name = lines[0][0]
+            self.assertEqual(lines, [(name, *match) for match in expected[name][:10]])
+            self.assertTrue(frames[-1][1]["limit_reached"])
+
+            for seed in (1, 2):
+                frames = ask(client_socket, {"query": "grep -n ERROR", "mode": "sample", "limit": 50, "seed": seed})
+                lines = [(payload["file"], *line) for frame_type, payload in frames if frame_type == MATCHES
+                         for line in payload["lines"]]
+                self.assertEqual(len(set(lines)), 50)
+                self.assertLessEqual(set(lines), all_matches)
+                self.assertEqual((frames[-1][1]["total_matches"], frames[-1][1]["sampled"]), (len(all_matches), 50))
+
+            for limit in (0, True, "10", None):
+                frames = ask(client_socket, {"query": "grep -n ERROR", "mode": "first", "limit": limit})
+                self.assertEqual(frames, [(ERROR, {"message": "Mode first needs a positive limit"})], limit)
+
+class TestFanOut(unittest.TestCase):
+    """
+    Checks deadlines, hedging and failover of fan-out queries to in-process grep servers.
+    """
+
+    def setUp(self):
+        self.log_directory = tempfile.mkdtemp()
+        for name in ('vm1.log', 'vm2.log'):
+            with open(os.path.join(self.log_directory, name), 'w') as f:
+                for i in range(2000):
+                    f.write(f"2024-09-15 12:00:00 - {['INFO', 'ERROR'][i % 2]} - request {i} from {name}\n")
+        self.listeners = []
+        # A server that waits a second before each file, and replicas of it that do not
+        self.slow_server = SlowServer(self.log_directory, 1)
+        self.slow = self.serve(self.slow_server)
+        self.fast = self.serve(GrepServer(self.log_directory))
+        self.replica = self.serve(GrepServer(self.log_directory))
+        # Nothing listens there
+        with socket.create_server(('127.0.0.1', 0)) as listener:
+            self.down = listener.getsockname()
+
+    def tearDown(self):
+        for listener in self.listeners:
+            listener.shutdown(socket.SHUT_RDWR)
+            listener.close()
+        for name in os.listdir(self.log_directory):
+            os.remove(os.path.join(self.log_directory, name))
+        os.rmdir(self.log_directory)
+
+    def serve(self, server):
+        listener = serve(server)
+        self.listeners.append(listener)
+        return listener.getsockname()
+
+    def query(self, servers, replicas=None, hedge_after=None, deadline=None):
+        async def run():
+            fanout = FanOut(servers, replicas, connect_timeout=1, hedge_after=hedge_after)
+            try:
+                return await fanout.query('grep -n ERROR', deadline=deadline)
+            finally:
+                fanout.close()
+
+        start = time.monotonic()
+        results = asyncio.run(run())
+        return results, time.monotonic() - start
+
+    def test_deadline_with_partial_results(self):
+        """
+        Tests that the query ends at the deadline with the status of every server, and the
+        matches the slow server sent before it.
+        """
+        results, elapsed = self.query([self.fast, self.slow, self.down], deadline=1.5)
+        self.assertLess(elapsed, 1.9)
+        self.assertEqual([result.status for result in results.values()], [OK, DEADLINE_PASSED, UNREACHABLE])
+        fast, slow, down = results.values()
+        self.assertEqual((fast.total_matches, fast.answered_by), (2000, self.fast))
+        # The first file arrived after a second, the second one would have after two
+        self.assertEqual((len(slow.files), slow.total_matches, slow.trailer), (1, 1000, None))
+        self.assertEqual((down.answered_by, down.total_matches), (None, 0))
+
+    def test_hedge_to_replica(self):
+        """
+        Tests that a server that has not answered after hedge_after gets its replica asked as
+        well, whose answer is used.
+        """
+        results, elapsed = self.query([self.slow], {self.slow: [self.replica]}, hedge_after=0.2, deadline=10)
+        result = results[self.slow]
+        self.assertLess(elapsed, 1)
+        self.assertEqual((result.status, result.answered_by, result.hedged), (OK, self.replica, True))
+        self.assertEqual(result.total_matches, 2000)
+
+    def test_failover_to_replica(self):
+        """
+        Tests that a server that cannot be reached is replaced by its next reachable replica
+        right away, without waiting to hedge.
+        """
+        results, elapsed = self.query([self.down, self.fast], {self.down: [self.down, self.replica]},
+                                      hedge_after=5, deadline=10)
+        self.assertLess(elapsed, 1)
+        down, fast = results.values()
+        self.assertEqual((down.status, down.answered_by, down.hedged, down.total_matches), (OK, self.replica, False, 2000))
+        self.assertEqual((fast.status, fast.answered_by), (OK, self.fast))
+
+    def test_abandoned_queries_cancelled(self):
+        """
+        Tests that the server stops the queries the client gave up on, a hedge that lost and a
+        query past its deadline, while the connection stays open.
+        """
+        async def run():
+            hedging = FanOut([self.slow], {self.slow: [self.replica]}, hedge_after=0.2)
+            waiting = FanOut([self.slow])
+            try:
+                hedged = await hedging.query('grep -n ERROR', deadline=10)
+                late = await waiting.query('grep -n ERROR', deadline=0.5)
+                # Both would take two seconds to run to their end
+                for _ in range(100):
+                    if self.slow_server.metrics.snapshot()["statuses"].get(CANCELLED) == 2:
+                        break
+                    await asyncio.sleep(0.01)
+                return hedged[self.slow], late[self.slow], self.slow_server.metrics.snapshot()["statuses"]
+            finally:
+                hedging.close()
+                waiting.close()
+
+        start = time.monotonic()
+        hedged, late, statuses = asyncio.run(run())
+        self.assertLess(time.monotonic() - start, 1.9)
+        self.assertEqual((hedged.status, hedged.answered_by, late.status), (OK, self.replica, DEADLINE_PASSED))
+        self.assertEqual(statuses, {CANCELLED: 2})
+
+class TestMetrics(unittest.TestCase):
+    """
+    Checks the histograms and the rate limit of the server's log.
+    """
+
+    def test_histogram_quantiles(self):
+        """
+        Tests that the quantiles fall in the bucket of the exact value and never exceed the maximum.
+        """
+        histogram = Histogram(SECONDS_BUCKETS)
+        for i in range(1, 1001):
+            histogram.observe(i / 1000)
+        for q in (0.5, 0.95, 0.99):
+            bound = histogram.quantile(q)
+            self.assertGreaterEqual(bound, q)
+            self.assertLessEqual(bound, min(2 * q, 1.0))
+        self.assertEqual(histogram.quantile(1.0), 1.0)
+        self.assertEqual(sum(count for _, count in histogram.snapshot()["buckets"]), 1000)
+
+    def test_rate_limited_log(self):
+        """
+        Tests that repeated messages are dropped past the rate and counted in the next one let through.
+        """
+        rate_limit = RateLimitFilter(rate=3, interval=0.2)
+        records = [logging.LogRecord('server', logging.INFO, __file__, 1, "Query %s", ('q',), None) for _ in range(10)]
+        self.assertEqual([rate_limit.filter(record) for record in records], [True] * 3 + [False] * 7)
+        time.sleep(0.25)
+        record = logging.LogRecord('server', logging.INFO, __file__, 1, "Query %s", ('q',), None)
+        self.assertTrue(rate_limit.filter(record))
+        self.assertEqual(record.getMessage(), "Query q (7 similar messages dropped)")
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,206 @@
+import os
+import re
+import bisect
+import threading
+from search_engine import CHUNK_SIZE, TIMESTAMP, find_time, read_line_blocks, iter_blocks, is_compressed
+from ngram_index import file_head
+
+# A file gets one index entry about every INTERVAL bytes, so finding where a time
+# range starts or ends reads at most about INTERVAL bytes after a binary search.
+INTERVAL = 64 * 1024
+
+TIME_FORMAT = re.compile(r'^(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})$')
+
+
+def parse_time_range(value):
+    """
+    Validates the "time_range" of a query: [start, end] with "YYYY-MM-DD HH:MM:SS" timestamps,
+    either of which may be null for an open end.
+
+    Returns:
+        tuple: (start, end) as bytes in the log format, or None if the range is open on both ends.
+
+    Raises:
+        ValueError: If the range is not valid.
+    """
+    if value is None:
+        return None
+    if not isinstance(value, list) or len(value) != 2:
+        raise ValueError(f"time_range must be a [start, end] pair: {value}")
+    bounds = []
+    for bound in value:
+        if bound is None:
+            bounds.append(None)
+            continue
+        m = TIME_FORMAT.match(bound) if isinstance(bound, str) else None
+        if m is None:
+            raise ValueError(f"time_range bounds must look like 2024-09-15 12:00:00: {bound}")
+        bounds.append(f"{m.group(1)} {m.group(2)}".encode('ascii'))
+    if bounds == [None, None]:
+        return None
+    return tuple(bounds)
+
+
+class FileTimes:
+    """
+    The sparse time index of one log file.
+
+    Attributes:
+        identity (tuple): (st_dev, st_ino) of the indexed file.
+        head (tuple): Length and digest of the first bytes, see ngram_index.file_head.
+        size (int): Bytes indexed so far, always at the end of a line.
+        lines (int): Lines indexed so far.
+        times (list): Timestamp of every entry, as bytes in the log format.
+        offsets (list): Offset of the timestamped line of every entry.
+        line_numbers (list): Number of lines before the line of every entry.
+    """
+
+    def __init__(self, identity, head):
+        self.identity = identity
+        self.head = head
+        self.size = 0
+        self.lines = 0
+        self.times = []
+        self.offsets = []
+        self.line_numbers = []
+
+
+class TimeIndex:
+    """
+    Keeps a sparse timestamp -> byte offset index of every plain log file queried with a
+    time range, so the scan can start and stop at the edges of the range.
+
+    A file's index is built at its first time range query and extended with the lines
+    appended since, at every later one; a rotated file gets a new index. Files are
+    assumed to be in time order, like the logs written by generate_random_log.py and MP2.
+    """
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def update(self, path, stat):
+        """
+        Returns the index of path, extended to the last complete line of the file.
+        """
+        with self.lock:
+            current = self.files.get(path)
+        if (current is None or current.identity != (stat.st_dev, stat.st_ino) or stat.st_size < current.size or
+                file_head(path, current.head[0]) != current.head):
+            current = FileTimes((stat.st_dev, stat.st_ino), file_head(path))
+        if stat.st_size == current.size:
+            return current
+
+        # Extend a copy, so concurrent queries never see a half-updated index
+        index = FileTimes(current.identity, current.head)
+        index.times, index.offsets, index.line_numbers = list(current.times), list(current.offsets), list(current.line_numbers)
+        offset, line = current.size, current.lines
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for block in read_line_blocks(f):
+                if offset + len(block) > stat.st_size or not block.endswith(b'\n'):
+                    break  # A line that is still being written
+                counted, counted_lines = 0, line
+                target = max(index.offsets[-1] + self.interval - offset, 0) if index.offsets else 0
+                while target < len(block):
+                    # The next timestamped line from target on
+                    line_start = block.rfind(b'\n', 0, target) + 1
+                    m = TIMESTAMP.search(block, line_start if line_start == target else block.find(b'\n', target) + 1)
+                    if m is None:
+                        break
+                    counted_lines += block.count(b'\n', counted, m.start())
+                    counted = m.start()
+                    index.times.append(m.group(1) + b' ' + m.group(2))
+                    index.offsets.append(offset + m.start())
+                    index.line_numbers.append(counted_lines)
+                    target = m.start() + self.interval
+                offset += len(block)
+                line += block.count(b'\n')
+        index.size, index.lines = offset, line
+        with self.lock:
+            self.files[path] = index
+        return index
+
+    def locate(self, path, index, timestamp, after=False):
+        """
+        Finds the first line at or after timestamp (strictly after if after is set).
+
+        Returns:
+            tuple: (offset, line_number) of that line, or of the end of the file.
+        """
+        # Binary search for the last entry before the line, then read forward from there
+        i = (bisect.bisect_right if after else bisect.bisect_left)(index.times, timestamp)
+        offset, line = (index.offsets[i - 1], index.line_numbers[i - 1]) if i > 0 else (0, 0)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for block in read_line_blocks(f, self.interval):
+                if i < len(index.offsets) and offset >= index.offsets[i]:
+                    break
+                pos = find_time(block, timestamp, after)
+                if pos is not None:
+                    return offset + pos, line + block.count(b'\n', 0, pos)
+                offset += len(block)
+                line += block.count(b'\n')
+        if i < len(index.offsets):
+            return index.offsets[i], index.line_numbers[i]
+        return offset, line
+
+    def lines_at(self, path, identity, offset):
+        """
+        Returns the number of lines before offset in the file identity at path, counted from
+        the entry before offset, or None if offset is past the index of that file.
+        """
+        with self.lock:
+            index = self.files.get(path)
+        if index is None or index.identity != identity or offset > index.size:
+            return None
+        if offset == index.size:
+            return index.lines
+        i = bisect.bisect_right(index.offsets, offset)
+        start, line = (index.offsets[i - 1], index.line_numbers[i - 1]) if i > 0 else (0, 0)
+        with open(path, 'rb') as f:
+            return line + os.pread(f.fileno(), offset - start, start).count(b'\n')
+
+    def window(self, path, stat, time_range):
+        """
+        Returns the part of a plain file that holds the lines of time_range.
+
+        Returns:
+            tuple: (start, end, first_line), the byte range and the number of lines before it.
+        """
+        index = self.update(path, stat)
+        start_time, end_time = time_range
+        start, first_line = self.locate(path, index, start_time) if start_time is not None else (0, 0)
+        end = self.locate(path, index, end_time, after=True)[0] if end_time is not None else stat.st_size
+        return start, max(start, min(end, stat.st_size)), first_line
+
+    def iter_window(self, path, time_range, block_size=CHUNK_SIZE):
+        """
+        Reads the lines of time_range from a plain or compressed file, seeking straight to
+        them in plain files.
+
+        Yields:
+            tuple: (first_line, block) like search_engine.iter_blocks.
+        """
+        if is_compressed(path):
+            yield from iter_blocks(path, time_range, block_size)
+            return
+        start, end, line = self.window(path, os.stat(path), time_range)
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            carry = b''
+            while remaining > 0:
+                data = f.read(min(block_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                buf = carry + data
+                cut = buf.rfind(b'\n') + 1 if remaining > 0 else len(buf)
+                if cut:
+                    yield line, buf[:cut]
+                    line += buf.count(b'\n', 0, cut)
+                carry = buf[cut:]
+            if carry:
+                yield line, carry
@@ -0,0 +1,69 @@
+import time
+import random
+import argparse
+import wire
+
+
+def make_entries(nodes):
+    now = time.time()
+    return {
+        f"172.22.{i // 256}.{i % 256}": {
+            "status": random.choice(["alive", "alive", "alive", "suspicion", "failure"]),
+            "timestamp": now - random.random() * 100,
+            "sus": False,
+            "sus_timestamp": now - 86400,
+            "version": random.randint(1, 50)
+        }
+        for i in range(nodes)
+    }
+
+
+def measure(function, seconds):
+    # Calls per second of function, run for about seconds
+    calls = 0
+    batch = 1
+    start = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            function()
+        calls += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return calls / elapsed
+        batch = min(batch * 2, 10000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Encode and decode throughput of the wire formats.')
+    parser.add_argument('--nodes', type=int, default=100, help='Cluster size for the delta and digest messages')
+    parser.add_argument('--deltas', type=int, default=10, help='Entries in a delta message')
+    parser.add_argument('--seconds', type=float, default=1.0, help='Time spent measuring each case')
+    args = parser.parse_args()
+
+    random.seed(42)
+    entries = make_entries(args.nodes)
+    deltas = dict(list(entries.items())[:args.deltas])
+    digest = {node_id: (info["version"], 1) for node_id, info in entries.items()}
+    cases = {
+        "ping": lambda wire_format: [wire.encode_ping(12345, wire_format)],
+        "ack": lambda wire_format: [wire.encode_ack(12345, wire_format)],
+        f"delta {args.deltas}": lambda wire_format: wire.encode_deltas(deltas, wire_format),
+        f"digest {args.nodes}": lambda wire_format: wire.encode_digest(digest, wire_format),
+    }
+
+    print(f"{'message':<12} {'format':<7} {'datagrams':>9} {'bytes':>7} {'encode/s':>11} {'decode/s':>11}")
+    for name, encode in cases.items():
+        for wire_format in wire.FORMATS:
+            messages = encode(wire_format)
+
+            def decode():
+                for message in messages:
+                    wire.decode(message)
+
+            encode_rate = measure(lambda: encode(wire_format), args.seconds)
+            decode_rate = measure(decode, args.seconds)
+            print(f"{name:<12} {wire_format:<7} {len(messages):>9} {sum(map(len, messages)):>7} "
+                  f"{encode_rate:>11.0f} {decode_rate:>11.0f}")
+
+if __name__ == "__main__":
+    main()
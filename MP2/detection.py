@@ -1,41 +1,103 @@
 import socket
+import selectors
 import threading
 import time
 import random
-import json
 import re
 import sys
+import math
+import argparse
+from collections import deque
+import wire
+from timer_wheel import TimerWheel
+from lock_stats import TimedLock
 from member_list import initialize_membership_list
-from log_update import log_membership_change, initialize_log_file
+import log_update
 
 FAIL_WAIT_TIME = 5
 SUS_WAIT_TIME = 10
+# With suspicion on, a node that does not answer for SUSPECT_TIME is suspected, and failed at SUS_WAIT_TIME
+SUSPECT_TIME = 5
+# A suspicion heard from another node is failed after this long unless the node refutes it
+SUS_GOSSIP_WAIT_TIME = SUS_WAIT_TIME + 5
+# Seconds between two probes of the node. Targets are probed in a shuffled round-robin order,
+# so a failed node is probed within two rounds of the nodes known.
+PROTOCOL_PERIOD = 2
+# Seconds to wait for an ack before asking INDIRECT_PROBES other nodes to ping the target, so a
+# lost ping or ack alone does not fail a node
+PING_TIMEOUT = 1
+INDIRECT_PROBES = 3
+# Seconds between two gossip rounds
+GOSSIP_PERIOD = 3
 gossip_node_instance = None
 PORT = 7777
+# Size of the receive buffer, enough for the largest UDP payload. Messages are split to fit
+# wire.MAX_MESSAGE, see wire.py, so no message comes close to it.
+MAX_DATAGRAM = 65507
+# Messages waiting for room in the socket's send buffer, the oldest are dropped past this
+MAX_OUTBOX = 1024
+GOSSIP_FANOUT = 3
+# A change is gossiped in RETRANSMIT_MULT * log2(cluster size) rounds, enough to reach every node
+RETRANSMIT_MULT = 3
+# Every this many rounds the node also compares digests with one node and pulls what it misses
+ANTI_ENTROPY_ROUNDS = 5
+# At the same version, the status that wins
+STATUS_RANK = {"alive": 0, "suspicion": 1, "failure": 2, "leave": 2}
+
+def entry_rank(info):
+    # Which of two entries of a node is newer
+    return (info["version"], STATUS_RANK.get(info["status"], 0))
 
 class GossipNode:
-    def __init__(self, membership_file="MP2/membership_list.json"):
-        self.node_ip = self.get_ip()
+    def __init__(self, membership_file="MP2/membership_list.json", wire_format=wire.BINARY,
+                 protocol_period=PROTOCOL_PERIOD, ping_timeout=PING_TIMEOUT, indirect_probes=INDIRECT_PROBES,
+                 round_robin=True, fail_wait_time=FAIL_WAIT_TIME, log_format="text", fsync="interval",
+                 ip=None, port=PORT, log_file="MP2/mp2.log", gossip_period=GOSSIP_PERIOD):
+        # The host's address by default. Nodes are known by address, so every node of a cluster
+        # listens on the same port.
+        self.node_ip = ip or self.get_ip()
+        self.port = port
+        self.gossip_period = gossip_period
+        # Format of the messages sent, JSON to read them while debugging
+        self.wire_format = wire_format
+        self.protocol_period = protocol_period
+        self.ping_timeout = ping_timeout
+        # 0 turns the ping-reqs off, and round_robin=False picks every target at random
+        self.indirect_probes = indirect_probes
+        self.round_robin = round_robin
+        self.fail_wait_time = fail_wait_time
         self.membership_file = membership_file
         self.version = 1
         # Ensure membership list initialized
+        # The membership list and the known nodes are snapshots: a change publishes a new dict or
+        # frozenset and never changes an entry already published, so readers take the current
+        # one without a lock. Writers take list_lock to publish one after the other.
         self.membership_list = initialize_membership_list(self.node_ip, self.membership_file)
 
-        self.known_nodes = {node_ip for node_ip in self.membership_list if node_ip != self.node_ip}
+        self.known_nodes = frozenset(node_ip for node_ip in self.membership_list if node_ip != self.node_ip)
         self.running = True
         self.sus = False
         # self.known_nodes = {node_id: info for node_id, info in parsed_data.items() if node_id != self.node_id}
-        self.list_lock = threading.Lock()
-        self.log_lock = threading.Lock()
-        self.known_lock = threading.Lock()
-        self.records_lock = threading.Lock()
-        self.socket_lock = threading.Lock()
-        self.sus_lock = threading.Lock()
-        self.sus_list_lock = threading.Lock()
-
-        # Generate the log file name based on node ID
-        self.log_file = "MP2/mp2.log"
-        initialize_log_file(self.node_ip, self.version, self.log_file)
+        # Never held together
+        self.list_lock = TimedLock("list")
+        self.records_lock = TimedLock("records")
+        # Entries changed lately, with the gossip rounds they are still sent in
+        self.changes = {self.node_ip: 1}
+        # Targets left to probe in this round
+        self.probe_order = []
+
+        # Sequence numbers of the unanswered pings of every target, its timer is pending in the wheel
+        self.probes = {}
+        # The requester, its port and sequence number of the pings sent for a ping-req, by (target, seq)
+        self.relays = {}
+        self.timers = TimerWheel()
+
+        # Membership changes are queued for the logger's thread, which writes them in batches
+        self.log_file = log_file
+        self.logger = log_update.get_logger(self.log_file, log_format=log_format, fsync=fsync)
+        self.log(self.node_ip, "joined", self.version)
+
+        self.open_transport()
 
         # Start the UDP server to listen for messages (gossip, ping, ack)
         self.server_thread = threading.Thread(target=self.start_server)
@@ -49,24 +111,110 @@ class GossipNode:
         self.ping_thread = threading.Thread(target=self.ping)
         self.ping_thread.start()
 
-        self.ping_records = []
-        self.sus_records = []
+        self.timer_thread = threading.Thread(target=self.timers.run, args=(lambda: self.running,))
+        self.timer_thread.start()
 
-        self.ping_check_thread = threading.Thread(target=self.check_ping_status)
-        self.ping_check_thread.start()
+    def open_transport(self):
+        # One non-blocking socket sends and receives every message of the node, so sends
+        # neither open a socket each nor wait for each other
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server_socket.bind((self.node_ip, self.port))
+        self.server_socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+        self.outbox = deque(maxlen=MAX_OUTBOX)
+        # Taken to check the outbox and send, so a message never overtakes the queued ones
+        self.outbox_lock = threading.Lock()
+        # Written to when the outbox stops being empty, so the select waits for room to send
+        # right away instead of at its next timeout
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+
+    def close_transport(self):
+        self.selector.close()
+        self.server_socket.close()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
 
     def start_server(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.server_socket.bind((self.node_ip, PORT))
         # print(f"Node {self.node_id} listening on {self.ip}:{self.port}")
-        self.server_socket.settimeout(2)
+        events = selectors.EVENT_READ
         while self.running == True:
+            # Wake up regularly to see if the node left
+            for key, mask in self.selector.select(timeout=0.5):
+                if key.fileobj is self.wakeup_reader:
+                    self.clear_wakeup()
+                    continue
+                if mask & selectors.EVENT_READ:
+                    self.receive_messages()
+                if mask & selectors.EVENT_WRITE:
+                    self.flush_outbox()
+            # Only wait for room to send while messages are waiting for it
+            wanted = selectors.EVENT_READ | (selectors.EVENT_WRITE if self.outbox else 0)
+            if wanted != events:
+                self.selector.modify(self.server_socket, wanted)
+                events = wanted
+
+    def receive_messages(self):
+        # Everything that arrived since the last select
+        while True:
             try:
-                message, (ip, port) = self.server_socket.recvfrom(1024)
-                self.process_message(message, ip, port)
-            except socket.timeout:
+                message, (ip, port) = self.server_socket.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
                 continue
-        self.server_socket.close()
+            self.handle_message(message, ip, port)
+
+    def handle_message(self, message, ip, port):
+        # A message the decoder lets through is well typed, a bad one is dropped without
+        # stopping the thread that reads the messages
+        try:
+            self.process_message(message, ip, port)
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Dropped a bad message from {ip}: {e}")
+
+    def send_message(self, data, address):
+        with self.outbox_lock:
+            if not self.outbox:
+                try:
+                    self.server_socket.sendto(data, address)
+                    return
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except OSError:
+                    # Unreachable, the pings notice
+                    return
+            # The send buffer is full, start_server sends it once there is room
+            self.outbox.append((data, address))
+            first = len(self.outbox) == 1
+        if first:
+            try:
+                self.wakeup_writer.send(b"\0")
+            except OSError:
+                pass  # A wakeup is already pending
+
+    def clear_wakeup(self):
+        while True:
+            try:
+                if not self.wakeup_reader.recv(4096):
+                    return
+            except (BlockingIOError, InterruptedError):
+                return
+
+    def flush_outbox(self):
+        with self.outbox_lock:
+            while self.outbox:
+                data, address = self.outbox[0]
+                try:
+                    self.server_socket.sendto(data, address)
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError:
+                    pass
+                self.outbox.popleft()
 
     def get_ip(self):
         hostname = socket.gethostname()
@@ -74,275 +222,330 @@ class GossipNode:
         return local_ip
     
     def gossip(self):
+        rounds = 0
         while self.running == True:
-            time.sleep(3)
-            with self.known_lock:
-                if len(self.known_nodes) >= 3:
-                    # Select 3 unique nodes to gossip with
-                    target_node = random.choice(list(self.known_nodes), 3)
-                else:
-                    # If less than 3 nodes, sample as many as possible without repeating
-                    target_nodes = self.known_nodes
-
+            time.sleep(self.gossip_period)
+            target_nodes = self.gossip_targets()
+            if not target_nodes:
+                continue
+            # Only what changed lately, so a round costs the same whatever the cluster size
+            with self.list_lock:
+                deltas = self.take_deltas()
             for target_node in target_nodes:
-                self.send_gossip(target_node)
-
-    def send_gossip(self, target_node):
-        message = json.dumps({"type": "gossip", "membership_list": self.membership_list})
-        with self.socket_lock:
-            # self.membership_list = load_membership_list(self.membership_file)
-            gossip_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            gossip_socket.sendto(message.encode(), (target_node, PORT))
-            gossip_socket.close()
-        # print(f"Gossip sent from {self.node_id} to {target_node}")
+                self.send_gossip(target_node, deltas)
+            # A node that missed deltas catches up by comparing digests
+            if rounds % ANTI_ENTROPY_ROUNDS == 0:
+                self.send_digest(random.choice(target_nodes))
+            rounds += 1
+
+    def gossip_targets(self):
+        known_nodes = list(self.known_nodes)
+        # Up to GOSSIP_FANOUT distinct nodes
+        return random.sample(known_nodes, min(GOSSIP_FANOUT, len(known_nodes)))
+
+    def publish(self, entries):
+        # Called with list_lock held: the new snapshot with entries replacing those of their nodes
+        members = dict(self.membership_list)
+        members.update(entries)
+        self.membership_list = members
+        for node_id in entries:
+            self.mark_changed(node_id)
+
+    def update_known(self, add=(), discard=()):
+        # Called with list_lock held, copies the set only if it changes
+        add = [node_id for node_id in add if node_id not in self.known_nodes]
+        discard = [node_id for node_id in discard if node_id in self.known_nodes]
+        if add or discard:
+            self.known_nodes = self.known_nodes.union(add).difference(discard)
+
+    def mark_changed(self, node_id):
+        # Called with list_lock held
+        self.changes[node_id] = RETRANSMIT_MULT * max(1, math.ceil(math.log2(len(self.membership_list) + 1)))
+
+    def take_deltas(self):
+        # Called with list_lock held, the entries need none
+        members = self.membership_list
+        deltas = {}
+        for node_id in list(self.changes):
+            deltas[node_id] = members[node_id]
+            self.changes[node_id] -= 1
+            if self.changes[node_id] <= 0:
+                del self.changes[node_id]
+        return deltas
+
+    def send_gossip(self, target_node, entries, port=None):
+        for data in wire.encode_deltas(entries, self.wire_format):
+            self.send_message(data, (target_node, port or self.port))
+
+    def send_digest(self, target_node):
+        digest = {node_id: entry_rank(info) for node_id, info in self.membership_list.items() if info["status"]}
+        for data in wire.encode_digest(digest, self.wire_format):
+            self.send_message(data, (target_node, self.port))
 
     def ping(self):
         while self.running == True:
-            time.sleep(2)
-            with self.known_lock:
-                if self.known_nodes:
-                    target_node = random.choice(list(self.known_nodes))
-                    self.send_ping(target_node)
+            time.sleep(self.protocol_period)
+            target_node = self.next_target()
+            if target_node is not None:
+                self.send_ping(target_node)
+
+    def next_target(self):
+        # Only called by the ping thread
+        known_nodes = self.known_nodes
+        if not self.round_robin:
+            return random.choice(list(known_nodes)) if known_nodes else None
+        while self.probe_order:
+            target_node = self.probe_order.pop()
+            if target_node in known_nodes:
+                return target_node
+        # A new round in a new random order, with the nodes that joined meanwhile
+        self.probe_order = list(known_nodes)
+        random.shuffle(self.probe_order)
+        return self.probe_order.pop() if self.probe_order else None
 
     def send_ping(self, target_node):
         seq = self.get_seq()
-        ping_message = json.dumps({"type": "ping", "seq": seq})
+        # The timer starts at the first unanswered ping, an answer to any of them cancels it
+        with self.records_lock:
+            seqs = self.probes.get(target_node)
+            if seqs is None:
+                self.probes[target_node] = {seq}
+                if not self.sus:
+                    self.timers.schedule(target_node, self.fail_wait_time, self.probe_failed, target_node)
+                else:
+                    self.timers.schedule(target_node, SUSPECT_TIME, self.probe_suspected, target_node)
+            else:
+                seqs.add(seq)
+        if self.indirect_probes:
+            self.timers.schedule(("indirect", target_node), self.ping_timeout, self.probe_indirectly, target_node, seq)
         # Get unique number
-        with self.socket_lock:
-            ping_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            ping_socket.sendto(ping_message.encode(), (target_node, PORT))
-            ping_socket.close()
+        self.send_message(wire.encode_ping(seq, self.wire_format), (target_node, self.port))
         # print(f"Ping sent from {self.node_id} to {target_node}")
 
-        if not self.sus:
-            wait_second = FAIL_WAIT_TIME
-            record_to_check = {
-                "target": target_node,
-                "seq": seq,
-                "time": wait_second
-            }
-            with self.records_lock:
-                if not any(record["target"] == target_node for record in self.ping_records):
-                    self.ping_records.append(record_to_check)
-        else:
-            wait_second = SUS_WAIT_TIME
-            record_to_check = {
-                "target": target_node,
-                "time": wait_second
-            }
-            with self.sus_lock:
-                if not any(record["target"] == target_node for record in self.sus_records):
-                    self.sus_records.append(record_to_check)
-
-    def check_ping_status(self):
-        while self.running == True:
-            time.sleep(1)
-            if not self.sus:
-                with self.records_lock:
-                    for record in list(self.ping_records):
-                        if record["time"] <= 0:
-                            targetId = record["target"]
-                            with self.known_lock:
-                                self.known_nodes.discard(targetId)
-                                self.ping_records.remove(record)
-                            # print(f"Node {record['target']} marked as failure.")
-                            with self.list_lock:
-                                self.membership_list[targetId]["status"] = "failure"
-                                self.membership_list[targetId]["timestamp"] = time.time()
-                                version = self.membership_list[targetId]["version"]
-                            with self.log_lock:
-                                log_membership_change(targetId, "failure", version, self.log_file)
-                        else:
-                            record["time"] -= 1
-            else:
-                with self.sus_lock:
-                    for record in list(self.sus_records): 
-                        time_left = record["time"]  
-                        targetId = record["target"]             
-                        if time_left  <= 0:
-                            self.known_nodes.discard(targetId)
-                            self.sus_records.remove(record)
-                            # print(f"Node {record['target']} marked as failure.")
-                            with self.list_lock:
-                                self.membership_list[targetId]["status"] = "failure"
-                                self.membership_list[targetId]["timestamp"] = time.time()
-                                version = self.membership_list[targetId]["version"]
-                            with self.log_lock:
-                                log_membership_change(targetId, "failure", version, self.log_file)
-                        elif time_left == 5:
-                            print(f"\n!!!!!!!{targetId} was suspected!!!!!!\n")
-                            with self.list_lock:
-                                self.membership_list[targetId]["status"] = "suspicion"
-                                self.membership_list[targetId]["timestamp"] = time.time()
-                                version = self.membership_list[targetId]["version"]
-                            with self.log_lock:
-                                log_membership_change(targetId, "suspicion", version, self.log_file)
-                            record["time"] -= 1
-                        else:
-                            record["time"] -= 1
+    def probe_indirectly(self, target_node, seq):
+        with self.records_lock:
+            if seq not in self.probes.get(target_node, ()):
+                return
+        # Other nodes ping the target and relay its ack, which then clears the probe like a direct one
+        helpers = [node for node in self.known_nodes if node != target_node]
+        ping_req = wire.encode_ping_req(target_node, seq, self.wire_format)
+        for helper in random.sample(helpers, min(self.indirect_probes, len(helpers))):
+            self.send_message(ping_req, (helper, self.port))
+
+    def process_ping_req(self, ip, port, target_node, seq):
+        relay_seq = self.get_seq()
+        with self.records_lock:
+            self.relays[(target_node, relay_seq)] = (ip, port, seq)
+        # The requester gives up by then
+        self.timers.schedule(("relay", target_node, relay_seq), self.fail_wait_time, self.drop_relay, target_node, relay_seq)
+        self.send_message(wire.encode_ping(relay_seq, self.wire_format), (target_node, self.port))
+
+    def drop_relay(self, target_node, seq):
+        with self.records_lock:
+            self.relays.pop((target_node, seq), None)
+
+    def clear_probe(self, target_node):
+        with self.records_lock:
+            self.probes.pop(target_node, None)
+            self.timers.cancel(target_node)
+
+    def clear_probes(self):
+        with self.records_lock:
+            self.probes.clear()
+            self.timers.cancel_all()
+
+    def probe_suspected(self, target_node):
+        with self.records_lock:
+            # Answered meanwhile
+            if target_node not in self.probes:
+                return
+            self.timers.schedule(target_node, SUS_WAIT_TIME - SUSPECT_TIME, self.probe_failed, target_node)
+        print(f"\n!!!!!!!{target_node} was suspected!!!!!!\n")
+        with self.list_lock:
+            info = self.membership_list[target_node]
+            self.publish({target_node: dict(info, status="suspicion", timestamp=time.time())})
+            version = info["version"]
+        self.log(target_node, "suspicion", version)
 
+    def probe_failed(self, target_node):
+        with self.records_lock:
+            if self.probes.pop(target_node, None) is None:
+                return
+        # print(f"Node {target_node} marked as failure.")
+        with self.list_lock:
+            info = self.membership_list[target_node]
+            self.publish({target_node: dict(info, status="failure", timestamp=time.time())})
+            self.update_known(discard=(target_node,))
+            version = info["version"]
+        self.log(target_node, "failure", version)
+
+    def log(self, target_node, action, version):
+        self.logger.log(target_node, action, version, reporter=self.node_ip)
 
     def process_message(self, message, ip, port):
-        message = json.loads(message.decode())
-        if message["type"] == "gossip":
-            self.process_gossip(message["membership_list"])
-        elif message["type"] == "ping":
-            self.process_ping(ip, port, message["seq"])
-        elif message["type"] == "ack":
-            self.process_ack(ip, message["seq"])
-        else:
-            raise ValueError("Wrong type in process_message()")  
+        # Binary or JSON, the payload depends on the type: a ping or an ack is only its sequence number
+        msg_type, payload = wire.decode(message)
+        if msg_type == wire.PING:
+            self.process_ping(ip, port, payload)
+        elif msg_type == wire.ACK:
+            self.process_ack(ip, payload)
+        elif msg_type == wire.PING_REQ:
+            self.process_ping_req(ip, port, *payload)
+        elif msg_type == wire.INDIRECT_ACK:
+            # Relayed by a node this one sent a ping-req
+            self.process_ack(*payload)
+        elif msg_type == wire.DELTA or msg_type == wire.GOSSIP:
+            self.process_gossip(payload)
+        elif msg_type == wire.DIGEST:
+            self.process_digest(ip, port, *payload)
+        elif msg_type == wire.PULL:
+            self.process_pull(ip, port, payload)
 
     def process_ping(self, ip, port, seq):
         # print(f"Ping received by {self.node_id} from {source_id}")
-        ack_message = json.dumps({"type": "ack", "seq": seq})
-        with self.socket_lock:
-            ack_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            ack_socket.sendto(ack_message.encode(), (ip, port))
-            ack_socket.close()
+        self.send_message(wire.encode_ack(seq, self.wire_format), (ip, port))
 
         # Try ================================================================
-        if not self.sus:
-            with self.records_lock:
-                self.ping_records = [record for record in self.ping_records if record["target"] != ip]
-        else:
-            with self.sus_lock:
-                self.sus_records = [record for record in self.sus_records if record["target"] != ip]
-
+        self.clear_probe(ip)
+
+        info = self.membership_list.get(ip)
+        if info is not None and info["status"] == "alive" and ip in self.known_nodes:
+            # Nothing changes, the common case takes no lock
+            return
+        joined = False
+        seen_as = None
         with self.list_lock:
-            if ip not in self.membership_list:
-                log_membership_change(ip, "joined", 1, self.log_file)
-                self.membership_list[ip] = {
+            info = self.membership_list.get(ip)
+            if info is None or not info["status"]:
+                joined = True
+                self.publish({ip: {
                     "status": "alive",
                     "timestamp": time.time()-86400,
                     "sus": self.sus,
                     "sus_timestamp": time.time()-86400,
                     "version": 1
-                }
-            else:
-                self.membership_list[ip]["status"] = "alive"
+                }})
+            elif info["status"] != "alive":
+                seen_as = info
+                self.membership_list = dict(self.membership_list, **{ip: dict(info, status="alive")})
                 # self.membership_list[ip]["time"] = time.time()
-                self.membership_list[ip]["version"] += 1
-        with self.known_lock:
-            self.known_nodes.add(ip)
+            self.update_known(add=(ip,))
+        if joined:
+            self.log(ip, "joined", 1)
+        if seen_as is not None:
+            # Tell the node how it is seen, it refutes it with a newer version
+            self.send_gossip(ip, {ip: seen_as}, port)
         # ====================================================================
 
     def process_ack(self, source_id, seq):
         # print(f"Ack received by {self.node_id} from {source_id}")
-        with self.list_lock:
-            self.membership_list[source_id]["status"] = "alive"
-            self.membership_list[source_id]["timestamp"] = time.time()
-            if not self.sus:
-                with self.records_lock:
-                    for record in list(self.ping_records):
-                        if record["target"] == source_id and record["seq"] == seq:
-                            self.ping_records.remove(record) 
-                            break
-            else:
-                with self.sus_lock:
-                    for record in list(self.sus_records):
-                        if record["target"] == source_id and record["seq"] == seq:
-                            self.ping_records.remove(record) 
-                            break
+        with self.records_lock:
+            relay = self.relays.pop((source_id, seq), None)
+        if relay is not None:
+            self.timers.cancel(("relay", source_id, seq))
+            ip, port, requested_seq = relay
+            self.send_message(wire.encode_indirect_ack(source_id, requested_seq, self.wire_format), (ip, port))
+        info = self.membership_list.get(source_id)
+        if info is not None and info["status"] != "alive":
+            with self.list_lock:
+                info = self.membership_list[source_id]
+                self.membership_list = dict(self.membership_list, **{source_id: dict(info, status="alive", timestamp=time.time())})
+        with self.records_lock:
+            seqs = self.probes.get(source_id)
+            if seqs is not None and seq in seqs:
+                del self.probes[source_id]
+                self.timers.cancel(source_id)
 
-        # with self.log_lock:
-        #     log_membership_change(source_id, "ack - alive", self.log_file)
+        # self.log(source_id, "ack - alive", ...)
 
     def process_gossip(self, new_membership_list):
+        # The whole message is merged into one new snapshot
+        changes = []
+        updates = {}
+        sus_change = None
         with self.list_lock:
-            # self.membership_list = load_membership_list(self.membership_file)
+            members = self.membership_list
             for node_id, node_info in new_membership_list.items():
-                new_status = node_info["status"]
-                if not new_status:
-                    break
-                new_version = node_info["version"]
-                if node_id not in self.membership_list:
-                    # If not, you can initialize it or handle it accordingly
-                    self.membership_list[node_id] = node_info
-                    if node_info["status"] == "alive":
-                        with self.known_lock:
-                            self.known_nodes.add(node_id)
-                        with self.log_lock:
-                            log_membership_change(node_id, "joined", new_version, self.log_file)
-                    continue  # Skip to the next node in new_membership_list
-                current_version = self.membership_list[node_id]["version"]
-                current_status = self.membership_list[node_id]["status"]
-                current_time = self.membership_list[node_id]["timestamp"]
-                new_time = node_info["timestamp"]
-                current_sus_time = self.membership_list[self.node_ip]["sus_timestamp"]
-                new_sus_time = node_info["sus_timestamp"]
-                if node_info["sus"] and not self.sus and current_sus_time < new_sus_time:
-                    self.enable_sus(self)
-                elif not node_info["sus"] and self.sus and current_sus_time < new_sus_time:
-                    self.disable_sus(self)
-                newest_time = max(current_time, new_time)
-                if current_version > new_version or (new_version == current_status and current_time > new_time):
-                    break
-                elif current_version < new_version:
-                    self.membership_list[node_id] = new_version
-                if self.node_ip == node_id:
-                    self.version = new_version
-                    break
-                # self.membership_list[node_id] = node_info
-                self.membership_list[node_id] = {
-                    "status": new_status,
-                    "timestamp": newest_time,
-                    "version": new_version
-                }
-                if new_status == "sus" and current_status != "sus":
-                    wait_second = SUS_WAIT_TIME + 5
-                    with self.sus_lock:
-                        record_to_check = {
-                            "target": node_id,
-                            "time": wait_second
-                        }
-                    with self.sus_lock:
-                        if not any(record["target"] == node_id for record in self.sus_records):
-                            self.sus_records.append(record_to_check)
-                    with self.log_lock:
-                        log_membership_change(node_id, "suspicion", new_version, self.log_file)
-                elif new_status != "sus" and current_status == "sus":
-                    if new_status == "alive":
-                        if node_id in self.sus_records:
-                            log_membership_change(node_id, "resume", new_version, self.log_file)
-                            with self.sus_lock:
-                                self.sus_records = [record for record in self.sus_records if record["target"] != node_id]
-                    else:
-                        with self.known_lock:
-                            self.known_nodes.discard(node_id)
-                        with self.sus_lock:
-                            self.sus_records = [record for record in self.sus_records if record["target"] != node_id]
-                            
-                        with self.log_lock:
-                            log_membership_change(node_id, new_status, new_version, self.log_file)
-                elif new_status == "alive" and current_status != "alive":
-                    with self.known_lock:
-                        self.known_nodes.add(node_id)
-                    with self.log_lock:
-                        log_membership_change(node_id, "joined", new_version, self.log_file)
-                elif new_status != "alive" and current_status == "alive":
-                    with self.known_lock:
-                        self.known_nodes.discard(node_id)
-                    with self.log_lock:
-                        log_membership_change(node_id, new_status, new_version, self.log_file)
+                if not node_info.get("status"):
+                    continue
+                current = members.get(node_id)
+                if node_id == self.node_ip:
+                    # Only the node itself says it is alive, with a version newer than any other claim
+                    if node_info["status"] != "alive" and self.running and entry_rank(node_info) >= entry_rank(current):
+                        self.version = node_info["version"] + 1
+                        updates[node_id] = dict(current, version=self.version, status="alive", timestamp=time.time())
+                    continue
+                if current is not None and current["status"] and entry_rank(node_info) <= entry_rank(current):
+                    continue
+                # The suspicion mode travels with the entries, the latest switch wins
+                own = members[self.node_ip]
+                if node_info.get("sus") != self.sus and (node_info.get("sus_timestamp") or 0) > (own.get("sus_timestamp") or 0):
+                    sus_change = node_info["sus"]
+                updates[node_id] = dict(node_info)
+                if current is None or current["status"] != node_info["status"]:
+                    changes.append((node_id, current["status"] if current is not None else None, node_info["status"], node_info["version"]))
+            if updates:
+                self.publish(updates)
+                self.update_known(add=[node_id for node_id, _, status, _ in changes if status == "alive"],
+                                  discard=[node_id for node_id, _, status, _ in changes if status in ("failure", "leave")])
+        # Timers and the log after the list is published and unlocked
+        for change in changes:
+            self.status_changed(*change)
+        if sus_change is not None and sus_change != self.sus:
+            if sus_change:
+                self.enable_sus()
+            else:
+                self.disable_sus()
+
+    def status_changed(self, node_id, current_status, new_status, new_version):
+        # The known nodes are already updated
+        if new_status == "alive":
+            if current_status == "suspicion":
+                self.clear_probe(node_id)
+                action = "resume"
+            else:
+                action = "joined"
+        elif new_status == "suspicion":
+            with self.records_lock:
+                if node_id not in self.probes:
+                    self.probes[node_id] = set()
+                    self.timers.schedule(node_id, SUS_GOSSIP_WAIT_TIME, self.probe_failed, node_id)
+            action = "suspicion"
+        else:
+            self.clear_probe(node_id)
+            action = new_status
+        self.log(node_id, action, new_version)
+
+    def process_digest(self, ip, port, digest, key_range):
+        low, high = key_range
+        members = self.membership_list
+        # What the sender misses or has older, in the part of the ids the digest covers
+        newer_here = {node_id: info for node_id, info in members.items()
+                      if info["status"] and (low is None or node_id >= low) and (high is None or node_id < high)
+                      and (node_id not in digest or entry_rank(info) > tuple(digest[node_id]))}
+        newer_there = [node_id for node_id, rank in digest.items()
+                       if node_id not in members or not members[node_id]["status"]
+                       or tuple(rank) > entry_rank(members[node_id])]
+        self.send_gossip(ip, newer_here, port)
+        for data in wire.encode_pull(newer_there, self.wire_format):
+            self.send_message(data, (ip, port))
+
+    def process_pull(self, ip, port, node_ids):
+        members = self.membership_list
+        entries = {node_id: members[node_id] for node_id in node_ids if node_id in members}
+        self.send_gossip(ip, entries, port)
 
     def send_leave(self):
         self.running = False
-        with self.log_lock:
-            log_membership_change(self.node_ip, "leave", self.version, self.log_file)
+        self.log(self.node_ip, "leave", self.version)
         with self.list_lock:
-            # Mark the node as 'leave' in its own membership list
-            self.membership_list[self.node_ip]["status"] = "leave"
-            self.membership_list[self.node_ip]["timestamp"] = time.time()
-        with self.known_lock:
-            if len(self.known_nodes) >= 3:
-                # Select 3 unique nodes to gossip with
-                target_node = random.choice(list(self.known_nodes), 3)
-            else:
-                # If less than 3 nodes, sample as many as possible without repeating
-                target_nodes = self.known_nodes
-        for target_node in target_nodes:
-            self.send_gossip(target_node)
+            # Mark the node as 'leave' in its own membership list, newer than it being alive
+            self.version += 1
+            leave = {self.node_ip: dict(self.membership_list[self.node_ip], version=self.version, status="leave",
+                                        timestamp=time.time())}
+            self.publish(leave)
+        for target_node in self.gossip_targets():
+            self.send_gossip(target_node, leave)
         self.shutdown()
         
     def shutdown(self):
@@ -354,8 +557,12 @@ class GossipNode:
             self.gossip_thread.join()
         if self.ping_thread.is_alive():
             self.ping_thread.join()
-        if self.ping_check_thread.is_alive():
-            self.ping_check_thread.join()
+        if self.timer_thread.is_alive():
+            self.timer_thread.join()
+        # Closed last, send_leave gossips through it after running turned False
+        self.close_transport()
+        # Other nodes of the process may share the logger, so it is only flushed
+        self.logger.flush(timeout=5)
         
     def get_seq(self):
         rand_source = time.time_ns()
@@ -366,28 +573,30 @@ class GossipNode:
     def enable_sus(self):
         self.sus = True
         with self.list_lock:
-            self.membership_list[self.node_ip]["sus"] = True
-            self.membership_list[self.node_ip]["sus_timestamp"] = time.time()
-        with self.records_lock:
-            self.ping_records = []
+            self.bump_version(sus=True, sus_timestamp=time.time())
+        self.clear_probes()
 
     def disable_sus(self):
         self.sus = False
-        with self.sus_lock:
-            self.sus_records = []
+        self.clear_probes()
         with self.list_lock:
-            self.membership_list[self.node_ip]["sus"] = False
-            self.membership_list[self.node_ip]["sus_timestamp"] = time.time()
-            for key, value in self.membership_list.items():
-                if value.get('status') == "suspicion":
-                    value['status'] = "alive"
+            self.bump_version(sus=False, sus_timestamp=time.time())
+            self.membership_list = {key: dict(value, status="alive") if value.get('status') == "suspicion" else value
+                                    for key, value in self.membership_list.items()}
             
+    def bump_version(self, **fields):
+        # Called with list_lock held, publishes the own entry with fields changed and a new version, so it is gossiped
+        self.version += 1
+        self.publish({self.node_ip: dict(self.membership_list[self.node_ip], version=self.version, **fields)})
+
+    def lock_stats(self):
+        return {lock.name: lock.stats() for lock in (self.list_lock, self.records_lock)}
+
     def show_sus(self):
         sus_info = []
         sus_info.append("================Suspicion List=================")
-        with self.sus_lock:
-            for info in self.sus_records:
-                id = info["target"]
+        with self.records_lock:
+            for id in self.probes:
                 formatted_info = f"{id}"
                 sus_info.append(formatted_info)
         sus_info.append("================================================")
@@ -396,12 +605,11 @@ class GossipNode:
     def get_membership_list(self):
         membership_info = []
         membership_info.append("================Membership List=================")
-        with self.list_lock:
-            for node_id, info in self.membership_list.items():
-                if info['status']:
-                    timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(info['timestamp']))
-                    formatted_info = f"id: {node_id} - version: {info['version']} - status: {info['status']} - time: {timestamp}"
-                    membership_info.append(formatted_info)
+        for node_id, info in self.membership_list.items():
+            if info['status']:
+                timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(info['timestamp']))
+                formatted_info = f"id: {node_id} - version: {info['version']} - status: {info['status']} - time: {timestamp}"
+                membership_info.append(formatted_info)
         membership_info.append("================================================")
         return "\n".join(membership_info)
 
@@ -411,7 +619,7 @@ class GossipNode:
     def get_sus(self):
         return self.sus
 
-def listen_for_commands():
+def listen_for_commands(node_options):
     global gossip_node_instance
     while True:
         command = input("\nEnter command: ")  # Wait for user input
@@ -424,7 +632,7 @@ def listen_for_commands():
                 print("You are not joined")
         elif command == "join":
             if gossip_node_instance is None:
-                gossip_node_instance = GossipNode()
+                gossip_node_instance = GossipNode(**node_options)
                 print(f"Node {gossip_node_instance.node_ip} has joined the cluster.")
             else:
                 print("Node is already in the cluster.")
@@ -446,6 +654,13 @@ def listen_for_commands():
                     print("You are not enable suspicion")
             else:
                 print("You are not joined")
+        elif command == "show_locks":
+            if gossip_node_instance is not None:
+                for name, stats in gossip_node_instance.lock_stats().items():
+                    print(f"{name}: {stats}")
+                print(f"log: {gossip_node_instance.logger.stats()}")
+            else:
+                print("You are not joined")
         elif command == "status_sus":
             if gossip_node_instance is not None:
                 print(gossip_node_instance.get_sus())
@@ -468,11 +683,45 @@ def listen_for_commands():
             else:
                 print("You are not joined")
         else:
-            print("Wrong command, use either: \njoin \nleave \nshowid \nshowlist \nenable_sus \ndisable_sus \nstatus_sus \nshow_sus")
+            print("Wrong command, use either: \njoin \nleave \nshowid \nshowlist \nenable_sus \ndisable_sus \nstatus_sus \nshow_sus \nshow_locks")
 
 
 def main():
-    command_thread = threading.Thread(target=listen_for_commands)
+    parser = argparse.ArgumentParser(description='Gossip membership and failure detection node.')
+    parser.add_argument('--wire_format', choices=wire.FORMATS, default=wire.BINARY,
+                        help='Format of the messages sent, json to read them while debugging (both are received)')
+    parser.add_argument('--protocol_period', type=float, default=PROTOCOL_PERIOD, help='Seconds between two probes')
+    parser.add_argument('--ping_timeout', type=float, default=PING_TIMEOUT,
+                        help='Seconds to wait for an ack before probing through other nodes')
+    parser.add_argument('--indirect_probes', type=int, default=INDIRECT_PROBES,
+                        help='Nodes asked to ping a target that did not answer, 0 to fail it on a missed ack alone')
+    parser.add_argument('--gossip_period', type=float, default=GOSSIP_PERIOD, help='Seconds between two gossip rounds')
+    parser.add_argument('--random_targets', action='store_true', help='Probe random targets instead of round-robin')
+    parser.add_argument('--ip', type=str, default=None, help="Address to listen on, the host's by default")
+    parser.add_argument('--port', type=int, default=PORT, help='Port every node of the cluster listens on')
+    parser.add_argument('--membership_file', type=str, default="MP2/membership_list.json",
+                        help='JSON file listing the nodes of the cluster')
+    parser.add_argument('--log_file', type=str, default="MP2/mp2.log", help='Membership log')
+    parser.add_argument('--log_format', choices=log_update.FORMATS, default="text",
+                        help='Format of the membership log, json for structured queries from MP1')
+    parser.add_argument('--fsync', choices=log_update.FSYNC_POLICIES, default="interval",
+                        help='When the membership log is synced to disk')
+    args = parser.parse_args()
+    node_options = {
+        "wire_format": args.wire_format,
+        "protocol_period": args.protocol_period,
+        "gossip_period": args.gossip_period,
+        "ping_timeout": args.ping_timeout,
+        "indirect_probes": args.indirect_probes,
+        "round_robin": not args.random_targets,
+        "ip": args.ip,
+        "port": args.port,
+        "membership_file": args.membership_file,
+        "log_file": args.log_file,
+        "log_format": args.log_format,
+        "fsync": args.fsync
+    }
+    command_thread = threading.Thread(target=listen_for_commands, args=(node_options,))
     command_thread.start()
 
 if __name__ == "__main__":
@@ -0,0 +1,53 @@
+import time
+import threading
+
+
+class TimedLock:
+    # A threading.Lock that measures how often it is taken, how often a thread had to wait for
+    # it, and how long it was waited for and held. The counters are only changed by the thread
+    # holding the lock, so they need no lock of their own.
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+        self.hold_seconds = 0.0
+        self.max_hold = 0.0
+        self.acquired_at = 0.0
+
+    def __enter__(self):
+        waited = 0.0
+        if not self.lock.acquire(blocking=False):
+            start = time.perf_counter()
+            self.lock.acquire()
+            waited = time.perf_counter() - start
+            self.contended += 1
+            self.wait_seconds += waited
+            self.max_wait = max(self.max_wait, waited)
+        self.acquisitions += 1
+        self.acquired_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        held = time.perf_counter() - self.acquired_at
+        self.hold_seconds += held
+        self.max_hold = max(self.max_hold, held)
+        self.lock.release()
+
+    def stats(self):
+        return {
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "wait_seconds": round(self.wait_seconds, 6),
+            "max_wait": round(self.max_wait, 6),
+            "hold_seconds": round(self.hold_seconds, 6),
+            "max_hold": round(self.max_hold, 6),
+            "mean_hold": round(self.hold_seconds / max(self.acquisitions, 1), 9),
+        }
+
+    def reset(self):
+        with self:
+            self.acquisitions = self.contended = 0
+            self.wait_seconds = self.max_wait = self.hold_seconds = self.max_hold = 0.0
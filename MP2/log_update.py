@@ -1,16 +1,203 @@
-import time
 import os
+import json
+import time
+import queue
+import atexit
+import threading
+
+# Events wait in a bounded queue for the logger's thread, which writes them in batches. When
+# the queue is full an event is dropped and counted, so logging never blocks the detector.
+QUEUE_SIZE = 10000
+BATCH_SIZE = 512
+# Seconds the written events may stay in the file buffer
+FLUSH_INTERVAL = 1.0
+# Seconds flush waits for the events to be written by default
+FLUSH_TIMEOUT = 10.0
+# "always" syncs the file to disk after every flush, "interval" at most every FSYNC_INTERVAL
+# seconds, "never" leaves it to the OS
+FSYNC_POLICIES = ("always", "interval", "never")
+FSYNC_INTERVAL = 5.0
+# mp2.log is renamed mp2.log.1 past MAX_BYTES, and so on up to mp2.log.<BACKUPS>, the names
+# the MP1 grep server searches
+MAX_BYTES = 10 * 1024 * 1024
+BACKUPS = 5
+# "text" is the line the logs always had. "json" starts the same way with the action as the
+# level, so the MP1 time index and structured queries read it, and ends with the event in JSON.
+FORMATS = ("text", "json")
+
+_STOP = object()
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+
+def format_event(event, log_format="text"):
+    # event is (time, target node, action, version, node that logged it)
+    at, target_node_id, action, version, reporter = event
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(at))
+    if log_format == "json":
+        record = {"node": target_node_id, "action": action, "version": version, "time": round(at, 6)}
+        if reporter is not None:
+            record["reporter"] = reporter
+        level = "".join(c for c in action.upper() if c.isalpha()) or "EVENT"
+        return f"{timestamp} - {level} - {json.dumps(record)}\n"
+    return f"{timestamp} - Node: {target_node_id} Version: {version} - has {action}\n"
+
+
+class MembershipLogger:
+    def __init__(self, log_file, log_format="text", reporter=None, queue_size=QUEUE_SIZE,
+                 flush_interval=FLUSH_INTERVAL, fsync="interval", fsync_interval=FSYNC_INTERVAL,
+                 max_bytes=MAX_BYTES, backups=BACKUPS):
+        if log_format not in FORMATS or fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown log format {log_format} or fsync policy {fsync}")
+        self.log_file = log_file
+        self.log_format = log_format
+        self.reporter = reporter
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue(queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        # Binary, so size counts the bytes max_bytes limits
+        self.file = open(log_file, "ab")
+        self.size = self.file.tell()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def log(self, target_node_id, action, version, reporter=None):
+        try:
+            self.queue.put_nowait((time.time(), target_node_id, action, version, reporter or self.reporter))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        # Waits until the events logged so far are written and flushed, returns False if they
+        # were not within timeout or the logger's thread is gone
+        if not self.thread.is_alive():
+            return False
+        deadline = time.monotonic() + timeout
+        done = threading.Event()
+        try:
+            self.queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(max(0.0, deadline - time.monotonic()))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+
+    def run(self):
+        last_flush = last_fsync = time.monotonic()
+        reported = 0
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            waiting = []
+            previous = reported
+            for item in batch:
+                if item is _STOP:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    waiting.append(item)
+                else:
+                    lines.append(format_event(item, self.log_format))
+            events = len(lines)
+            if self.dropped > reported:
+                event = (time.time(), "logger", f"dropped {self.dropped - reported} events", 0, self.reporter)
+                lines.append(format_event(event, self.log_format))
+                reported = self.dropped
+            lost = True
+            try:
+                if lines:
+                    self.write("".join(lines))
+                    self.written += len(lines)
+                lost = False
+                now = time.monotonic()
+                # Flushed once the queue is drained, or regularly while it never is
+                if (waiting or stopping or self.queue.empty() or now - last_flush >= self.flush_interval) and not self.file.closed:
+                    self.file.flush()
+                    last_flush = now
+                    if self.fsync == "always" or (self.fsync == "interval" and now - last_fsync >= self.fsync_interval):
+                        os.fsync(self.file.fileno())
+                        last_fsync = now
+            except OSError as e:
+                print(f"Could not write {self.log_file}: {e}")
+                if lost:
+                    # Counted and reported by the next batch, with the drops this one reported
+                    self.dropped += events
+                    reported = previous
+            for done in waiting:
+                done.set()
+        self.file.close()
+
+    def write(self, text):
+        data = text.encode()
+        if self.file.closed:
+            # Reopening failed after a rotation
+            self.reopen()
+        if self.max_bytes and self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.size += len(data)
+
+    def rotate(self):
+        self.file.close()
+        try:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.log_file}.{i}"):
+                    os.replace(f"{self.log_file}.{i}", f"{self.log_file}.{i + 1}")
+            if self.backups:
+                os.replace(self.log_file, f"{self.log_file}.1")
+            else:
+                os.remove(self.log_file)
+            self.rotations += 1
+        except OSError as e:
+            # E.g. the file was removed, the events go on to a file at its name
+            print(f"Could not rotate {self.log_file}: {e}")
+        self.reopen()
+
+    def reopen(self):
+        self.file = open(self.log_file, "ab")
+        self.size = self.file.tell()
+
+    def stats(self):
+        return {"written": self.written, "dropped": self.dropped, "queued": self.queue.qsize(), "rotations": self.rotations}
+
+
+def get_logger(log_file, **options):
+    # One logger per file, the first call's options set it up
+    with _loggers_lock:
+        logger = _loggers.get(log_file)
+        if logger is None or not logger.thread.is_alive():
+            logger = _loggers[log_file] = MembershipLogger(log_file, **options)
+        return logger
+
+
+@atexit.register
+def close_loggers():
+    with _loggers_lock:
+        loggers = list(_loggers.values())
+        _loggers.clear()
+    for logger in loggers:
+        logger.close()
+
 
 def log_membership_change(target_node_id, action, version, log_file):
-    timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-    log_message = f"{timestamp} - Node: {target_node_id} Version: {version} - has {action}\n"
-    with open(log_file, "a") as log:
-        log.write(log_message)
+    get_logger(log_file).log(target_node_id, action, version)
 
 def initialize_log_file(node_id, version, log_file_name):
-    if os.path.exists(log_file_name):
-        log_membership_change(node_id, "joined", version, log_file_name)
-    else:
-        with open(log_file_name, 'w') as log_file:
-            pass
-        log_membership_change(node_id, "joined", version, log_file_name)
\ No newline at end of file
+    log_membership_change(node_id, "joined", version, log_file_name)
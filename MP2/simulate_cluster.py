@@ -0,0 +1,259 @@
+import os
+import sys
+import json
+import math
+import time
+import heapq
+import queue
+import random
+import argparse
+import itertools
+import tempfile
+import threading
+import detection
+
+# "memory" hands messages from node to node in the process, "udp" sends them through sockets on
+# loopback addresses, like separate machines would
+TRANSPORTS = ("memory", "udp")
+
+
+class Network:
+    # Carries the messages of every node of a run: loses them with probability loss, delays them
+    # by delay plus up to jitter seconds, and counts the messages and bytes every node sends
+    def __init__(self, loss=0.0, delay=0.0, jitter=0.0):
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.nodes = {}
+        self.sent = {}
+        self.failures = []
+        self.counts_lock = threading.Lock()
+        self.pending = []
+        self.order = itertools.count()
+        self.pending_ready = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, node, data, address):
+        with self.counts_lock:
+            counts = self.sent.setdefault(node.node_ip, [0, 0])
+            counts[0] += 1
+            counts[1] += len(data)
+        if self.loss and random.random() < self.loss:
+            return
+        delay = self.delay + random.uniform(0, self.jitter)
+        if delay <= 0:
+            node.deliver(data, address)
+            return
+        with self.pending_ready:
+            heapq.heappush(self.pending, (time.monotonic() + delay, next(self.order), node, data, address))
+            self.pending_ready.notify()
+
+    def run(self):
+        # Delivers the delayed messages once they are due
+        while self.running:
+            due = []
+            with self.pending_ready:
+                now = time.monotonic()
+                while self.pending and self.pending[0][0] <= now:
+                    due.append(heapq.heappop(self.pending))
+                if not due:
+                    self.pending_ready.wait(self.pending[0][0] - now if self.pending else 0.5)
+            for _, _, node, data, address in due:
+                node.deliver(data, address)
+
+    def traffic(self):
+        with self.counts_lock:
+            return sum(messages for messages, _ in self.sent.values()), sum(size for _, size in self.sent.values())
+
+    def close(self):
+        self.running = False
+        with self.pending_ready:
+            self.pending_ready.notify()
+        self.thread.join()
+
+
+class UdpNode(detection.GossipNode):
+    # A node on its own loopback address whose messages go through the network
+    def __init__(self, network, **options):
+        self.network = network
+        super().__init__(**options)
+
+    def send_message(self, data, address):
+        self.network.send(self, data, address)
+
+    def deliver(self, data, address):
+        # Called by the network once the message is due
+        super().send_message(data, address)
+
+    def probe_failed(self, target_node):
+        with self.records_lock:
+            pending = target_node in self.probes
+        super().probe_failed(target_node)
+        if pending:
+            self.network.failures.append((time.monotonic(), self.node_ip, target_node))
+
+
+class MemoryNode(UdpNode):
+    # Without a socket, the network puts the messages straight into the inbox of their target
+    def open_transport(self):
+        self.inbox = queue.Queue()
+
+    def close_transport(self):
+        pass
+
+    def start_server(self):
+        while self.running == True:
+            try:
+                message, ip, port = self.inbox.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.handle_message(message, ip, port)
+
+    def deliver(self, data, address):
+        target = self.network.nodes.get(address[0])
+        # A crashed node reads nothing
+        if target is not None and target.running:
+            target.inbox.put((data, self.node_ip, self.port))
+
+
+def node_ips(size, subnet):
+    # 127.0.0.0/8 is all loopback, so every node gets its own address and the same port
+    return [f"127.{subnet}.{i // 250}.{i % 250 + 1}" for i in range(size)]
+
+
+def wait_for(condition, timeout):
+    # Seconds until condition held, None if it did not within timeout
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if condition():
+            return time.monotonic() - start
+        time.sleep(0.1)
+    return None
+
+
+def all_see(nodes, ips, statuses):
+    return all(node.membership_list.get(ip, {}).get("status") in statuses for node in nodes for ip in ips)
+
+
+def run(transport, size, args, directory):
+    ips = node_ips(size, args.subnet)
+    membership_file = os.path.join(directory, f"membership_{transport}_{size}.json")
+    with open(membership_file, "w") as f:
+        json.dump({ip: {"status": "", "timestamp": 0, "sus": False, "sus_timestamp": None, "version": 1} for ip in ips}, f)
+    options = {
+        "membership_file": membership_file,
+        "log_file": os.path.join(directory, f"cluster_{transport}_{size}.log"),
+        "log_format": "json",
+        "fsync": "never",
+        "port": args.port,
+        "protocol_period": args.period,
+        "ping_timeout": args.period / 2,
+        "fail_wait_time": args.fail_periods * args.period,
+        "gossip_period": args.gossip_period,
+    }
+    network = Network(args.loss, args.delay, args.jitter)
+    node_class = MemoryNode if transport == "memory" else UdpNode
+    nodes = []
+    for ip in ips:
+        node = node_class(network, ip=ip, **options)
+        network.nodes[ip] = node
+        nodes.append(node)
+
+    # Until every node has every node alive
+    joined = wait_for(lambda: all_see(nodes, ips, ("alive",)), args.timeout)
+    # The joins are still gossiped for RETRANSMIT_MULT * log2(n) rounds after every node knows
+    # them, until no node has a change left to retransmit
+    retransmit = detection.RETRANSMIT_MULT * math.ceil(math.log2(size + 1)) * args.gossip_period
+    settled = wait_for(lambda: not any(node.changes for node in nodes), max(args.timeout, retransmit))
+
+    # The steady cost of a node, without the harness's own polling
+    messages, size_sent = network.traffic()
+    cpu = time.process_time() - time.thread_time()
+    start = time.monotonic()
+    time.sleep(args.window)
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - time.thread_time() - cpu
+    messages_after, size_after = network.traffic()
+
+    crashed = random.sample(nodes, args.crashes)
+    crash_time = time.monotonic()
+    for node in crashed:
+        # Stops answering, like a crashed process
+        node.running = False
+    crashed_ips = {node.node_ip for node in crashed}
+    live = [node for node in nodes if node not in crashed]
+    converged = wait_for(lambda: all_see(live, crashed_ips, ("failure",)), args.timeout)
+
+    for node in nodes:
+        node.running = False
+    for node in nodes:
+        node.shutdown()
+    network.close()
+
+    detections = []
+    for ip in crashed_ips:
+        times = [at for at, _, target in network.failures if target == ip and at >= crash_time]
+        if times:
+            detections.append(min(times) - crash_time)
+    false_failures = sum(1 for at, _, target in network.failures if target not in crashed_ips or at < crash_time)
+    return {
+        "transport": transport, "nodes": size, "joined": joined, "settled": settled,
+        "detected": len(detections), "crashes": args.crashes,
+        "detection_mean": sum(detections) / len(detections) if detections else None,
+        "detection_max": max(detections) if detections else None,
+        "converged": converged, "false_failures": false_failures,
+        "messages_per_node_second": (messages_after - messages) / size / elapsed,
+        "bytes_per_node_second": (size_after - size_sent) / size / elapsed,
+        # Share of one CPU, for the whole process and for a node
+        "cpu": cpu / elapsed,
+        "cpu_per_node": cpu / elapsed / size,
+    }
+
+
+def seconds(value):
+    return value if value is not None else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs clusters of growing size in one process and measures failure '
+                                                 'detection, convergence and the cost of a node.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[25, 50, 100, 200], help='Cluster sizes to run')
+    parser.add_argument('--transports', nargs='+', choices=TRANSPORTS, default=["memory"], help='How messages travel')
+    parser.add_argument('--subnet', type=int, default=43, help='Second byte of the loopback addresses of the nodes')
+    parser.add_argument('--port', type=int, default=detection.PORT, help='Port of every node')
+    parser.add_argument('--loss', type=float, default=0.0, help='Probability a message is lost')
+    parser.add_argument('--delay', type=float, default=0.0, help='Seconds every message is delayed')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many more seconds of delay, at random')
+    parser.add_argument('--crashes', type=int, default=2, help='Nodes crashed once the cluster is steady')
+    parser.add_argument('--period', type=float, default=detection.PROTOCOL_PERIOD, help='Protocol period in seconds, the ping timeout is half of it')
+    parser.add_argument('--fail_periods', type=float, default=3, help='Periods without an ack before a node is failed')
+    parser.add_argument('--gossip_period', type=float, default=detection.GOSSIP_PERIOD, help='Seconds between two gossip rounds')
+    parser.add_argument('--window', type=float, default=5, help='Seconds the steady traffic and CPU are measured over')
+    parser.add_argument('--timeout', type=float, default=90, help='Seconds to wait for the nodes to join or see the crashes')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the results to')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'transport':<9} {'nodes':>5} {'join s':>7} {'settle s':>8} {'detected':>9} {'mean s':>7} {'max s':>7} {'all know s':>10} "
+              f"{'false':>6} {'msg/node/s':>10} {'B/node/s':>9} {'cpu':>6} {'cpu/node':>9}")
+        for transport in args.transports:
+            for size in sorted(args.sizes):
+                row = run(transport, size, args, directory)
+                results.append(row)
+                print(f"{transport:<9} {size:>5} {seconds(row['joined']):>7.2f} {seconds(row['settled']):>8.2f} {row['detected']:>4}/{row['crashes']:<4} "
+                      f"{seconds(row['detection_mean']):>7.2f} {seconds(row['detection_max']):>7.2f} "
+                      f"{seconds(row['converged']):>10.2f} {row['false_failures']:>6} "
+                      f"{row['messages_per_node_second']:>10.1f} {row['bytes_per_node_second']:>9.0f} "
+                      f"{row['cpu'] * 100:>5.0f}% {row['cpu_per_node'] * 100:>8.2f}%")
+                sys.stdout.flush()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
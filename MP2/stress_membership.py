@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import detection
+import wire
+
+STATUSES = ("alive", "suspicion", "failure")
+
+
+def member_ids(nodes):
+    return [f"127.1.{i // 256}.{i % 256}" for i in range(nodes)]
+
+
+def merge_load(node, ids, batch, versions, stop, counts):
+    # Gossip that changes the status of batch nodes at a time, with newer versions, so every
+    # merge publishes a snapshot and logs the changes
+    rng = random.Random()
+    while not stop.is_set():
+        entries = {}
+        for node_id in rng.sample(ids, batch):
+            versions[node_id] += 1
+            entries[node_id] = {"status": rng.choice(STATUSES), "timestamp": time.time(), "sus": False,
+                                "sus_timestamp": None, "version": versions[node_id]}
+        node.process_gossip(entries)
+        counts["merges"] += 1
+
+
+def ping_load(node, ids, stop, counts):
+    rng = random.Random()
+    while not stop.is_set():
+        node.process_ping(rng.choice(ids), detection.PORT, rng.randrange(1 << 15))
+        counts["pings"] += 1
+
+
+def read_load(node, stop, counts):
+    # What showlist, gossip rounds and digests do
+    while not stop.is_set():
+        node.get_membership_list()
+        wire.encode_deltas(node.membership_list)
+        counts["reads"] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Membership throughput and lock contention of one node under load.')
+    parser.add_argument('--nodes', type=int, default=200, help='Members in the list')
+    parser.add_argument('--batch', type=int, default=10, help='Entries changed by a gossip message')
+    parser.add_argument('--mergers', type=int, default=2, help='Threads merging gossip')
+    parser.add_argument('--pingers', type=int, default=2, help='Threads handling pings')
+    parser.add_argument('--readers', type=int, default=2, help='Threads reading and encoding the list')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds of load')
+    args = parser.parse_args()
+
+    ids = member_ids(args.nodes)
+    with tempfile.TemporaryDirectory() as directory:
+        membership_file = os.path.join(directory, "membership_list.json")
+        with open(membership_file, "w") as f:
+            json.dump({node_id: {"status": "alive", "timestamp": time.time(), "sus": False, "sus_timestamp": None,
+                                 "version": 1} for node_id in ids}, f)
+        # No probing until the load below ends
+        node = detection.GossipNode(membership_file=membership_file, ip="127.0.0.77", protocol_period=args.duration + 1,
+                                    log_file=os.path.join(directory, "stress.log"))
+        for lock in (node.list_lock, node.records_lock):
+            lock.reset()
+
+        stop = threading.Event()
+        versions = {node_id: 1 for node_id in ids}
+        counts = {"merges": 0, "pings": 0, "reads": 0}
+        threads = [threading.Thread(target=merge_load, args=(node, ids, args.batch, versions, stop, counts))
+                   for _ in range(args.mergers)]
+        threads += [threading.Thread(target=ping_load, args=(node, ids, stop, counts)) for _ in range(args.pingers)]
+        threads += [threading.Thread(target=read_load, args=(node, stop, counts)) for _ in range(args.readers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        stats = node.lock_stats()
+        node.logger.flush()
+        log_stats = node.logger.stats()
+        node.running = False
+        node.shutdown()
+
+    print(f"{args.nodes} members, {args.mergers} mergers of {args.batch} entries, {args.pingers} pingers, "
+          f"{args.readers} readers for {elapsed:.1f}s")
+    for kind, count in counts.items():
+        print(f"{kind:>8}: {count / elapsed:>10.0f}/s")
+    print(f"{'lock':>8} {'taken':>9} {'waited':>8} {'mean hold us':>13} {'max hold ms':>12} {'max wait ms':>12}")
+    for name, lock in stats.items():
+        waited = lock["contended"] / max(lock["acquisitions"], 1) * 100
+        print(f"{name:>8} {lock['acquisitions']:>9} {waited:>7.1f}% {lock['mean_hold'] * 1e6:>13.1f} "
+              f"{lock['max_hold'] * 1000:>12.2f} {lock['max_wait'] * 1000:>12.2f}")
+    print(f"log: {log_stats['written']} events written, {log_stats['dropped']} dropped, {log_stats['rotations']} rotations")
+
+if __name__ == "__main__":
+    main()
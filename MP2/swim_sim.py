@@ -0,0 +1,131 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import detection
+
+# Probing modes compared: the old one pings a random target and fails it on a missed ack,
+# SWIM goes round-robin and asks other nodes to ping a target before failing it
+MODES = {
+    "random": {"round_robin": False, "indirect_probes": 0},
+    "swim": {"round_robin": True, "indirect_probes": detection.INDIRECT_PROBES},
+}
+
+
+class SimulatedNode(detection.GossipNode):
+    # A node on its own loopback address that loses every message it sends with probability loss
+    def __init__(self, loss, events, **options):
+        self.loss = loss
+        self.events = events
+        self.pings = {}
+        self.sent = 0
+        super().__init__(**options)
+
+    def send_message(self, data, address):
+        self.sent += 1
+        if random.random() < self.loss:
+            return
+        super().send_message(data, address)
+
+    def send_ping(self, target_node):
+        self.pings[target_node] = self.pings.get(target_node, 0) + 1
+        super().send_ping(target_node)
+
+    def probe_failed(self, target_node):
+        with self.records_lock:
+            pending = target_node in self.probes
+        super().probe_failed(target_node)
+        if pending:
+            self.events.append((time.monotonic(), self.node_ip, target_node))
+
+
+def run(mode, loss, args, directory):
+    ips = [f"127.0.{args.subnet}.{i}" for i in range(1, args.nodes + 1)]
+    membership_file = os.path.join(directory, f"membership_{mode}_{loss}.json")
+    with open(membership_file, "w") as f:
+        json.dump({ip: {"status": "", "timestamp": 0, "sus": False, "sus_timestamp": None, "version": 1} for ip in ips}, f)
+    options = dict(MODES[mode], protocol_period=args.period, ping_timeout=args.period / 2,
+                   fail_wait_time=args.fail_periods * args.period, membership_file=membership_file,
+                   log_file=os.path.join(directory, f"swim_{mode}_{loss}.log"))
+    events = []
+    nodes = [SimulatedNode(loss, events, ip=ip, **options) for ip in ips]
+    start = time.monotonic()
+    time.sleep(args.duration / 3)
+    crashed = random.sample(nodes, args.crashes)
+    crash_time = time.monotonic()
+    for node in crashed:
+        # Stops answering, like a crashed process
+        node.running = False
+    crashed_ips = {node.node_ip for node in crashed}
+    live = [node for node in nodes if node not in crashed]
+
+    # Until every live node has the crashed ones as failed, or the run ends
+    converged = None
+    while time.monotonic() - start < args.duration:
+        if converged is None and all(node.membership_list[ip]["status"] == "failure" for node in live for ip in crashed_ips):
+            converged = time.monotonic() - crash_time
+        time.sleep(0.05)
+
+    for node in nodes:
+        node.running = False
+    for node in nodes:
+        node.shutdown()
+
+    detections = []
+    for ip in crashed_ips:
+        times = [at for at, _, target in events if target == ip and at >= crash_time]
+        if times:
+            detections.append(min(times) - crash_time)
+    false_failures = sum(1 for at, _, target in events if target not in crashed_ips or at < crash_time)
+    # Pings to nodes that were up, the chances a node had to be failed wrongly
+    probes = sum(count for node in nodes for target, count in node.pings.items() if target not in crashed_ips)
+    return {
+        "mode": mode, "loss": loss, "nodes": args.nodes, "probes": probes, "false_failures": false_failures,
+        "false_positive_rate": false_failures / max(probes, 1),
+        "detected": len(detections), "crashes": args.crashes,
+        "detection_mean": sum(detections) / len(detections) if detections else None,
+        "detection_max": max(detections) if detections else None,
+        "converged": converged,
+        "messages_per_second": sum(node.sent for node in nodes) / args.duration,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Failure detection latency and false positives of the probing modes under packet loss.')
+    parser.add_argument('--nodes', type=int, default=10, help='Nodes, on loopback addresses 127.0.<subnet>.1 and up')
+    parser.add_argument('--subnet', type=int, default=42, help='Third byte of the loopback addresses')
+    parser.add_argument('--crashes', type=int, default=2, help='Nodes crashed a third into the run')
+    parser.add_argument('--duration', type=float, default=12, help='Seconds of every run')
+    parser.add_argument('--period', type=float, default=0.2, help='Protocol period in seconds, the ping timeout is half of it')
+    parser.add_argument('--fail_periods', type=float, default=3, help='Periods without an ack before a node is failed')
+    parser.add_argument('--loss', type=float, nargs='+', default=[0, 0.05, 0.1, 0.2], help='Packet loss rates')
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES), help='Probing modes')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the results to')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'mode':<7} {'loss':>5} {'probes':>7} {'false':>6} {'fp rate':>8} {'detected':>9} "
+              f"{'mean s':>7} {'max s':>7} {'all know s':>10} {'msg/s':>7}")
+        for loss in args.loss:
+            for mode in args.modes:
+                row = run(mode, loss, args, directory)
+                results.append(row)
+                print(f"{mode:<7} {loss:>5.2f} {row['probes']:>7} {row['false_failures']:>6} "
+                      f"{row['false_positive_rate'] * 100:>7.2f}% {row['detected']:>4}/{row['crashes']:<4} "
+                      f"{row['detection_mean'] if row['detection_mean'] is not None else float('nan'):>7.2f} "
+                      f"{row['detection_max'] if row['detection_max'] is not None else float('nan'):>7.2f} "
+                      f"{row['converged'] if row['converged'] is not None else float('nan'):>10.2f} "
+                      f"{row['messages_per_second']:>7.0f}")
+                sys.stdout.flush()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
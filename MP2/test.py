@@ -0,0 +1,408 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import wire
+import log_update
+import detection
+from timer_wheel import TimerWheel
+from log_update import MembershipLogger
+
+
+def merge(messages):
+    # The entries, ids or digest of the parts of a split message, with the range of every digest part
+    merged, ranges = None, []
+    for data in messages:
+        msg_type, payload = wire.decode(data)
+        if msg_type == wire.DIGEST:
+            # JSON has no tuples
+            payload, bounds = {node_id: tuple(rank) for node_id, rank in payload[0].items()}, tuple(payload[1])
+            ranges.append((payload, bounds))
+        if merged is None:
+            merged = type(payload)()
+        if isinstance(payload, dict):
+            merged.update(payload)
+        else:
+            merged.extend(payload)
+    return merged, ranges
+
+
+def entry(version, status="alive", sus_timestamp=None):
+    return {"status": status, "timestamp": 1695805623.5 + version, "sus": sus_timestamp is not None,
+            "sus_timestamp": sus_timestamp, "version": version}
+
+
+class TestWire(unittest.TestCase):
+    def setUp(self):
+        # IPv4 addresses pack into fixed size items, host names do not
+        self.ips = [f"10.0.{i // 250}.{i % 250 + 1}" for i in range(300)]
+        self.hosts = [f"fa24-cs425-{i:04d}.cs.illinois.edu" for i in range(300)]
+
+    def test_round_trip(self):
+        entries = {"172.22.95.32": entry(3), "fa24-cs425-0001.cs.illinois.edu": entry(7, "suspicion", 1695805630.25),
+                   "172.22.95.33": entry(1, "")}
+        for wire_format in wire.FORMATS:
+            with self.subTest(wire_format=wire_format):
+                self.assertEqual(wire.decode(wire.encode_ping(7, wire_format)), (wire.PING, 7))
+                self.assertEqual(wire.decode(wire.encode_ack(2 ** 32 - 1, wire_format)), (wire.ACK, 2 ** 32 - 1))
+                for target in ("172.22.95.32", "fa24-cs425-0001.cs.illinois.edu"):
+                    self.assertEqual(wire.decode(wire.encode_ping_req(target, 9, wire_format)), (wire.PING_REQ, (target, 9)))
+                    self.assertEqual(wire.decode(wire.encode_indirect_ack(target, 9, wire_format)),
+                                     (wire.INDIRECT_ACK, (target, 9)))
+                self.assertEqual(merge(wire.encode_deltas(entries, wire_format))[0], entries)
+                for node_ids in (self.ips[:5], self.hosts[:5], self.ips[:2] + self.hosts[:2]):
+                    deltas = {node_id: entry(i + 1) for i, node_id in enumerate(node_ids)}
+                    self.assertEqual(merge(wire.encode_deltas(deltas, wire_format))[0], deltas)
+                    self.assertEqual(merge(wire.encode_pull(node_ids, wire_format))[0], node_ids)
+                    digest = {node_id: (i + 1, i % 3) for i, node_id in enumerate(node_ids)}
+                    self.assertEqual(merge(wire.encode_digest(digest, wire_format)), (digest, [(digest, (None, None))]))
+                self.assertEqual(wire.encode_digest({}, wire_format), [])
+
+    def test_split_messages(self):
+        for wire_format in wire.FORMATS:
+            for node_ids in (self.ips, self.hosts):
+                with self.subTest(wire_format=wire_format, ids=node_ids[0]):
+                    entries = {node_id: entry(i + 1, sus_timestamp=1695805630.0 if i % 2 else None)
+                               for i, node_id in enumerate(node_ids)}
+                    for messages, expected in ((wire.encode_deltas(entries, wire_format), entries),
+                                               (wire.encode_pull(node_ids, wire_format), node_ids)):
+                        self.assertGreater(len(messages), 1)
+                        self.assertTrue(all(len(data) <= wire.MAX_MESSAGE for data in messages))
+                        self.assertEqual(merge(messages)[0], expected)
+
+    def test_digest_ranges(self):
+        # Every part covers the ids from its low bound up to its high bound, and the parts
+        # cover every id together
+        for wire_format in wire.FORMATS:
+            for node_ids in (self.ips, self.hosts):
+                with self.subTest(wire_format=wire_format, ids=node_ids[0]):
+                    digest = {node_id: (i + 1, i % 3) for i, node_id in enumerate(node_ids)}
+                    messages = wire.encode_digest(digest, wire_format)
+                    self.assertGreater(len(messages), 1)
+                    self.assertTrue(all(len(data) <= wire.MAX_MESSAGE for data in messages))
+                    merged, ranges = merge(messages)
+                    self.assertEqual(merged, digest)
+                    self.assertIsNone(ranges[0][1][0])
+                    self.assertIsNone(ranges[-1][1][1])
+                    for (_, (_, high)), (_, (low, _)) in zip(ranges, ranges[1:]):
+                        self.assertEqual(high, low)
+                    for part, (low, high) in ranges:
+                        self.assertTrue(all((low is None or low <= node_id) and (high is None or node_id < high)
+                                            for node_id in part))
+
+    def test_bad_messages(self):
+        deltas = [wire.encode_deltas({node_ids[0]: entry(1)})[0] for node_ids in (self.ips, self.hosts)]
+        digest = wire.encode_digest({node_id: (1, 0) for node_id in self.hosts[:3]})[0]
+        ping_req = wire.encode_ping_req(self.hosts[0], 1)
+        bad = [b"", b"{", b"[1]", b'{"type": "unknown"}', bytes((wire.MAGIC,)),
+               bytes((wire.MAGIC, wire.VERSION + 1, wire.PING)) + bytes(4),
+               bytes((wire.MAGIC, wire.VERSION, 99)) + bytes(4),
+               ping_req[:wire.SEQ_MESSAGE.size], ping_req[:-1], digest[:-2]]
+        # Well formed JSON with payloads of the wrong types
+        bad += [json.dumps(message).encode() for message in (
+            {"type": "delta", "entries": [1]}, {"type": "delta", "entries": {"a": 5}},
+            {"type": "gossip", "membership_list": {"a": [1]}}, {"type": "pull", "ids": 5}, {"type": "pull", "ids": [5]},
+            {"type": "digest", "digest": [1]}, {"type": "digest", "digest": {"a": 5}}, {"type": "digest", "digest": {"a": [1, "x"]}},
+            {"type": "digest", "digest": {}, "range": [1, 2]}, {"type": "ping", "seq": "1"}, {"type": "ack", "seq": -1},
+            {"type": "ping_req", "target": 5, "seq": 1})]
+        bad += [data[:-3] for data in deltas]
+        for data in bad:
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    wire.decode(data)
+
+
+class OfflineNode(detection.GossipNode):
+    # A node without a socket or probing that keeps what it sends
+    def open_transport(self):
+        self.sent = []
+
+    def close_transport(self):
+        pass
+
+    def start_server(self):
+        pass
+
+    def gossip(self):
+        pass
+
+    def ping(self):
+        pass
+
+    def send_message(self, data, address):
+        self.sent.append((wire.decode(data), address))
+
+
+class TestMerge(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        membership_file = os.path.join(self.directory, "membership_list.json")
+        self.ips = [f"127.0.0.{i}" for i in range(1, 5)]
+        with open(membership_file, "w") as f:
+            json.dump({ip: entry(2) for ip in self.ips[:3]}, f)
+        self.node = OfflineNode(membership_file=membership_file, ip=self.ips[0],
+                                log_file=os.path.join(self.directory, "mp2.log"))
+
+    def tearDown(self):
+        self.node.running = False
+        self.node.shutdown()
+        shutil.rmtree(self.directory)
+
+    def status(self, ip):
+        info = self.node.membership_list.get(ip)
+        return (info["status"], info["version"]) if info is not None else None
+
+    def test_newer_entry_wins(self):
+        _, second, third, fourth = self.ips
+        self.node.process_gossip({second: entry(3, "failure"), third: entry(1, "failure")})
+        self.assertEqual((self.status(second), self.status(third)), (("failure", 3), ("alive", 2)))
+        self.assertNotIn(second, self.node.known_nodes)
+        # At the same version the worse status wins, the same rank changes nothing
+        same = dict(entry(2), timestamp=0.0)
+        self.node.process_gossip({third: same, second: entry(3, "alive")})
+        self.assertEqual(self.node.membership_list[third]["timestamp"], entry(2)["timestamp"])
+        self.assertEqual(self.status(second), ("failure", 3))
+        self.node.process_gossip({third: entry(2, "suspicion")})
+        self.assertEqual(self.status(third), ("suspicion", 2))
+        self.node.process_gossip({fourth: entry(1)})
+        self.assertEqual(self.status(fourth), ("alive", 1))
+        self.assertIn(fourth, self.node.known_nodes)
+
+    def test_refute(self):
+        me = self.ips[0]
+        self.node.process_gossip({me: entry(5, "failure")})
+        self.assertEqual((self.status(me), self.node.version), (("alive", 6), 6))
+        self.assertIn(me, self.node.changes)
+        # An older claim is already refuted
+        self.node.process_gossip({me: entry(4, "suspicion")})
+        self.assertEqual(self.status(me), ("alive", 6))
+
+    def test_entry_without_status(self):
+        second, fourth = self.ips[1], self.ips[3]
+        self.node.process_gossip({second: entry(9, ""), fourth: entry(9, "")})
+        self.assertEqual((self.status(second), self.status(fourth)), (("alive", 2), None))
+
+    def test_digest_pulls_stale_ids(self):
+        me, second, third, fourth = self.ips
+        peer = ("127.0.0.9", detection.PORT)
+        self.node.process_digest(*peer, {second: [5, 0], third: [2, 0], fourth: [1, 0]}, (None, None))
+        sent = {msg_type: payload for (msg_type, payload), address in self.node.sent if address == peer}
+        # Newer there or unknown here is pulled, newer here or missing there is sent
+        self.assertEqual(sorted(sent[wire.PULL]), [second, fourth])
+        self.assertEqual(list(sent[wire.DELTA]), [me])
+
+        # Only the ids of the range the digest covers
+        self.node.sent.clear()
+        self.node.process_digest(*peer, {third: [2, 0]}, (third, None))
+        self.assertEqual(self.node.sent, [])
+
+        self.node.process_pull(*peer, [third, fourth])
+        self.assertEqual([(msg_type, list(payload)) for (msg_type, payload), _ in self.node.sent], [(wire.DELTA, [third])])
+
+
+class Clock:
+    # A clock the test moves by hand
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        # Ticks of a quarter of a second, exact in binary, and a wheel that turns every 2 seconds
+        self.clock = Clock()
+        self.wheel = TimerWheel(tick=0.25, slots=8, clock=self.clock)
+        self.fired = []
+
+    def advance(self, now):
+        self.clock.now = now
+        return self.wheel.advance()
+
+    def test_fires_at_deadline(self):
+        self.wheel.schedule("a", 1.0, self.fired.append, "a")
+        self.assertEqual(self.advance(0.99), 0)
+        self.assertEqual(self.fired, [])
+        self.assertEqual(self.advance(1.0), 1)
+        self.assertEqual(self.fired, ["a"])
+        self.assertFalse(self.wheel.pending("a"))
+        self.assertEqual(self.advance(5.0), 0)
+        # Between two ticks, at the next one
+        self.wheel.schedule("b", 0.1, self.fired.append, "b")
+        self.assertEqual(self.advance(5.2), 0)
+        self.assertEqual(self.advance(5.25), 1)
+        self.assertEqual(self.fired, ["a", "b"])
+
+    def test_cancel(self):
+        self.wheel.schedule("a", 1.0, self.fired.append, "a")
+        self.wheel.schedule("b", 1.0, self.fired.append, "b")
+        self.assertTrue(self.wheel.cancel("a"))
+        self.assertFalse(self.wheel.cancel("a"))
+        self.assertFalse(self.wheel.pending("a"))
+        self.assertEqual(len(self.wheel), 1)
+        self.advance(3.0)
+        self.assertEqual(self.fired, ["b"])
+        self.wheel.schedule("c", 1.0, self.fired.append, "c")
+        self.wheel.cancel_all()
+        self.assertEqual((self.advance(6.0), len(self.wheel)), (0, 0))
+
+    def test_replace_by_key(self):
+        self.wheel.schedule("a", 1.0, self.fired.append, 1)
+        self.wheel.schedule("a", 1.5, self.fired.append, 2)
+        self.assertEqual(len(self.wheel), 1)
+        self.assertEqual(self.advance(1.25), 0)
+        self.assertEqual(self.advance(1.5), 1)
+        self.assertEqual(self.fired, [2])
+        # An earlier deadline replaces a later one too
+        self.wheel.schedule("a", 3.0, self.fired.append, 3)
+        self.wheel.schedule("a", 0.5, self.fired.append, 4)
+        self.advance(5.0)
+        self.assertEqual(self.fired, [2, 4])
+
+    def test_timers_past_one_turn(self):
+        # 5 seconds is 20 ticks, two and a half turns of the wheel, so the timer shares its slot
+        # with one due after a second
+        self.wheel.schedule("later", 5.0, self.fired.append, "later")
+        self.wheel.schedule("soon", 1.0, self.fired.append, "soon")
+        self.assertEqual(self.wheel.timers["later"].rounds, 2)
+        self.assertEqual(self.advance(1.0), 1)
+        for now in (3.0, 4.99):
+            self.assertEqual(self.advance(now), 0)
+        self.assertEqual(self.advance(5.0), 1)
+        self.assertEqual(self.fired, ["soon", "later"])
+
+    def test_callback_schedules(self):
+        # Callbacks run outside the lock, so a timer can schedule the next one
+        def again(count):
+            self.fired.append(count)
+            if count < 3:
+                self.wheel.schedule("a", 1.0, again, count + 1)
+        self.wheel.schedule("a", 1.0, again, 1)
+        for now in (1.0, 2.0, 3.0, 4.0):
+            self.advance(now)
+        self.assertEqual(self.fired, [1, 2, 3])
+
+
+class TestMembershipLogger(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.directory, "mp2.log")
+        self.loggers = []
+
+    def tearDown(self):
+        for logger in self.loggers:
+            logger.close()
+        shutil.rmtree(self.directory)
+
+    def logger(self, **options):
+        logger = MembershipLogger(self.log_file, **options)
+        self.loggers.append(logger)
+        return logger
+
+    def hold(self, logger):
+        # Makes the logger's thread wait in its first write until the returned event is set,
+        # and records the lines of every write
+        entered, gate, writes = threading.Event(), threading.Event(), []
+        write = logger.write
+
+        def held(text):
+            entered.set()
+            gate.wait()
+            writes.append(text.count("\n"))
+            write(text)
+        logger.write = held
+        return entered, gate, writes
+
+    def read(self, name="mp2.log"):
+        with open(os.path.join(self.directory, name)) as f:
+            return f.read().splitlines()
+
+    def test_batches_in_order(self):
+        logger = self.logger()
+        entered, gate, writes = self.hold(logger)
+        logger.log("node-0", "joined", 0)
+        entered.wait(5)
+        for i in range(1, 1000):
+            logger.log(f"node-{i}", "joined", i)
+        gate.set()
+        self.assertTrue(logger.flush())
+        # The first event alone, then the others in batches of at most BATCH_SIZE
+        self.assertEqual(writes, [1, log_update.BATCH_SIZE, 999 - log_update.BATCH_SIZE])
+        self.assertEqual([line.split(" - ")[1] for line in self.read()],
+                         [f"Node: node-{i} Version: {i}" for i in range(1000)])
+        self.assertEqual(logger.stats(), {"written": 1000, "dropped": 0, "queued": 0, "rotations": 0})
+
+    def test_drops_counted(self):
+        logger = self.logger(queue_size=10)
+        entered, gate, _ = self.hold(logger)
+        logger.log("node-0", "joined", 0)
+        entered.wait(5)
+        for i in range(1, 31):
+            logger.log(f"node-{i}", "joined", i)
+        gate.set()
+        self.assertTrue(logger.flush())
+        lines = self.read()
+        self.assertEqual(len(lines), 12)
+        self.assertTrue(lines[-1].endswith("Node: logger Version: 0 - has dropped 20 events"))
+        self.assertEqual((logger.stats()["dropped"], logger.stats()["written"]), (20, 12))
+
+        # Events that cannot be written are dropped too
+        write = logger.write
+
+        def failing(text):
+            logger.write = write
+            raise OSError("disk full")
+        logger.write = failing
+        logger.log("lost", "joined", 1)
+        self.assertTrue(logger.flush())
+        logger.log("node-31", "joined", 31)
+        self.assertTrue(logger.flush())
+        self.assertEqual(logger.stats()["dropped"], 21)
+        self.assertTrue(self.read()[-1].endswith("has dropped 1 events"))
+        self.assertNotIn("lost", "".join(self.read()))
+
+    def test_rotation(self):
+        logger = self.logger(max_bytes=200, backups=2)
+        for i in range(30):
+            logger.log(f"node-{i}", "joined", i)
+            self.assertTrue(logger.flush())
+        names = sorted(os.listdir(self.directory))
+        self.assertEqual(names, ["mp2.log", "mp2.log.1", "mp2.log.2"])
+        self.assertTrue(all(os.path.getsize(os.path.join(self.directory, name)) <= 200 for name in names))
+        lines = self.read("mp2.log.2") + self.read("mp2.log.1") + self.read()
+        self.assertEqual([line.split(" - ")[1] for line in lines],
+                         [f"Node: node-{i} Version: {i}" for i in range(30 - len(lines), 30)])
+        self.assertGreater(logger.stats()["rotations"], 2)
+
+        # A log removed under the logger is started again at the next rotation
+        os.remove(self.log_file)
+        for i in range(30, 40):
+            logger.log(f"node-{i}", "joined", i)
+            self.assertTrue(logger.flush())
+        self.assertEqual(logger.stats()["written"], 40)
+        self.assertTrue(self.read()[-1].endswith("Node: node-39 Version: 39 - has joined"))
+
+    def test_json_format(self):
+        logger = self.logger(log_format="json", reporter="172.22.95.32")
+        logger.log("172.22.95.33", "failure", 4)
+        self.assertTrue(logger.flush())
+        timestamp, level, record = self.read()[0].split(" - ", 2)
+        record = json.loads(record)
+        self.assertEqual(level, "FAILURE")
+        self.assertEqual(record.pop("time") // 1, time.mktime(time.strptime(timestamp, "%Y-%m-%d %H:%M:%S")))
+        self.assertEqual(record, {"node": "172.22.95.33", "action": "failure", "version": 4, "reporter": "172.22.95.32"})
+
+    def test_flush_after_close(self):
+        logger = self.logger()
+        logger.log("node-0", "joined", 0)
+        logger.close()
+        self.assertFalse(logger.flush())
+        self.assertEqual(self.read()[0].split(" - ")[1], "Node: node-0 Version: 0")
+
+
+if __name__ == '__main__':
+    unittest.main()
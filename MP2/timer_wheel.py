@@ -0,0 +1,106 @@
+import math
+import time
+import threading
+
+# Resolution of the timers, and slots of the wheel: a timer due within TICK * SLOTS seconds
+# is found in its slot at its tick, a later one stays there for more turns of the wheel
+TICK = 0.1
+SLOTS = 512
+
+
+class Timer:
+    __slots__ = ("key", "deadline", "rounds", "callback", "args", "cancelled")
+
+    def __init__(self, key, deadline, rounds, callback, args):
+        self.key = key
+        self.deadline = deadline
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+class TimerWheel:
+    # A hashed timing wheel on the monotonic clock. Scheduling and cancelling cost the same
+    # whatever the number of timers, and a tick only looks at the timers of one slot. A
+    # cancelled timer is only marked, and dropped when its slot comes round.
+    def __init__(self, tick=TICK, slots=SLOTS, clock=time.monotonic):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.clock = clock
+        self.start = clock()
+        # Next tick to process
+        self.current = 0
+        # Pending timer of every key
+        self.timers = {}
+        self.lock = threading.Lock()
+
+    def schedule(self, key, delay, callback, *args):
+        # Calls callback(*args) delay seconds from now, replacing the pending timer of key
+        with self.lock:
+            old = self.timers.pop(key, None)
+            if old is not None:
+                old.cancelled = True
+            deadline = self.clock() + delay
+            # The first tick at or after the deadline, never one already processed
+            tick = max(self.current, math.ceil((deadline - self.start) / self.tick))
+            timer = Timer(key, deadline, (tick - self.current) // len(self.slots), callback, args)
+            self.slots[tick % len(self.slots)].append(timer)
+            self.timers[key] = timer
+
+    def cancel(self, key):
+        # Returns whether key had a pending timer
+        with self.lock:
+            timer = self.timers.pop(key, None)
+            if timer is None:
+                return False
+            timer.cancelled = True
+            return True
+
+    def cancel_all(self):
+        with self.lock:
+            for timer in self.timers.values():
+                timer.cancelled = True
+            self.timers.clear()
+
+    def pending(self, key):
+        with self.lock:
+            return key in self.timers
+
+    def __len__(self):
+        return len(self.timers)
+
+    def advance(self, now=None):
+        # Fires the timers due by now, returns how many
+        now = self.clock() if now is None else now
+        due = []
+        with self.lock:
+            last = math.floor((now - self.start) / self.tick)
+            while self.current <= last:
+                index = self.current % len(self.slots)
+                later = []
+                for timer in self.slots[index]:
+                    if timer.cancelled:
+                        continue
+                    if timer.rounds > 0:
+                        timer.rounds -= 1
+                        later.append(timer)
+                    else:
+                        del self.timers[timer.key]
+                        due.append(timer)
+                self.slots[index] = later
+                self.current += 1
+        # Outside the lock, so callbacks can schedule and cancel timers
+        for timer in due:
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                print(f"Timer {timer.key} failed: {e}")
+        return len(due)
+
+    def run(self, running):
+        # Fires the timers at every tick while running() is true. It sleeps until the start of
+        # the next tick on the clock, so late wake-ups do not add up.
+        while running():
+            time.sleep(max(0.0, self.start + self.current * self.tick - self.clock()))
+            self.advance()
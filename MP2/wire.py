@@ -0,0 +1,367 @@
+import json
+import math
+import socket
+import struct
+import sys
+
+# Messages of the failure detector on the wire. The binary format is the default, JSON is
+# kept to read the messages while debugging. Both decode to (type, payload) so the node
+# handles them the same way, and a node reads both whatever format it sends.
+BINARY = "binary"
+JSON = "json"
+FORMATS = (BINARY, JSON)
+
+# First byte of a binary message. A JSON message starts with "{", so the two never mix up
+MAGIC = 0xC5
+VERSION = 1
+
+# Gossip messages are split to stay within one Ethernet frame (1500 bytes less the IP and UDP headers)
+MAX_MESSAGE = 1400
+
+PING, ACK, DELTA, DIGEST, PULL, GOSSIP, PING_REQ, INDIRECT_ACK = range(1, 9)
+TYPE_NAMES = {PING: "ping", ACK: "ack", DELTA: "delta", DIGEST: "digest", PULL: "pull", GOSSIP: "gossip",
+              PING_REQ: "ping_req", INDIRECT_ACK: "indirect_ack"}
+TYPES = {name: msg_type for msg_type, name in TYPE_NAMES.items()}
+
+# "" is a node of the membership file that never joined
+STATUSES = ("", "alive", "suspicion", "failure", "leave")
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+STATUS_CODES[None] = 0
+
+# magic, version, type
+HEADER = struct.Struct("!BBB")
+# A ping or an ack is the header and the sequence number, packed in one call. A ping-req
+# and an indirect ack add the id of the node pinged.
+SEQ_MESSAGE = struct.Struct("!BBBI")
+# Entries, ids or digest ranks in a message
+COUNT = struct.Struct("!H")
+# An entry after its id: status, sus, version, timestamp, sus_timestamp (NaN for none)
+ENTRY = struct.Struct("!BBIdd")
+# A digest rank after its id: version, status rank
+RANK = struct.Struct("!IB")
+# Flags after the header of a delta, digest or pull. With IPV4_IDS every id is an IPv4
+# address, so the items have a fixed size and are unpacked by one iter_unpack call.
+LOW_BOUND = 1
+HIGH_BOUND = 2
+IPV4_IDS = 4
+IPV4_ENTRY = struct.Struct("!5sBBIdd")
+IPV4_RANK = struct.Struct("!5sIB")
+IPV4_ID = struct.Struct("!5s")
+
+# Node ids are interned: every id is encoded and decoded once, later messages only look it up.
+# An IPv4 address takes 4 bytes after a 0, any other id its length (1 to 255) and its UTF-8.
+MAX_INTERNED = 4096
+_packed_ids = {}
+_ids = {}
+
+
+def pack_id(node_id):
+    packed = _packed_ids.get(node_id)
+    if packed is not None:
+        return packed
+    try:
+        address = socket.inet_aton(node_id)
+        ipv4 = socket.inet_ntoa(address) == node_id
+    except OSError:
+        ipv4 = False
+    if ipv4:
+        packed = b"\x00" + address
+    else:
+        raw = node_id.encode()
+        if not 0 < len(raw) < 256:
+            raise ValueError(f"Node id of {len(raw)} bytes")
+        packed = bytes((len(raw),)) + raw
+    if len(_packed_ids) < MAX_INTERNED:
+        _packed_ids[node_id] = packed
+    return packed
+
+
+def unpack_id(data, offset):
+    length = data[offset]
+    end = offset + 1 + (length or 4)
+    if end > len(data):
+        raise ValueError("Truncated node id")
+    key = data[offset:end]
+    node_id = _ids.get(key)
+    if node_id is None:
+        node_id = sys.intern(socket.inet_ntoa(key[1:]) if length == 0 else key[1:].decode())
+        if len(_ids) < MAX_INTERNED:
+            _ids[key] = node_id
+    return node_id, end
+
+
+def encode_ping(seq, wire_format=BINARY):
+    if wire_format == JSON:
+        return json.dumps({"type": "ping", "seq": seq}).encode()
+    return SEQ_MESSAGE.pack(MAGIC, VERSION, PING, seq)
+
+
+def encode_ack(seq, wire_format=BINARY):
+    if wire_format == JSON:
+        return json.dumps({"type": "ack", "seq": seq}).encode()
+    return SEQ_MESSAGE.pack(MAGIC, VERSION, ACK, seq)
+
+
+def encode_ping_req(target, seq, wire_format=BINARY):
+    # Asks the receiver to ping target and relay its ack, seq being the sequence number to answer with
+    if wire_format == JSON:
+        return json.dumps({"type": "ping_req", "target": target, "seq": seq}).encode()
+    return SEQ_MESSAGE.pack(MAGIC, VERSION, PING_REQ, seq) + pack_id(target)
+
+
+def encode_indirect_ack(target, seq, wire_format=BINARY):
+    if wire_format == JSON:
+        return json.dumps({"type": "indirect_ack", "target": target, "seq": seq}).encode()
+    return SEQ_MESSAGE.pack(MAGIC, VERSION, INDIRECT_ACK, seq) + pack_id(target)
+
+
+def pack_entry(node_id, info):
+    sus_timestamp = info.get("sus_timestamp")
+    return pack_id(node_id) + ENTRY.pack(
+        STATUS_CODES[info.get("status")], bool(info.get("sus")), info["version"],
+        info.get("timestamp") or 0.0, math.nan if sus_timestamp is None else sus_timestamp)
+
+
+def encode_deltas(entries, wire_format=BINARY, limit=MAX_MESSAGE):
+    # The entries, a dict of node id to entry, in as many messages as needed to keep each within limit bytes
+    if wire_format == JSON:
+        return pack_messages({"type": "delta"}, "entries", entries, limit)
+    node_ids = list(entries)
+    return pack_binary(DELTA, node_ids, [pack_entry(node_id, entries[node_id]) for node_id in node_ids], limit)
+
+
+def encode_pull(node_ids, wire_format=BINARY, limit=MAX_MESSAGE):
+    if wire_format == JSON:
+        return pack_messages({"type": "pull"}, "ids", node_ids, limit)
+    return pack_binary(PULL, node_ids, [pack_id(node_id) for node_id in node_ids], limit)
+
+
+def encode_digest(digest, wire_format=BINARY, limit=MAX_MESSAGE):
+    # digest maps node ids to (version, status rank). Each part covers the ids from its first
+    # one to the first one of the next part, so the receiver also knows which of its ids the
+    # sender does not have.
+    node_ids = sorted(digest)
+    if not node_ids:
+        return []
+    if wire_format == JSON:
+        reserve = 2 * max(len(json.dumps(node_id)) for node_id in node_ids) + 20
+        parts = [json.loads(part) for part in pack_messages(
+            {"type": "digest"}, "digest", {node_id: digest[node_id] for node_id in node_ids}, limit - reserve)]
+        bounds = [None] + [min(part["digest"]) for part in parts[1:]] + [None]
+        for i, part in enumerate(parts):
+            part["range"] = [bounds[i], bounds[i + 1]]
+        return [json.dumps(part).encode() for part in parts]
+    items = [pack_id(node_id) + RANK.pack(*digest[node_id]) for node_id in node_ids]
+    reserve = 1 + 2 * max(len(pack_id(node_id)) for node_id in node_ids)
+    parts = split_items(items, limit - HEADER.size - reserve - COUNT.size)
+    bounds = [None] + [node_ids[start] for start, _ in parts[1:]] + [None]
+    header = HEADER.pack(MAGIC, VERSION, DIGEST)
+    messages = []
+    for i, (start, end) in enumerate(parts):
+        low, high = bounds[i], bounds[i + 1]
+        flags = id_flags(node_ids[start:end]) | (LOW_BOUND if low is not None else 0) | (HIGH_BOUND if high is not None else 0)
+        ranges = bytes((flags,)) + (pack_id(low) if low is not None else b"") + (pack_id(high) if high is not None else b"")
+        messages.append(header + ranges + COUNT.pack(end - start) + b"".join(items[start:end]))
+    return messages
+
+
+def split_items(items, room):
+    # (start, end) of runs of the packed items that fit in room bytes, at least one item each
+    parts = []
+    start, size = 0, 0
+    for i, item in enumerate(items):
+        if i > start and size + len(item) > room:
+            parts.append((start, i))
+            start, size = i, 0
+        size += len(item)
+    if start < len(items):
+        parts.append((start, len(items)))
+    return parts
+
+
+def id_flags(node_ids):
+    return IPV4_IDS if all(pack_id(node_id)[0] == 0 for node_id in node_ids) else 0
+
+
+def pack_binary(msg_type, node_ids, items, limit):
+    # items[i] is the packed item of node_ids[i]
+    header = HEADER.pack(MAGIC, VERSION, msg_type)
+    return [header + bytes((id_flags(node_ids[start:end]),)) + COUNT.pack(end - start) + b"".join(items[start:end])
+            for start, end in split_items(items, limit - HEADER.size - 1 - COUNT.size)]
+
+
+def pack_messages(message, field, items, limit=MAX_MESSAGE):
+    # Splits items, a dict or a list, over as many JSON copies of message as needed to keep each one within limit bytes
+    empty = {} if isinstance(items, dict) else []
+    base = len(json.dumps(dict(message, **{field: empty})))
+    messages = []
+    part, size = type(empty)(), base
+    for item in (items.items() if isinstance(items, dict) else items):
+        # An item adds its own size plus a separator, which a container of it alone also counts
+        item_size = len(json.dumps(dict([item]) if isinstance(items, dict) else [item]))
+        if part and size + item_size > limit:
+            messages.append(json.dumps(dict(message, **{field: part})).encode())
+            part, size = type(empty)(), base
+        if isinstance(items, dict):
+            part[item[0]] = item[1]
+        else:
+            part.append(item)
+        size += item_size
+    if part:
+        messages.append(json.dumps(dict(message, **{field: part})).encode())
+    return messages
+
+
+def decode(data):
+    # Returns (type, payload): the sequence number of a ping or an ack, (target, seq) of a
+    # ping-req or an indirect ack, the entries of a delta or gossip, (digest, (low, high)) of a
+    # digest, the node ids of a pull
+    if not data:
+        raise ValueError("Empty message")
+    if data[0] != MAGIC:
+        return decode_json(data)
+    try:
+        if len(data) == SEQ_MESSAGE.size:
+            # A ping or an ack, the common case, without building anything
+            _, version, msg_type, seq = SEQ_MESSAGE.unpack(data)
+            if version == VERSION and (msg_type == PING or msg_type == ACK):
+                return msg_type, seq
+        _, version, msg_type = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise ValueError(f"Wire version {version} is not supported")
+        offset = HEADER.size
+        if msg_type == PING_REQ or msg_type == INDIRECT_ACK:
+            _, _, _, seq = SEQ_MESSAGE.unpack_from(data)
+            target, _ = unpack_id(data, SEQ_MESSAGE.size)
+            return msg_type, (target, seq)
+        if msg_type == DELTA:
+            return DELTA, unpack_entries(data, offset)
+        if msg_type == DIGEST:
+            return DIGEST, unpack_digest(data, offset)
+        if msg_type == PULL:
+            return PULL, unpack_ids(data, offset)
+    except (struct.error, IndexError) as e:
+        raise ValueError(f"Malformed message: {e}")
+    raise ValueError(f"Wrong message type {msg_type}")
+
+
+def unpack_count(data, offset, flags, ipv4_item):
+    # Returns the count of items at offset and where they start, checking fixed size items fill the message
+    (count,) = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    if flags & IPV4_IDS and len(data) - offset != count * ipv4_item.size:
+        raise ValueError("Wrong number of items")
+    return count, offset
+
+
+def ipv4_id(key):
+    # The id of the packed IPv4 address key, interned
+    node_id = _ids.get(key)
+    if node_id is None:
+        if key[0] != 0:
+            raise ValueError("Not an IPv4 address")
+        node_id, _ = unpack_id(key, 0)
+    return node_id
+
+
+def make_entry(status, sus, version, timestamp, sus_timestamp):
+    return {
+        "status": STATUSES[status],
+        "timestamp": timestamp,
+        "sus": bool(sus),
+        "sus_timestamp": None if math.isnan(sus_timestamp) else sus_timestamp,
+        "version": version
+    }
+
+
+def unpack_entries(data, offset):
+    flags = data[offset]
+    count, offset = unpack_count(data, offset + 1, flags, IPV4_ENTRY)
+    if flags & IPV4_IDS:
+        return {ipv4_id(key): make_entry(*fields) for key, *fields in IPV4_ENTRY.iter_unpack(data[offset:])}
+    entries = {}
+    for _ in range(count):
+        node_id, offset = unpack_id(data, offset)
+        entries[node_id] = make_entry(*ENTRY.unpack_from(data, offset))
+        offset += ENTRY.size
+    return entries
+
+
+def unpack_digest(data, offset):
+    flags = data[offset]
+    offset += 1
+    low = high = None
+    if flags & LOW_BOUND:
+        low, offset = unpack_id(data, offset)
+    if flags & HIGH_BOUND:
+        high, offset = unpack_id(data, offset)
+    count, offset = unpack_count(data, offset, flags, IPV4_RANK)
+    if flags & IPV4_IDS:
+        return {ipv4_id(key): (version, rank) for key, version, rank in IPV4_RANK.iter_unpack(data[offset:])}, (low, high)
+    digest = {}
+    for _ in range(count):
+        node_id, offset = unpack_id(data, offset)
+        digest[node_id] = RANK.unpack_from(data, offset)
+        offset += RANK.size
+    return digest, (low, high)
+
+
+def unpack_ids(data, offset):
+    flags = data[offset]
+    count, offset = unpack_count(data, offset + 1, flags, IPV4_ID)
+    if flags & IPV4_IDS:
+        return [ipv4_id(key) for key, in IPV4_ID.iter_unpack(data[offset:])]
+    node_ids = []
+    for _ in range(count):
+        node_id, offset = unpack_id(data, offset)
+        node_ids.append(node_id)
+    return node_ids
+
+
+def decode_json(data):
+    # Checks the payload has the types the node handles, like the binary decoder does
+    message = json.loads(data)
+    if not isinstance(message, dict):
+        raise ValueError("Not a message")
+    msg_type = TYPES.get(message.get("type"))
+    if msg_type == PING or msg_type == ACK:
+        return msg_type, json_seq(message)
+    if msg_type == PING_REQ or msg_type == INDIRECT_ACK:
+        target = message["target"]
+        if not isinstance(target, str):
+            raise ValueError("The target must be a node id")
+        return msg_type, (target, json_seq(message))
+    if msg_type == DELTA:
+        return DELTA, json_entries(message["entries"])
+    if msg_type == GOSSIP:
+        # The whole list, as older nodes send it
+        return GOSSIP, json_entries(message["membership_list"])
+    if msg_type == DIGEST:
+        digest, key_range = message["digest"], message.get("range") or (None, None)
+        if not isinstance(digest, dict) or not all(
+                isinstance(rank, list) and len(rank) == 2 and all(type(value) is int for value in rank)
+                for rank in digest.values()):
+            raise ValueError("The digest must map node ids to [version, status rank]")
+        if not isinstance(key_range, (list, tuple)) or len(key_range) != 2 or not all(
+                bound is None or isinstance(bound, str) for bound in key_range):
+            raise ValueError("The range must be two node ids or nulls")
+        return DIGEST, (digest, tuple(key_range))
+    if msg_type == PULL:
+        node_ids = message["ids"]
+        if not isinstance(node_ids, list) or not all(isinstance(node_id, str) for node_id in node_ids):
+            raise ValueError("ids must be a list of node ids")
+        return PULL, node_ids
+    raise ValueError(f"Wrong message type {message.get('type')}")
+
+
+def json_seq(message):
+    seq = message["seq"]
+    if type(seq) is not int or not 0 <= seq < 1 << 32:
+        raise ValueError("The sequence number must be a 32 bit unsigned integer")
+    return seq
+
+
+def json_entries(entries):
+    if not isinstance(entries, dict) or not all(isinstance(info, dict) for info in entries.values()):
+        raise ValueError("The entries must map node ids to entries")
+    return entries